@@ -0,0 +1,270 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import pickle
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import p2
+import persistencia
+
+_estado_inicial = None  # cópia do estado herdado por cada processo do conjunto de simula_cenarios
+
+
+def lista_instantaneos(pasta):
+    """
+    Lista os instantâneos do mercado de uma pasta: ficheiros no formato de carrega_mercado cujo nome, sem extensão, é
+    a data da cotação no formato 'AAAA-MM-DD'. Os restantes ficheiros, incluindo as caches binárias, são ignorados.
+
+    Args:
+    - pasta (str): Pasta com os instantâneos.
+
+    Returns:
+    - list: Pares (data, caminho), por ordem cronológica.
+    """
+    instantaneos = []
+    for nome in os.listdir(pasta):
+        if nome.endswith(('.cache', '.tmp')):
+            continue
+        try:
+            data = datetime.date.fromisoformat(os.path.splitext(nome)[0])
+        except ValueError:
+            continue
+        instantaneos.append((data, os.path.join(pasta, nome)))
+    instantaneos.sort()
+    return instantaneos
+
+
+def divide_periodo(pasta, partes, data_inicio=None, data_fim=None):
+    """
+    Divide o período coberto pelos instantâneos de uma pasta em intervalos consecutivos, com um número semelhante
+    de instantâneos, para serem simulados de forma independente.
+
+    Args:
+    - pasta (str): Pasta com os instantâneos.
+    - partes (int): Número máximo de intervalos.
+    - data_inicio (str): Primeira data a considerar, no formato 'AAAA-MM-DD'. Por omissão, a do primeiro instantâneo.
+    - data_fim (str): Última data a considerar, no formato 'AAAA-MM-DD'. Por omissão, a do último instantâneo.
+
+    Returns:
+    - list: Pares (data_inicio, data_fim) no formato 'AAAA-MM-DD', cada um a começar num instantâneo.
+    """
+    datas = [data for data, _ in lista_instantaneos(pasta)
+             if (not data_inicio or str(data) >= data_inicio) and (not data_fim or str(data) <= data_fim)]
+    if not datas:
+        return []
+    partes = max(1, min(partes, len(datas)))
+    inicios = [datas[len(datas) * i // partes] for i in range(partes)]
+    fins = [inicio - datetime.timedelta(days=1) for inicio in inicios[1:]] + [datas[-1]]
+    return [(str(inicio), str(fim)) for inicio, fim in zip(inicios, fins)]
+
+
+def simula(pasta, ficheiro_ordens=None, data_inicio=None, data_fim=None, carteira_ids=None):
+    """
+    Repete a abertura de todos os dias de um período sobre o estado atual de p2, carregando em cada dia o
+    instantâneo do mercado dessa data, e regista o valor das carteiras em cada dia com instantâneo.
+
+    Os dias sem instantâneo são abertos com as últimas cotações conhecidas, para que as ordens agendadas para eles
+    sejam executadas. Em cada dia, inicia_dia é chamada antes da carga do instantâneo: as ordens do dia são avaliadas
+    com as cotações do fecho anterior e as que ficam no livro de limites são disparadas pelas novas cotações. Os
+    instantâneos só são lidos quando a simulação chega à sua data, a partir da cache binária de carrega_mercado,
+    que é projetada em memória (mmap) e criada na primeira leitura de cada ficheiro.
+
+    A data atual de p2 passa a ser a véspera do primeiro dia, para que as ordens do ficheiro sejam validadas contra
+    o período simulado e não contra a data real. O estado de p2 é alterado pela simulação; as operações não são
+    registadas no diário de escrita.
+
+    Args:
+    - pasta (str): Pasta com os instantâneos do mercado (ver lista_instantaneos).
+    - ficheiro_ordens (str): Ficheiro de ordens a carregar antes da simulação, no formato de carrega_ordens.
+    - data_inicio (str): Primeiro dia a abrir, no formato 'AAAA-MM-DD'. Por omissão, o do primeiro instantâneo.
+    - data_fim (str): Último dia a abrir, no formato 'AAAA-MM-DD'. Por omissão, o do último instantâneo.
+    - carteira_ids (iterable): Carteiras a valorizar. Por omissão, todas as carteiras abertas no início.
+
+    Raises:
+    - ValueError: Se a pasta não tiver instantâneos ou houver um erro a abrir algum dos ficheiros.
+
+    Returns:
+    - dict: Série temporal em colunas: 'datas' (lista das datas com instantâneo), 'carteira_ids' (array) e 'valores'
+      (array com o valor, em euros, de cada carteira em cada data, dia a dia, na ordem de 'carteira_ids'), além das
+      linhas rejeitadas do ficheiro de ordens ('rejeitadas').
+    """
+    instantaneos = lista_instantaneos(pasta)
+    if not instantaneos:
+        raise ValueError('pasta sem instantaneos do mercado')
+    inicio = datetime.date.fromisoformat(data_inicio) if data_inicio else instantaneos[0][0]
+    fim = datetime.date.fromisoformat(data_fim) if data_fim else instantaneos[-1][0]
+    carteira_ids = array('q', sorted(p2.carteiras) if carteira_ids is None else carteira_ids)
+    resultado = {'datas': [], 'carteira_ids': carteira_ids, 'valores': array('d'), 'rejeitadas': []}
+
+    diario, p2.diario_escrita = p2.diario_escrita, None
+    try:
+        # O dia de início é aberto com o último instantâneo anterior, se houver
+        p2.estado['hoje'] = inicio - datetime.timedelta(days=1)
+        proximo = 0
+        while proximo < len(instantaneos) and instantaneos[proximo][0] < inicio:
+            proximo += 1
+        if proximo:
+            p2.carrega_mercado(instantaneos[proximo - 1][1])
+        if ficheiro_ordens:
+            resultado['rejeitadas'] = p2.carrega_ordens(ficheiro_ordens)
+
+        dia = inicio
+        while dia <= fim:
+            p2.inicia_dia(str(dia))
+            if proximo < len(instantaneos) and instantaneos[proximo][0] == dia:
+                p2.carrega_mercado(instantaneos[proximo][1])
+                proximo += 1
+                _regista_valores(resultado, dia)
+            dia += datetime.timedelta(days=1)
+    finally:
+        p2.diario_escrita = diario
+    return resultado
+
+
+def _regista_valores(resultado, dia):
+    """
+    Acrescenta à série temporal o valor atual das carteiras valorizadas.
+
+    Args:
+    - resultado (dict): Série temporal em construção, tal como devolvida por simula.
+    - dia (datetime.date): Data dos valores.
+
+    Returns:
+    - None
+    """
+    valores = p2.valores_carteiras
+    escala = p2.ESCALA_MONETARIA
+    resultado['datas'].append(str(dia))
+    resultado['valores'].extend([valores[carteira_id] / escala for carteira_id in resultado['carteira_ids']])
+
+
+def serie_carteira(resultado, carteira_id):
+    """
+    Extrai da série temporal de uma simulação os valores diários de uma carteira.
+
+    Args:
+    - resultado (dict): Série temporal, tal como devolvida por simula.
+    - carteira_id (int): Identificador da carteira.
+
+    Raises:
+    - ValueError: Se a carteira não tiver sido valorizada na simulação.
+
+    Returns:
+    - array: Valor da carteira, em euros, em cada data de resultado['datas'].
+    """
+    coluna = list(resultado['carteira_ids']).index(carteira_id)
+    return array('d', memoryview(resultado['valores'])[coluna::len(resultado['carteira_ids'])])
+
+
+def _copia_estado():
+    """
+    Guarda uma cópia do estado de p2, para que cada cenário parta do mesmo estado inicial.
+
+    Returns:
+    - bytes: Variáveis de estado serializadas.
+    """
+    return pickle.dumps({nome: getattr(p2, nome) for nome in p2.VARIAVEIS_ESTADO}, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _repoe_estado(copia):
+    """
+    Repõe o estado de p2 guardado por _copia_estado.
+
+    Args:
+    - copia (bytes): Variáveis de estado serializadas.
+
+    Returns:
+    - None
+    """
+    for nome, valor in pickle.loads(copia).items():
+        persistencia._repoe_variavel(nome, valor)
+    p2._descarta_resumo()
+
+
+def _inicia_processo():
+    """
+    Prepara um processo do conjunto, guardando o estado herdado do processo principal: um processo pode simular
+    vários cenários, e cada um deve partir desse estado.
+
+    Returns:
+    - None
+    """
+    global _estado_inicial
+    _estado_inicial = _copia_estado()
+
+
+def _simula_cenario(cenario):
+    """
+    Simula um cenário num processo do conjunto, sobre a cópia do estado herdada do processo principal, que é
+    reposta no fim.
+
+    Args:
+    - cenario (dict): Argumentos de simula.
+
+    Returns:
+    - dict: Série temporal do cenário.
+    """
+    try:
+        return simula(**cenario)
+    finally:
+        _repoe_estado(_estado_inicial)
+
+
+def simula_cenarios(cenarios, processos=1):
+    """
+    Simula um conjunto de cenários independentes, todos a partir do estado atual de p2, que no fim fica inalterado.
+
+    Cada cenário é um dicionário com os argumentos de simula: pode usar outra pasta de instantâneos, outro ficheiro
+    de ordens ou outro período (ver divide_periodo). Com mais de um processo, os cenários são repartidos por um
+    conjunto de processos criados por fork, que partilham sem cópia o estado do processo principal.
+
+    Args:
+    - cenarios (list): Cenários a simular.
+    - processos (int): Número máximo de processos a usar.
+
+    Returns:
+    - list: Série temporal de cada cenário, pela ordem dos cenários.
+    """
+    cenarios = list(cenarios)
+    if processos > 1 and len(cenarios) > 1:
+        contexto = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(min(processos, len(cenarios)), mp_context=contexto,
+                                 initializer=_inicia_processo) as executor:
+            return list(executor.map(_simula_cenario, cenarios))
+
+    copia = _copia_estado()
+    resultados = []
+    for cenario in cenarios:
+        try:
+            resultados.append(simula(**cenario))
+        finally:
+            _repoe_estado(copia)
+    return resultados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simula a abertura dos dias de um período histórico.')
+    parser.add_argument('pasta', help='pasta com os instantâneos do mercado, um ficheiro AAAA-MM-DD.txt por dia')
+    parser.add_argument('--ordens', help='ficheiro de ordens a carregar')
+    parser.add_argument('--instantaneo', help='instantâneo de persistencia.py com o estado inicial')
+    parser.add_argument('--inicio', help='primeiro dia, no formato AAAA-MM-DD')
+    parser.add_argument('--fim', help='último dia, no formato AAAA-MM-DD')
+    parser.add_argument('--partes', type=int, default=1, help='número de intervalos independentes do período')
+    parser.add_argument('--processos', type=int, default=1)
+    parser.add_argument('--json', help='ficheiro onde gravar as séries temporais, em vez de as mostrar')
+    args = parser.parse_args()
+    if args.instantaneo:
+        persistencia.recupera(args.instantaneo)
+    cenarios = [{'pasta': args.pasta, 'ficheiro_ordens': args.ordens, 'data_inicio': inicio, 'data_fim': fim}
+                for inicio, fim in divide_periodo(args.pasta, args.partes, args.inicio, args.fim)]
+    series = [{'datas': resultado['datas'], 'carteira_ids': resultado['carteira_ids'].tolist(),
+               'valores': resultado['valores'].tolist(), 'rejeitadas': resultado['rejeitadas']}
+              for resultado in simula_cenarios(cenarios, args.processos)]
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(series, file)
+    else:
+        print(json.dumps(series, indent=2))
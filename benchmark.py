@@ -0,0 +1,425 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import instrumentacao
+import p2
+import servidor
+
+
+def bench_inicia_dia(n_ordens=1_000_000, n_carteiras=1_000, dias=365, semente=42):
+    """
+    Agenda um grande número de ordens distribuídas ao longo de um ano e mede o tempo de abertura de todos os dias.
+
+    Args:
+    - n_ordens (int): Número de ordens a agendar.
+    - n_carteiras (int): Número de carteiras pelas quais as ordens são distribuídas.
+    - dias (int): Número de dias simulados.
+    - semente (int): Semente do gerador aleatório.
+
+    Returns:
+    - dict: Tempos, em segundos, do agendamento e da simulação completa dos dias.
+    """
+    rng = random.Random(semente)
+    p2.carrega_mercado('mercado.txt')
+    inicio = datetime.date(2023, 1, 1)
+    p2.inicia_dia(str(inicio))
+
+    carteira_ids = []
+    for i in range(n_carteiras):
+        cliente_id = p2.cria_cliente(str(i), 'Cliente %d' % i, '1980-01-01')
+        p2.movimenta_saldo(cliente_id, 1e12)
+        carteira_ids.append(p2.abre_carteira(cliente_id, 'Carteira %d' % i))
+
+    datas = [str(inicio + datetime.timedelta(days=d)) for d in range(1, dias + 1)]
+    t0 = time.perf_counter()
+    for _ in range(n_ordens):
+        p2.agenda_ordem(rng.choice(carteira_ids), 'COMPRA', 'CUR', 1, 100.0, rng.choice(datas))
+    t_agenda = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in range(dias):
+        p2.inicia_dia()
+    t_dias = time.perf_counter() - t0
+
+    return {'ordens': n_ordens, 'dias': dias, 'agenda_ordem_s': t_agenda, 'inicia_dia_s': t_dias}
+
+
+def gera_carteiras(n_clientes, n_carteiras, partilhadas=0.1, posicoes=3, semente=42, cliente_ids=None):
+    """
+    Cria clientes e carteiras sintéticos, com saldo e algumas posições em cada carteira.
+
+    Args:
+    - n_clientes (int): Número de clientes a criar.
+    - n_carteiras (int): Número de carteiras a abrir.
+    - partilhadas (float): Fração das carteiras com dois titulares.
+    - posicoes (int): Número de compras feitas em cada carteira.
+    - semente (int): Semente do gerador aleatório.
+    - cliente_ids (list): Clientes já existentes, a juntar aos criados, pelos quais as carteiras são distribuídas.
+
+    Returns:
+    - tuple: Listas com os identificadores dos clientes e das carteiras criados.
+    """
+    rng = random.Random(semente)
+    titulos = list(p2.mercado)
+    cliente_ids = list(cliente_ids or ())
+    for i in range(n_clientes):
+        cliente_id = p2.cria_cliente(str(i), 'Cliente %d' % i, '1980-01-01')
+        p2.movimenta_saldo(cliente_id, 1e9)
+        cliente_ids.append(cliente_id)
+    carteira_ids = []
+    for i in range(n_carteiras):
+        if rng.random() < partilhadas:
+            titulares = tuple(rng.sample(cliente_ids, 2))
+        else:
+            titulares = cliente_ids[i % len(cliente_ids)]
+        carteira_id = p2.abre_carteira(titulares, 'Carteira %d' % i)
+        for _ in range(posicoes):
+            p2.processa_operacao(carteira_id, 'COMPRA', rng.choice(titulos), rng.randint(1, 100))
+        carteira_ids.append(carteira_id)
+    return cliente_ids, carteira_ids
+
+
+def bench_posicao_clientes(n_clientes=1_000_000, n_carteiras=3_000_000):
+    """
+    Compara o cálculo da posição de todos os clientes, um a um com posicao_cliente e de uma só vez com posicao_clientes.
+
+    Args:
+    - n_clientes (int): Número de clientes.
+    - n_carteiras (int): Número de carteiras.
+
+    Returns:
+    - dict: Tempos, em segundos, de cada uma das formas de cálculo.
+    """
+    p2.carrega_mercado('mercado.txt')
+    cliente_ids, _ = gera_carteiras(n_clientes, n_carteiras)
+
+    t0 = time.perf_counter()
+    for cliente_id in cliente_ids:
+        p2.posicao_cliente(cliente_id)
+    t_ciclo = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    matriz = p2.matriz_posicoes(cliente_ids)
+    t_matriz = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    p2.posicao_clientes(matriz=matriz)
+    t_lote = time.perf_counter() - t0
+
+    return {'clientes': n_clientes, 'carteiras': n_carteiras, 'posicao_cliente_s': t_ciclo,
+            'matriz_posicoes_s': t_matriz, 'posicao_clientes_s': t_lote}
+
+
+def bench_memoria(n_clientes=5_000_000, n_carteiras=10_000_000):
+    """
+    Mede a memória ocupada pelos registos de clientes e carteiras, incluindo uma compra em cada carteira.
+
+    Args:
+    - n_clientes (int): Número de clientes.
+    - n_carteiras (int): Número de carteiras.
+
+    Returns:
+    - dict: Memória total e por registo, em bytes, dos clientes e das carteiras.
+    """
+    p2.carrega_mercado('mercado.txt')
+    tracemalloc.start()
+    try:
+        antes = tracemalloc.get_traced_memory()[0]
+        cliente_ids, _ = gera_carteiras(n_clientes, 0)
+        depois_clientes = tracemalloc.get_traced_memory()[0]
+        gera_carteiras(0, n_carteiras, posicoes=1, cliente_ids=cliente_ids)
+        depois_carteiras = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return {'clientes': n_clientes, 'carteiras': n_carteiras,
+            'memoria_clientes_bytes': depois_clientes - antes,
+            'bytes_por_cliente': (depois_clientes - antes) / n_clientes,
+            'memoria_carteiras_bytes': depois_carteiras - depois_clientes,
+            'bytes_por_carteira': (depois_carteiras - depois_clientes) / n_carteiras}
+
+
+def reinicia_estado():
+    """
+    Esvazia o estado do módulo p2, para que cada benchmark parta do zero dentro do mesmo processo.
+
+    Returns:
+    - None
+    """
+    for nome in p2.VARIAVEIS_ESTADO:
+        if nome in ('estado', 'OPERACOES'):
+            continue
+        valor = getattr(p2, nome)
+        if isinstance(valor, dict):
+            valor.clear()
+        else:
+            del valor[:]
+    p2.estado.update(cliente_id=1, carteira_id=1, ordem_id=1)
+    p2._descarta_resumo()
+
+
+def gera_mercado(nome_ficheiro, n_titulos, semente=42):
+    """
+    Escreve um ficheiro de mercado sintético, com colunas separadas por tabulações.
+
+    Args:
+    - nome_ficheiro (str): Nome do ficheiro a criar.
+    - n_titulos (int): Número de títulos.
+    - semente (int): Semente do gerador aleatório.
+
+    Returns:
+    - list: Nomes dos títulos gerados.
+    """
+    rng = random.Random(semente)
+    titulos = ['T%06d' % i for i in range(n_titulos)]
+    with open(nome_ficheiro, 'w') as file:
+        for i, nome_titulo in enumerate(titulos):
+            file.write('EMPRESA %d SGPS\t%s\t%.2f\n' % (i, nome_titulo, rng.uniform(1, 500)))
+    return titulos
+
+
+def gera_ordens(nome_ficheiro, carteira_ids, titulos, n_ordens, datas, semente=42):
+    """
+    Escreve um ficheiro de ordens sintético, no formato lido por carrega_ordens.
+
+    Args:
+    - nome_ficheiro (str): Nome do ficheiro a criar.
+    - carteira_ids (list): Carteiras pelas quais as ordens são distribuídas.
+    - titulos (list): Títulos negociados.
+    - n_ordens (int): Número de ordens.
+    - datas (list): Datas, no formato 'AAAA-MM-DD', pelas quais as ordens são distribuídas.
+    - semente (int): Semente do gerador aleatório.
+
+    Returns:
+    - None
+    """
+    rng = random.Random(semente)
+    with open(nome_ficheiro, 'w') as file:
+        for _ in range(n_ordens):
+            nome_titulo = rng.choice(titulos)
+            file.write('%d\t%s\t%d\t%.2f\t%s\n' % (rng.choice(carteira_ids), nome_titulo, rng.randint(1, 10),
+                                                      p2.preco_titulo(nome_titulo) * rng.uniform(0.9, 1.1),
+                                                      rng.choice(datas)))
+
+
+def _pico_memoria():
+    """
+    Devolve o pico de memória residente do processo até ao momento.
+
+    Returns:
+    - int: Pico de memória, em KiB.
+    """
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico // 1024 if sys.platform == 'darwin' else pico
+
+
+def _cronometra(resultados, nome, n, funcao):
+    """
+    Mede o tempo de execução de uma função que executa n operações e guarda o resultado.
+
+    Args:
+    - resultados (dict): Dicionário onde o resultado é guardado, com a chave nome.
+    - nome (str): Nome da operação medida.
+    - n (int): Número de operações executadas por funcao.
+    - funcao (callable): Função sem argumentos a medir.
+
+    Returns:
+    - None
+    """
+    t0 = time.perf_counter()
+    funcao()
+    total = time.perf_counter() - t0
+    resultados[nome] = {'n': n, 'total_s': total, 'por_operacao_us': total / n * 1e6 if n else 0.0,
+                        'pico_memoria_kib': _pico_memoria()}
+
+
+def bench_operacoes(escala=1_000, dias=30, partilhadas=0.1, semente=42):
+    """
+    Gera um mercado, clientes, carteiras (algumas partilhadas) e ordens sintéticos à escala indicada e mede o tempo
+    de cada operação pública de p2.
+
+    Args:
+    - escala (int): Número de clientes, de carteiras, de compras e de ordens agendadas e carregadas; o mercado tem
+      escala // 100 títulos, com um mínimo de 10.
+    - dias (int): Número de dias pelos quais as ordens são distribuídas e que são depois simulados.
+    - partilhadas (float): Fração das carteiras com dois titulares.
+    - semente (int): Semente do gerador aleatório.
+
+    Returns:
+    - dict: Para cada operação, o número de chamadas, o tempo total e por chamada e o pico de memória do processo.
+    """
+    rng = random.Random(semente)
+    reinicia_estado()
+    resultados = {}
+    n_titulos = max(10, escala // 100)
+    inicio = datetime.date(2023, 1, 1)
+    datas = [str(inicio + datetime.timedelta(days=d)) for d in range(1, dias + 1)]
+    with tempfile.TemporaryDirectory() as pasta:
+        nome_mercado = os.path.join(pasta, 'mercado.txt')
+        titulos = gera_mercado(nome_mercado, n_titulos, semente)
+        _cronometra(resultados, 'carrega_mercado', n_titulos, lambda: p2.carrega_mercado(nome_mercado))
+        reinicia_estado()
+        _cronometra(resultados, 'carrega_mercado_cache', n_titulos, lambda: p2.carrega_mercado(nome_mercado))
+        p2.inicia_dia(str(inicio))
+
+        cliente_ids = []
+        _cronometra(resultados, 'cria_cliente', escala, lambda: cliente_ids.extend(
+            p2.cria_cliente(str(i), 'Cliente %d' % i, '1980-01-01') for i in range(escala)))
+        for cliente_id in cliente_ids:
+            p2.movimenta_saldo(cliente_id, 1e12)
+
+        titulares = [tuple(rng.sample(cliente_ids, 2)) if rng.random() < partilhadas else cliente_ids[i]
+                     for i in range(escala)]
+        carteira_ids = []
+        _cronometra(resultados, 'abre_carteira', escala, lambda: carteira_ids.extend(
+            p2.abre_carteira(titulares[i], 'Carteira %d' % i) for i in range(escala)))
+
+        compras = [(rng.choice(carteira_ids), rng.choice(titulos), rng.randint(1, 100)) for _ in range(escala)]
+        _cronometra(resultados, 'processa_operacao', escala, lambda: [
+            p2.processa_operacao(carteira_id, 'COMPRA', nome_titulo, quantidade)
+            for carteira_id, nome_titulo, quantidade in compras])
+
+        agendadas = [(rng.choice(carteira_ids), rng.choice(titulos), rng.randint(1, 10), rng.choice(datas))
+                     for _ in range(escala)]
+        _cronometra(resultados, 'agenda_ordem', escala, lambda: [
+            p2.agenda_ordem(carteira_id, 'COMPRA', nome_titulo, quantidade,
+                            p2.preco_titulo(nome_titulo) * 1.05, data_str)
+            for carteira_id, nome_titulo, quantidade, data_str in agendadas])
+
+        nome_ordens = os.path.join(pasta, 'ordens.txt')
+        gera_ordens(nome_ordens, carteira_ids, titulos, escala, datas, semente)
+        _cronometra(resultados, 'carrega_ordens', escala, lambda: p2.carrega_ordens(nome_ordens))
+
+    _cronometra(resultados, 'inicia_dia', dias, lambda: [p2.inicia_dia() for _ in range(dias)])
+    _cronometra(resultados, 'posicao_cliente', escala, lambda: [
+        p2.posicao_cliente(cliente_id) for cliente_id in cliente_ids])
+    _cronometra(resultados, 'gera_resumo', escala, lambda: [
+        p2.gera_resumo(carteira_id) for carteira_id in carteira_ids])
+    return resultados
+
+
+def bench_servidor(n_ligacoes=1_000, pedidos=10):
+    """
+    Abre um grande número de ligações simultâneas a um servidor.Servidor local e mede a latência de cada pedido,
+    vista pelo cliente: cada ligação cria um cliente e alterna depósitos (escritas) e consultas da posição
+    (leituras).
+
+    Os clientes correm no mesmo processo e no mesmo ciclo de eventos que o servidor, pelo que a latência medida
+    inclui o tempo de espera pelo ciclo de eventos partilhado.
+
+    Args:
+    - n_ligacoes (int): Número de ligações simultâneas.
+    - pedidos (int): Número de pedidos feitos por cada ligação, além da criação do cliente.
+
+    Returns:
+    - dict: Número de pedidos, débito, latências (mediana, p99 e máxima) em milissegundos, número de lotes de
+      escrita e número médio de escritas por lote.
+    """
+    reinicia_estado()
+    latencias = []
+
+    async def sessao(porta, i):
+        ligacao = await servidor.Ligacao.abre(porta=porta)
+        try:
+            t0 = time.perf_counter()
+            cliente_id = await ligacao.chama('cria_cliente', str(i), 'Cliente %d' % i, '1980-01-01')
+            latencias.append(time.perf_counter() - t0)
+            for j in range(pedidos):
+                t0 = time.perf_counter()
+                if j % 2:
+                    await ligacao.chama('posicao_cliente', cliente_id)
+                else:
+                    await ligacao.chama('movimenta_saldo', cliente_id, 10)
+                latencias.append(time.perf_counter() - t0)
+        finally:
+            await ligacao.fecha()
+
+    async def executa():
+        servico = servidor.Servidor()
+        porta = await servico.inicia()
+        try:
+            t0 = time.perf_counter()
+            await asyncio.gather(*(sessao(porta, i) for i in range(n_ligacoes)))
+            return time.perf_counter() - t0, servico.lotes, servico.escritas
+        finally:
+            await servico.fecha()
+
+    total, lotes, escritas = asyncio.run(executa())
+    latencias.sort()
+    return {'ligacoes': n_ligacoes, 'pedidos': len(latencias), 'total_s': total,
+            'pedidos_por_s': len(latencias) / total,
+            'latencia_mediana_ms': latencias[len(latencias) // 2] * 1e3,
+            'latencia_p99_ms': latencias[int(0.99 * (len(latencias) - 1))] * 1e3,
+            'latencia_maxima_ms': latencias[-1] * 1e3,
+            'lotes': lotes, 'escritas_por_lote': escritas / lotes if lotes else 0.0}
+
+
+def _metadados():
+    """
+    Descreve o ambiente em que os benchmarks correm, para que resultados de versões diferentes possam ser comparados.
+
+    Returns:
+    - dict: Data, revisão git (se disponível), versão do Python e plataforma.
+    """
+    try:
+        revisao = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revisao = None
+    return {'data': datetime.datetime.now().isoformat(timespec='seconds'), 'revisao': revisao,
+            'python': platform.python_version(), 'plataforma': platform.platform()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks do módulo p2, com resultados em JSON.')
+    parser.add_argument('--ordens', type=int, default=1_000_000)
+    parser.add_argument('--carteiras', type=int, default=1_000)
+    parser.add_argument('--clientes', type=int, default=1_000_000)
+    parser.add_argument('--carteiras-clientes', type=int, default=3_000_000)
+    parser.add_argument('--escala', type=int, default=1_000, help='escala do benchmark operacoes (10**3 a 10**7)')
+    parser.add_argument('--ligacoes', type=int, default=1_000, help='ligações simultâneas do benchmark servidor')
+    parser.add_argument('--pedidos', type=int, default=10, help='pedidos por ligação do benchmark servidor')
+    parser.add_argument('--json', help='ficheiro onde gravar os resultados, em vez de os mostrar')
+    parser.add_argument('--metricas', help='recolhe métricas das operações e grava-as neste ficheiro (Prometheus)')
+    parser.add_argument('--perfil', choices=['cprofile', 'amostragem'], help='executa o benchmark sob um perfilador')
+    parser.add_argument('--perfil-ficheiro', help='ficheiro onde gravar o perfil')
+    parser.add_argument('bench', nargs='?', default='inicia_dia',
+                        choices=['inicia_dia', 'posicao_clientes', 'operacoes', 'memoria', 'servidor'])
+    args = parser.parse_args()
+    if args.bench == 'inicia_dia':
+        bench, bench_args = bench_inicia_dia, (args.ordens, args.carteiras)
+    elif args.bench == 'posicao_clientes':
+        bench, bench_args = bench_posicao_clientes, (args.clientes, args.carteiras_clientes)
+    elif args.bench == 'memoria':
+        bench, bench_args = bench_memoria, (args.clientes, args.carteiras_clientes)
+    elif args.bench == 'servidor':
+        bench, bench_args = bench_servidor, (args.ligacoes, args.pedidos)
+    else:
+        bench, bench_args = bench_operacoes, (args.escala,)
+    if args.metricas:
+        instrumentacao.ativa()
+    if args.perfil:
+        resultados, perfil = instrumentacao.perfila(bench, bench_args, args.perfil, args.perfil_ficheiro)
+        if args.perfil == 'cprofile' and not args.perfil_ficheiro:
+            perfil.sort_stats('cumulative').print_stats(25)
+    else:
+        resultados = bench(*bench_args)
+    if args.metricas:
+        instrumentacao.exporta(instrumentacao.ExportadorPrometheus(args.metricas))
+        instrumentacao.desativa()
+    relatorio = dict(_metadados(), benchmark=args.bench, resultados=resultados, pico_memoria_kib=_pico_memoria())
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(relatorio, file, indent=2)
+    else:
+        print(json.dumps(relatorio, indent=2))
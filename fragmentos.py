@@ -0,0 +1,1047 @@
+import heapq
+import itertools
+import multiprocessing
+
+import p2
+
+# Operações de p2 que o encaminhador pode pedir a um fragmento
+OPERACOES_P2 = ('cria_cliente', 'encerra_cliente', 'posicao_cliente', 'posicao_clientes', 'movimenta_saldo',
+                'abre_carteira', 'encerra_carteira', 'processa_operacao', 'agenda_ordem', 'gera_resumo',
+                'carrega_mercado', 'atualiza_precos', 'inicia_dia', 'preco_titulo', 'consulta_ordem', 'cancela_ordem',
+                'cancela_ordens', 'altera_ordem')
+
+# Estado próprio de cada processo fragmento
+_sombras = set()  # clientes locais que representam titulares de outros fragmentos em carteiras partilhadas
+_reservas = {}  # transação -> lista de (cliente_id, valor) dos movimentos preparados e ainda não decididos
+
+
+def _dados_cliente(cliente_id):
+    """
+    Devolve os dados de identificação de um cliente do fragmento.
+
+    Args:
+    - cliente_id (int): Identificador local do cliente.
+
+    Returns:
+    - tuple: NIF, nome e data de nascimento do cliente.
+    """
+    cliente = p2.clientes[cliente_id]
+    return cliente.nif, cliente.nome, cliente.data_nasc
+
+
+def _cria_sombra(nif, nome, data_nasc):
+    """
+    Cria no fragmento um cliente sombra, que representa o titular de outro fragmento numa carteira partilhada.
+
+    Args:
+    - nif (str): NIF do titular.
+    - nome (str): Nome do titular.
+    - data_nasc (str): Data de nascimento do titular.
+
+    Returns:
+    - int: Identificador local da sombra.
+    """
+    cliente_id = p2.cria_cliente(nif, nome, data_nasc)
+    _sombras.add(cliente_id)
+    return cliente_id
+
+
+def _prepara_carteira(carteira_id, operacao, nome_titulo=None, quantidade=None):
+    """
+    Primeira fase de uma operação numa carteira partilhada, no fragmento da carteira: verifica se a operação pode ser
+    realizada e calcula a parte de cada titular, sem alterar o estado.
+
+    Args:
+    - carteira_id (int): Identificador local da carteira.
+    - operacao (str): 'COMPRA', 'VENDA' ou 'FECHO'.
+    - nome_titulo (str): Nome do título transacionado.
+    - quantidade (int): Número de unidades do título.
+
+    Raises:
+    - ValueError: Se a operação não puder ser realizada.
+
+    Returns:
+    - tuple: A quantidade efetivamente transacionada e a lista das partes do valor, em unidades monetárias, pela
+      ordem dos titulares.
+    """
+    if carteira_id not in p2.carteiras:
+        raise ValueError('carteira inexistente')
+    carteira = p2.carteiras[carteira_id]
+    titulares = p2._titulares(carteira_id)
+    if operacao == 'FECHO':
+        valor = p2._valor_posicoes(carteira.titulos.items())
+    elif operacao == 'COMPRA':
+        valor = p2.mercado_precos[p2.id_titulo(nome_titulo)] * quantidade
+    elif operacao == 'VENDA':
+        detida = carteira.titulos.get(nome_titulo)
+        if not detida:
+            raise ValueError('titulo inexistente em carteira')
+        quantidade = min(quantidade, detida)
+        valor = p2.mercado_precos[p2.id_titulo(nome_titulo)] * quantidade
+    else:
+        raise ValueError('operacao desconhecida')
+    partes = p2._divide_valor(valor, len(titulares))
+    if operacao == 'COMPRA' and any(p2.saldos[titular_id] < parte for titular_id, parte in zip(titulares, partes)
+                                    if titular_id not in _sombras):
+        raise ValueError('fundos insuficientes')
+    return quantidade, partes
+
+
+def _prepara_movimento(transacao, cliente_id, valor):
+    """
+    Primeira fase de uma operação numa carteira partilhada, no fragmento de um titular: um débito é logo retirado
+    do saldo, para que os fundos não possam ser usados até à decisão; um crédito só é aplicado na confirmação.
+
+    Args:
+    - transacao (int): Identificador da transação.
+    - cliente_id (int): Identificador local do titular.
+    - valor (int): Movimento do saldo, em unidades monetárias, negativo num débito.
+
+    Raises:
+    - ValueError: Se o cliente não existir ou não tiver fundos suficientes.
+
+    Returns:
+    - None
+    """
+    if cliente_id not in p2.clientes:
+        raise ValueError('cliente inexistente')
+    if valor < 0:
+        if p2.saldos[cliente_id] < -valor:
+            raise ValueError('fundos insuficientes')
+        p2.saldos[cliente_id] += valor
+    _reservas.setdefault(transacao, []).append((cliente_id, valor))
+
+
+def _confirma(transacao):
+    """
+    Segunda fase de uma transação confirmada: aplica os créditos preparados.
+
+    Args:
+    - transacao (int): Identificador da transação.
+
+    Returns:
+    - None
+    """
+    for cliente_id, valor in _reservas.pop(transacao, ()):
+        if valor > 0:
+            p2.saldos[cliente_id] += valor
+
+
+def _aborta(transacao):
+    """
+    Segunda fase de uma transação abortada: devolve os débitos preparados.
+
+    Args:
+    - transacao (int): Identificador da transação.
+
+    Returns:
+    - None
+    """
+    for cliente_id, valor in _reservas.pop(transacao, ()):
+        if valor < 0:
+            p2.saldos[cliente_id] -= valor
+
+
+def _executa_carteira(carteira_id, operacao, nome_titulo, quantidade, partes):
+    """
+    Segunda fase de uma operação numa carteira partilhada, no fragmento da carteira: executa a operação com as
+    sombras dos titulares remotos, cujos fundos já foram movimentados nos respetivos fragmentos.
+
+    Numa compra, cada sombra recebe antes a sua parte, que a operação volta a debitar; numa venda ou no fecho, a
+    parte creditada a cada sombra é retirada no fim. Fora desta função, o saldo das sombras é sempre zero.
+
+    Args:
+    - carteira_id (int): Identificador local da carteira.
+    - operacao (str): 'COMPRA', 'VENDA' ou 'FECHO'.
+    - nome_titulo (str): Nome do título transacionado.
+    - quantidade (int): Número de unidades do título.
+    - partes (list): Partes do valor, tal como calculadas por _prepara_carteira.
+
+    Returns:
+    - float: O valor total da operação.
+    """
+    titulares = p2._titulares(carteira_id)
+    if operacao == 'COMPRA':
+        for titular_id, parte in zip(titulares, partes):
+            if titular_id in _sombras:
+                p2.saldos[titular_id] = parte
+    try:
+        if operacao == 'FECHO':
+            return p2.encerra_carteira(carteira_id)
+        return p2.processa_operacao(carteira_id, operacao, nome_titulo, quantidade)
+    finally:
+        for titular_id in titulares:
+            if titular_id in _sombras:
+                p2.saldos[titular_id] = 0
+
+
+def _ativos():
+    """
+    Soma o saldo e o valor dos títulos de todos os clientes do fragmento, incluindo as sombras.
+
+    Returns:
+    - int: Total dos ativos, em unidades monetárias.
+    """
+    return sum(p2.saldos[cliente_id] + p2.valores_titulos[cliente_id] for cliente_id in p2.clientes)
+
+
+def _cruzam(ordens):
+    """
+    Indica, para cada ordem, se a cotação atual permite executá-la (ver p2._cruza_limite).
+
+    Args:
+    - ordens (list): Ordens no formato guardado no livro de ordens.
+
+    Returns:
+    - list: Um valor booleano por ordem.
+    """
+    return [p2._cruza_limite(ordem) for ordem in ordens]
+
+
+def _precos(nomes_titulos):
+    """
+    Devolve a cotação atual de cada um dos títulos indicados.
+
+    Args:
+    - nomes_titulos (list): Nomes dos títulos.
+
+    Returns:
+    - list: A cotação de cada título, em euros, ou None se o título não estiver cotado.
+    """
+    return [p2.mercado_precos[p2.mercado[nome_titulo]] / p2.ESCALA_MONETARIA if nome_titulo in p2.mercado else None
+            for nome_titulo in nomes_titulos]
+
+
+def _hoje():
+    """
+    Devolve a data atual do fragmento.
+
+    Returns:
+    - str: A data atual, no formato 'AAAA-MM-DD'.
+    """
+    return str(p2.estado['hoje'])
+
+
+def _reserva_ordem_ids(quantidade):
+    """
+    Reserva um bloco de identificadores de ordens consecutivos, para ordens guardadas no encaminhador.
+
+    Args:
+    - quantidade (int): Número de identificadores a reservar.
+
+    Returns:
+    - int: O primeiro identificador reservado.
+    """
+    ordem_id = p2.estado['ordem_id']
+    p2.estado['ordem_id'] += quantidade
+    return ordem_id
+
+
+def _carrega_linhas(linhas):
+    """
+    Carrega linhas de um ficheiro de ordens, já com os identificadores locais das carteiras (ver p2.carrega_ordens).
+
+    Args:
+    - linhas (list): Linhas a carregar.
+
+    Returns:
+    - list: Tuplos (indice, motivo) das linhas rejeitadas, com o índice de cada linha na lista.
+    """
+    rejeitadas = []
+    p2._carrega_bloco_ordens(linhas, 0, rejeitadas)
+    return rejeitadas
+
+
+def _valida_ordens(linhas):
+    """
+    Valida, sem as agendar, linhas de um ficheiro de ordens com os identificadores locais das carteiras (ver
+    p2._valida_bloco_ordens).
+
+    Args:
+    - linhas (list): Linhas a validar.
+
+    Returns:
+    - tuple: Ordens válidas para dias futuros, tuplos (indice, ordem) das ordens válidas para o dia atual e tuplos
+      (indice, motivo) das linhas rejeitadas, com o índice de cada linha na lista.
+    """
+    rejeitadas = []
+    futuras, do_dia = p2._valida_bloco_ordens(linhas, 0, rejeitadas)
+    return futuras, do_dia, rejeitadas
+
+
+_OPERACOES_INTERNAS = {funcao.__name__: funcao for funcao in (
+    _dados_cliente, _cria_sombra, _prepara_carteira, _prepara_movimento, _confirma, _aborta, _executa_carteira,
+    _ativos, _cruzam, _precos, _hoje, _reserva_ordem_ids, _carrega_linhas, _valida_ordens, p2._nova_ordem_id)}
+
+
+def _atende(ligacao):
+    """
+    Ciclo de um processo fragmento: executa os pedidos (op, args) recebidos do encaminhador, pela ordem de chegada,
+    e responde a cada um com ('resultado', valor) ou ('erro', exceção). Termina com o pedido (None, None).
+
+    Args:
+    - ligacao (multiprocessing.connection.Connection): Ligação ao encaminhador.
+
+    Returns:
+    - None
+    """
+    while True:
+        try:
+            op, args = ligacao.recv()
+        except EOFError:
+            return
+        if op is None:
+            return
+        try:
+            if op in _OPERACOES_INTERNAS:
+                funcao = _OPERACOES_INTERNAS[op]
+            elif op in OPERACOES_P2:
+                funcao = getattr(p2, op)
+            else:
+                raise ValueError('operacao desconhecida')
+            resposta = ('resultado', funcao(*args))
+        except Exception as erro:
+            resposta = ('erro', erro)
+        ligacao.send(resposta)
+
+
+class Encaminhador:
+    """
+    Reparte os clientes e as carteiras de p2 por vários processos fragmento, na mesma máquina, e encaminha cada
+    operação para o fragmento certo.
+
+    O cliente ou a carteira com o identificador global g fica no fragmento g % n, com o identificador local g // n.
+    Os clientes são criados alternadamente em cada fragmento e uma carteira fica no fragmento do seu primeiro
+    titular. Os restantes titulares de uma carteira partilhada que estejam noutros fragmentos são representados no
+    fragmento da carteira por sombras, sem saldo próprio, e as compras, vendas e fecho destas carteiras são feitos
+    por confirmação em duas fases: o fragmento da carteira valida a operação e calcula as partes de cada titular,
+    os fragmentos dos titulares remotos reservam os seus movimentos e, se todos aceitarem, o fragmento da carteira
+    executa a operação e só então a transação é confirmada nos restantes; se algum recusar, as reservas são
+    devolvidas. As operações do encaminhador são feitas uma de cada vez, pelo que o estado dos fragmentos não muda
+    entre as duas fases.
+
+    As ordens agendadas para carteiras partilhadas ficam no encaminhador, que as executa na abertura do dia e após
+    cada atualização das cotações, com as regras de preço limite de p2: as ordens a aguardar ficam, como em p2, num
+    heap por título e lado do livro, pelo que uma nova cotação só percorre as ordens que atinge. Tal como os
+    clientes e as carteiras, cada ordem tem um identificador global, do fragmento da sua carteira. As consultas
+    que abrangem todos os clientes são pedidas a todos os fragmentos em simultâneo e os resultados juntos no fim.
+    """
+
+    def __init__(self, n_fragmentos):
+        contexto = multiprocessing.get_context('spawn')
+        self.n = n_fragmentos
+        self.ligacoes = []
+        self.processos = []
+        for _ in range(n_fragmentos):
+            ligacao, ligacao_fragmento = contexto.Pipe()
+            processo = contexto.Process(target=_atende, args=(ligacao_fragmento,), daemon=True)
+            processo.start()
+            ligacao_fragmento.close()
+            self.ligacoes.append(ligacao)
+            self.processos.append(processo)
+        self.proximo_fragmento = 0
+        self.sombras = {}  # (fragmento, cliente_id global) -> identificador local da sombra nesse fragmento
+        self.reais = {}  # (fragmento, identificador local da sombra) -> cliente_id global
+        self.partilhadas = {}  # carteira_id global -> titulares globais, das carteiras com titulares noutros fragmentos
+        self.transacao = 0
+        # Ordens de carteiras partilhadas, indexadas pelo identificador global da ordem
+        self.ordens = {}  # data 'AAAA-MM-DD' -> {ordem_id: ordem} agendadas para esse dia
+        self.agendadas = {}  # ordem_id -> ordem agendada
+        self.limites = {}  # ordem_id -> ordem a aguardar o preço limite
+        # nome do título -> {'COMPRA': heap, 'VENDA': heap} das ordens a aguardar: (chave do limite, chegada, ordem_id)
+        self.livro = {}
+        self.chegadas = {}  # ordem_id -> número de chegada da ordem a aguardar, que decide a ordem de execução
+        self.contador_chegadas = itertools.count()
+        self.obsoletas = {}  # nome do título -> {'COMPRA': n, 'VENDA': n} entradas do livro sem ordem em vigor
+        self.hoje = self._chama(0, '_hoje')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.fecha()
+
+    def fecha(self):
+        """
+        Termina os processos fragmento.
+
+        Returns:
+        - None
+        """
+        for ligacao in self.ligacoes:
+            try:
+                ligacao.send((None, None))
+            except OSError:
+                pass
+            ligacao.close()
+        for processo in self.processos:
+            processo.join()
+
+    def _chama_todos(self, pedidos):
+        """
+        Envia um conjunto de pedidos aos fragmentos e só depois espera pelas respostas, para que os fragmentos os
+        executem em simultâneo.
+
+        Args:
+        - pedidos (list): Tuplos (fragmento, op, args).
+
+        Raises:
+        - Exception: A exceção do primeiro pedido que falhou, depois de recebidas todas as respostas.
+
+        Returns:
+        - list: O resultado de cada pedido.
+        """
+        for fragmento, op, args in pedidos:
+            self.ligacoes[fragmento].send((op, args))
+        respostas = [self.ligacoes[fragmento].recv() for fragmento, _, _ in pedidos]
+        for tipo, valor in respostas:
+            if tipo == 'erro':
+                raise valor
+        return [valor for _, valor in respostas]
+
+    def _chama(self, fragmento, op, *args):
+        """
+        Faz um pedido a um fragmento e espera pela resposta.
+
+        Returns:
+        - O resultado do pedido.
+        """
+        return self._chama_todos([(fragmento, op, args)])[0]
+
+    def _difunde(self, op, *args):
+        """
+        Faz o mesmo pedido a todos os fragmentos, em simultâneo.
+
+        Returns:
+        - list: O resultado de cada fragmento.
+        """
+        return self._chama_todos([(fragmento, op, args) for fragmento in range(self.n)])
+
+    def _global(self, fragmento, local_id):
+        return local_id * self.n + fragmento
+
+    def _local(self, global_id):
+        return global_id % self.n, global_id // self.n
+
+    def _local_cliente(self, cliente_id):
+        """
+        Traduz o identificador global de um cliente, recusando os identificadores das sombras.
+
+        Args:
+        - cliente_id (int): Identificador global do cliente.
+
+        Raises:
+        - ValueError: Se o identificador for o de uma sombra.
+
+        Returns:
+        - tuple: Fragmento e identificador local do cliente.
+        """
+        local = self._local(cliente_id)
+        if local in self.reais:
+            raise ValueError('cliente inexistente')
+        return local
+
+    def cria_cliente(self, nif, nome, data_nasc):
+        """
+        Cria um cliente no próximo fragmento, alternadamente (ver p2.cria_cliente).
+
+        Returns:
+        - int: Identificador global do cliente criado.
+        """
+        fragmento = self.proximo_fragmento
+        self.proximo_fragmento = (fragmento + 1) % self.n
+        return self._global(fragmento, self._chama(fragmento, 'cria_cliente', nif, nome, data_nasc))
+
+    def encerra_cliente(self, cliente_id):
+        """
+        Encerra um cliente no seu fragmento (ver p2.encerra_cliente).
+
+        Raises:
+        - ValueError: Se o cliente for titular de carteiras partilhadas.
+
+        Returns:
+        - float: Valor a entregar ao cliente.
+        """
+        if any(cliente_id in titulares for titulares in self.partilhadas.values()):
+            raise ValueError('cliente tem carteiras partilhadas')
+        fragmento, local_id = self._local_cliente(cliente_id)
+        return self._chama(fragmento, 'encerra_cliente', local_id)
+
+    def movimenta_saldo(self, cliente_id, valor):
+        """
+        Movimenta o saldo de um cliente no seu fragmento (ver p2.movimenta_saldo).
+
+        Returns:
+        - float: O valor movimentado.
+        """
+        fragmento, local_id = self._local_cliente(cliente_id)
+        return self._chama(fragmento, 'movimenta_saldo', local_id, valor)
+
+    def posicao_cliente(self, cliente_id):
+        """
+        Calcula a posição de um cliente, juntando à do seu fragmento a das suas sombras noutros fragmentos.
+
+        Args:
+        - cliente_id (int): Identificador global do cliente.
+
+        Returns:
+        - float: O saldo mais o valor atual de todas as carteiras do cliente.
+        """
+        fragmento, local_id = self._local_cliente(cliente_id)
+        pedidos = [(fragmento, 'posicao_cliente', (local_id,))]
+        pedidos += [(fragmento_sombra, 'posicao_cliente', (sombra_id,))
+                    for (fragmento_sombra, titular_id), sombra_id in self.sombras.items() if titular_id == cliente_id]
+        return sum(self._chama_todos(pedidos))
+
+    def posicao_clientes(self, cliente_ids=None):
+        """
+        Calcula a posição de todos os clientes, pedindo-a a todos os fragmentos em simultâneo.
+
+        Args:
+        - cliente_ids (iterable): Identificadores globais dos clientes. Por omissão, todos os clientes.
+
+        Returns:
+        - dict: Posição de cada cliente, por identificador global.
+        """
+        posicoes = {}
+        for fragmento, posicoes_fragmento in enumerate(self._difunde('posicao_clientes')):
+            for local_id, posicao in posicoes_fragmento.items():
+                cliente_id = self.reais.get((fragmento, local_id))
+                if cliente_id is None:
+                    cliente_id = self._global(fragmento, local_id)
+                posicoes[cliente_id] = posicoes.get(cliente_id, 0) + posicao
+        if cliente_ids is not None:
+            posicoes = {cliente_id: posicoes.get(cliente_id, 0) for cliente_id in cliente_ids}
+        return posicoes
+
+    def total_ativos(self):
+        """
+        Calcula o total dos ativos sob gestão: a soma, exata, dos saldos e do valor dos títulos de todos os clientes.
+
+        Returns:
+        - float: Total dos ativos, em euros.
+        """
+        return sum(self._difunde('_ativos')) / p2.ESCALA_MONETARIA
+
+    def _sombra(self, fragmento, cliente_id):
+        """
+        Devolve a sombra de um cliente num fragmento, criando-a se ainda não existir.
+
+        Args:
+        - fragmento (int): Fragmento onde a sombra é necessária.
+        - cliente_id (int): Identificador global do cliente.
+
+        Returns:
+        - int: Identificador local da sombra.
+        """
+        if (fragmento, cliente_id) not in self.sombras:
+            titular_fragmento, local_id = self._local_cliente(cliente_id)
+            dados = self._chama(titular_fragmento, '_dados_cliente', local_id)
+            sombra_id = self._chama(fragmento, '_cria_sombra', *dados)
+            self.sombras[(fragmento, cliente_id)] = sombra_id
+            self.reais[(fragmento, sombra_id)] = cliente_id
+        return self.sombras[(fragmento, cliente_id)]
+
+    def abre_carteira(self, titulares_id, designacao):
+        """
+        Abre uma carteira no fragmento do primeiro titular, criando as sombras dos titulares de outros fragmentos
+        (ver p2.abre_carteira).
+
+        Returns:
+        - int: Identificador global da carteira aberta.
+        """
+        if titulares_id is None:
+            raise ValueError("titulares_id não pode ser None")
+        titulares = (titulares_id,) if isinstance(titulares_id, int) else tuple(titulares_id)
+        fragmento = self._local_cliente(titulares[0])[0]
+        locais = []
+        for titular_id in titulares:
+            titular_fragmento, local_id = self._local_cliente(titular_id)
+            locais.append(local_id if titular_fragmento == fragmento else self._sombra(fragmento, titular_id))
+        locais = locais[0] if isinstance(titulares_id, int) else tuple(locais)
+        carteira_id = self._global(fragmento, self._chama(fragmento, 'abre_carteira', locais, designacao))
+        if any(self._local(titular_id)[0] != fragmento for titular_id in titulares):
+            self.partilhadas[carteira_id] = titulares
+        return carteira_id
+
+    def _transacao(self, carteira_id, operacao, nome_titulo=None, quantidade=None):
+        """
+        Executa uma operação numa carteira partilhada entre fragmentos, por confirmação em duas fases.
+
+        Args:
+        - carteira_id (int): Identificador global da carteira.
+        - operacao (str): 'COMPRA', 'VENDA' ou 'FECHO'.
+        - nome_titulo (str): Nome do título transacionado.
+        - quantidade (int): Número de unidades do título.
+
+        Raises:
+        - ValueError: Se algum dos fragmentos recusar a operação; nesse caso, nenhum estado é alterado.
+
+        Returns:
+        - float: O valor total da operação.
+        """
+        fragmento, local_id = self._local(carteira_id)
+        quantidade, partes = self._chama(fragmento, '_prepara_carteira', local_id, operacao, nome_titulo, quantidade)
+        self.transacao += 1
+        sinal = -1 if operacao == 'COMPRA' else 1
+        pedidos = [(self._local(titular_id)[0], '_prepara_movimento', (self.transacao, self._local(titular_id)[1],
+                                                                       sinal * parte))
+                   for titular_id, parte in zip(self.partilhadas[carteira_id], partes)
+                   if self._local(titular_id)[0] != fragmento]
+        participantes = sorted({titular_fragmento for titular_fragmento, _, _ in pedidos})
+        # Os créditos dos titulares remotos só são aplicados depois de a operação ser executada no fragmento da
+        # carteira; se esta falhar, as reservas são devolvidas como numa recusa
+        try:
+            self._chama_todos(pedidos)
+            valor = self._chama(fragmento, '_executa_carteira', local_id, operacao, nome_titulo, quantidade, partes)
+        except Exception:
+            self._chama_todos([(participante, '_aborta', (self.transacao,)) for participante in participantes])
+            raise
+        self._chama_todos([(participante, '_confirma', (self.transacao,)) for participante in participantes])
+        return valor
+
+    def encerra_carteira(self, carteira_id):
+        """
+        Encerra uma carteira (ver p2.encerra_carteira), por confirmação em duas fases se for partilhada.
+
+        Returns:
+        - float: O valor total obtido com a venda dos títulos.
+        """
+        if carteira_id not in self.partilhadas:
+            fragmento, local_id = self._local(carteira_id)
+            return self._chama(fragmento, 'encerra_carteira', local_id)
+        self.cancela_ordens(carteira_id)
+        valor = self._transacao(carteira_id, 'FECHO')
+        del self.partilhadas[carteira_id]
+        return valor
+
+    def processa_operacao(self, carteira_id, operacao, nome_titulo, quantidade):
+        """
+        Realiza uma operação numa carteira (ver p2.processa_operacao), por confirmação em duas fases se for partilhada.
+
+        Returns:
+        - float: O valor total da operação.
+        """
+        if carteira_id in self.partilhadas and operacao in ('COMPRA', 'VENDA'):
+            return self._transacao(carteira_id, operacao, nome_titulo, quantidade)
+        fragmento, local_id = self._local(carteira_id)
+        return self._chama(fragmento, 'processa_operacao', local_id, operacao, nome_titulo, quantidade)
+
+    def agenda_ordem(self, carteira_id, operacao, nome_titulo, quantidade, preco_limite, data_str):
+        """
+        Agenda uma ordem (ver p2.agenda_ordem). As ordens de carteiras partilhadas ficam no encaminhador.
+
+        Returns:
+        - int: Identificador global da ordem, ou False se a operação não puder ser realizada ou a ordem agendada.
+        """
+        fragmento, local_id = self._local(carteira_id)
+        if carteira_id not in self.partilhadas:
+            ordem_id = self._chama(fragmento, 'agenda_ordem', local_id, operacao, nome_titulo, quantidade,
+                                   preco_limite, data_str)
+            return False if ordem_id is False else self._global(fragmento, ordem_id)
+        ordem = (carteira_id, operacao, nome_titulo, quantidade, preco_limite, data_str or self.hoje)
+        if data_str and data_str < self.hoje:
+            return False
+        # O identificador é atribuído pelo fragmento da carteira, para não colidir com os das suas próprias ordens
+        ordem_id = self._global(fragmento, self._chama(fragmento, '_nova_ordem_id'))
+        if not data_str or data_str == self.hoje:
+            if not self._chama(0, '_cruzam', [ordem])[0]:
+                self._aguarda(ordem_id, ordem)
+                return ordem_id
+            try:
+                self._transacao(carteira_id, operacao, nome_titulo, quantidade)
+            except ValueError:
+                return False
+            return ordem_id
+        self.ordens.setdefault(data_str, {})[ordem_id] = self.agendadas[ordem_id] = ordem
+        return ordem_id
+
+    def _ordem_global(self, fragmento, ordem):
+        """
+        Traduz o identificador da carteira de uma ordem devolvida por um fragmento.
+
+        Returns:
+        - tuple: A ordem, com o identificador global da carteira, ou None.
+        """
+        if ordem is None:
+            return None
+        return (self._global(fragmento, ordem[0]),) + tuple(ordem[1:])
+
+    def consulta_ordem(self, ordem_id):
+        """
+        Devolve uma ordem agendada ou a aguardar o preço limite (ver p2.consulta_ordem).
+
+        Returns:
+        - tuple: A ordem, com o identificador global da carteira, ou None se já foi executada ou cancelada.
+        """
+        if ordem_id in self.agendadas or ordem_id in self.limites:
+            return self.agendadas.get(ordem_id) or self.limites[ordem_id]
+        fragmento, local_id = self._local(ordem_id)
+        return self._ordem_global(fragmento, self._chama(fragmento, 'consulta_ordem', local_id))
+
+    def cancela_ordem(self, ordem_id):
+        """
+        Cancela uma ordem agendada ou a aguardar o preço limite (ver p2.cancela_ordem).
+
+        Returns:
+        - tuple: A ordem cancelada, ou None se já foi executada ou cancelada.
+        """
+        if ordem_id in self.agendadas:
+            ordem = self.agendadas.pop(ordem_id)
+            ordens_dia = self.ordens[ordem[5]]
+            del ordens_dia[ordem_id]
+            if not ordens_dia:
+                del self.ordens[ordem[5]]
+            return ordem
+        if ordem_id in self.limites:
+            return self._retira_limite(ordem_id)
+        fragmento, local_id = self._local(ordem_id)
+        return self._ordem_global(fragmento, self._chama(fragmento, 'cancela_ordem', local_id))
+
+    def cancela_ordens(self, carteira_id=None, nome_titulo=None):
+        """
+        Cancela as ordens de uma carteira, de um título ou de ambos (ver p2.cancela_ordens). As de um título são
+        canceladas em todos os fragmentos em simultâneo.
+
+        Returns:
+        - list: Identificadores globais das ordens canceladas.
+        """
+        if carteira_id is None and nome_titulo is None:
+            return []
+        proprias = [ordem_id for ordem_id, ordem in list(self.agendadas.items()) + list(self.limites.items())
+                    if (carteira_id is None or ordem[0] == carteira_id)
+                    and (nome_titulo is None or ordem[2] == nome_titulo)]
+        for ordem_id in proprias:
+            self.cancela_ordem(ordem_id)
+        if carteira_id is not None:
+            fragmento, local_id = self._local(carteira_id)
+            canceladas = {fragmento: self._chama(fragmento, 'cancela_ordens', local_id, nome_titulo)}
+        else:
+            canceladas = dict(enumerate(self._difunde('cancela_ordens', None, nome_titulo)))
+        return sorted(proprias + [self._global(fragmento, ordem_id) for fragmento, ordem_ids in canceladas.items()
+                                  for ordem_id in ordem_ids])
+
+    def altera_ordem(self, ordem_id, quantidade=None, preco_limite=None):
+        """
+        Altera a quantidade ou o preço limite de uma ordem, mantendo o seu identificador (ver p2.altera_ordem).
+
+        Returns:
+        - bool: Valor booleano que indica se a ordem foi alterada.
+        """
+        ordem = self.agendadas.get(ordem_id) or self.limites.get(ordem_id)
+        if ordem is None:
+            fragmento, local_id = self._local(ordem_id)
+            return self._chama(fragmento, 'altera_ordem', local_id, quantidade, preco_limite)
+        if quantidade is not None and quantidade <= 0:
+            return False
+        nova = (ordem[0], ordem[1], ordem[2], ordem[3] if quantidade is None else quantidade,
+                ordem[4] if preco_limite is None else preco_limite, ordem[5])
+        if ordem_id in self.agendadas:
+            self.ordens[ordem[5]][ordem_id] = self.agendadas[ordem_id] = nova
+            return True
+        self.limites[ordem_id] = nova
+        if p2._chave_limite(nova) != p2._chave_limite(ordem):
+            if self._chama(0, '_cruzam', [nova])[0]:
+                self._retira_limite(ordem_id)
+                self._executa_partilhadas([nova])
+            else:
+                # A entrada com o limite anterior fica no heap, obsoleta (ver _marca_obsoleta)
+                self._aguarda(ordem_id, nova)
+                self._marca_obsoleta(nova[2], nova[1])
+        return True
+
+    def _aguarda(self, ordem_id, ordem):
+        """
+        Coloca uma ordem de uma carteira partilhada a aguardar que a cotação atinja o seu preço limite, no heap do
+        seu título e lado do livro (ver p2._coloca_no_livro_limites). Uma ordem que já aguardava mantém a sua vez.
+
+        Args:
+        - ordem_id (int): Identificador global da ordem.
+        - ordem (tuple): Ordem no formato guardado no livro de ordens, com identificadores globais.
+
+        Returns:
+        - None
+        """
+        if ordem_id not in self.chegadas:
+            self.chegadas[ordem_id] = next(self.contador_chegadas)
+        self.limites[ordem_id] = ordem
+        livro = self.livro.setdefault(ordem[2], {'COMPRA': [], 'VENDA': []})
+        heapq.heappush(livro[ordem[1]], (p2._chave_limite(ordem), self.chegadas[ordem_id], ordem_id))
+
+    def _em_vigor(self, entrada):
+        """
+        Indica se uma entrada de um heap do livro corresponde a uma ordem a aguardar, com esse limite.
+
+        Args:
+        - entrada (tuple): Entrada (chave do limite, chegada, ordem_id) do heap.
+
+        Returns:
+        - bool: False se a ordem já foi executada ou cancelada ou se o seu limite foi alterado.
+        """
+        ordem = self.limites.get(entrada[2])
+        return ordem is not None and p2._chave_limite(ordem) == entrada[0]
+
+    def _retira_limite(self, ordem_id):
+        """
+        Retira uma ordem a aguardar o preço limite. A sua entrada no heap fica obsoleta (ver _marca_obsoleta).
+
+        Args:
+        - ordem_id (int): Identificador global da ordem.
+
+        Returns:
+        - tuple: A ordem retirada.
+        """
+        ordem = self.limites.pop(ordem_id)
+        del self.chegadas[ordem_id]
+        self._marca_obsoleta(ordem[2], ordem[1])
+        return ordem
+
+    def _marca_obsoleta(self, nome_titulo, operacao):
+        """
+        Conta uma entrada obsoleta num heap do livro e reconstrói o heap apenas com as entradas em vigor quando as
+        obsoletas passam a ser mais, tal como p2._marca_obsoleta.
+
+        Args:
+        - nome_titulo (str): Nome do título.
+        - operacao (str): Lado do livro, 'COMPRA' ou 'VENDA'.
+
+        Returns:
+        - None
+        """
+        obsoletas = self.obsoletas.setdefault(nome_titulo, {'COMPRA': 0, 'VENDA': 0})
+        obsoletas[operacao] += 1
+        heap = self.livro[nome_titulo][operacao]
+        if 2 * obsoletas[operacao] > len(heap):
+            heap[:] = set(filter(self._em_vigor, heap))
+            heapq.heapify(heap)
+            obsoletas[operacao] = 0
+
+    def _executa_partilhadas(self, ordens):
+        """
+        Executa, pela ordem dada, ordens de carteiras partilhadas, descartando as que não podem ser realizadas.
+
+        Args:
+        - ordens (list): Ordens no formato guardado no livro de ordens, com identificadores globais.
+
+        Returns:
+        - set: Identificadores globais das carteiras das ordens executadas.
+        """
+        executadas = set()
+        for carteira_id, operacao, nome_titulo, quantidade, _, _ in ordens:
+            if carteira_id not in self.partilhadas:
+                continue
+            try:
+                self._transacao(carteira_id, operacao, nome_titulo, quantidade)
+            except ValueError:
+                continue
+            executadas.add(carteira_id)
+        return executadas
+
+    def _dispara_partilhadas(self, nomes_titulos=None):
+        """
+        Executa, por ordem de chegada, as ordens de carteiras partilhadas a aguardar que as cotações atuais dos
+        títulos indicados permitem executar (ver p2._dispara_ordens). Só são percorridas as entradas do topo de cada
+        heap que a cotação atinge; as ordens de um título que deixou de estar cotado são todas executadas, tal como
+        em p2._cruza_limite.
+
+        Args:
+        - nomes_titulos (iterable): Títulos cuja cotação mudou. Por omissão, todos os títulos com ordens a aguardar.
+
+        Returns:
+        - set: Identificadores globais das carteiras das ordens executadas.
+        """
+        nomes = [nome_titulo for nome_titulo in (self.livro if nomes_titulos is None else set(nomes_titulos))
+                 if nome_titulo in self.livro and any(self.livro[nome_titulo].values())]
+        if not nomes:
+            return set()
+        disparadas = {}  # ordem_id -> chegada
+        for nome_titulo, preco in zip(nomes, self._chama(0, '_precos', nomes)):
+            obsoletas = self.obsoletas.setdefault(nome_titulo, {'COMPRA': 0, 'VENDA': 0})
+            compras, vendas = self.livro[nome_titulo]['COMPRA'], self.livro[nome_titulo]['VENDA']
+            while compras and (preco is None or -compras[0][0] >= preco or not self._em_vigor(compras[0])):
+                entrada = heapq.heappop(compras)
+                if self._em_vigor(entrada) and entrada[2] not in disparadas:
+                    disparadas[entrada[2]] = entrada[1]
+                else:
+                    obsoletas['COMPRA'] -= 1
+            while vendas and (preco is None or vendas[0][0] <= preco or not self._em_vigor(vendas[0])):
+                entrada = heapq.heappop(vendas)
+                if self._em_vigor(entrada) and entrada[2] not in disparadas:
+                    disparadas[entrada[2]] = entrada[1]
+                else:
+                    obsoletas['VENDA'] -= 1
+        executaveis = []
+        for ordem_id in sorted(disparadas, key=disparadas.get):
+            del self.chegadas[ordem_id]
+            executaveis.append(self.limites.pop(ordem_id))
+        return self._executa_partilhadas(executaveis)
+
+    def inicia_dia(self, data_str=""):
+        """
+        Abre o dia em todos os fragmentos e executa as ordens do dia das carteiras partilhadas (ver p2.inicia_dia).
+
+        Returns:
+        - None
+        """
+        self._difunde('inicia_dia', data_str)
+        self.hoje = self._chama(0, '_hoje')
+        ordens_dia = self.ordens.pop(self.hoje, {})
+        for ordem_id in ordens_dia:
+            del self.agendadas[ordem_id]
+        cruzam = self._chama(0, '_cruzam', list(ordens_dia.values())) if ordens_dia else []
+        executaveis = []
+        for (ordem_id, ordem), cruza in zip(ordens_dia.items(), cruzam):
+            if cruza:
+                executaveis.append(ordem)
+            else:
+                self._aguarda(ordem_id, ordem)
+        self._executa_partilhadas(executaveis)
+
+    def carrega_ordens(self, nome_ficheiro, tamanho_bloco=p2.TAMANHO_BLOCO):
+        """
+        Carrega um ficheiro de ordens com os identificadores globais das carteiras (ver p2.carrega_ordens).
+
+        Cada bloco de linhas é repartido pelos fragmentos das carteiras, com os identificadores locais, e carregado
+        em todos em simultâneo. As linhas sem um identificador de carteira numérico vão para o fragmento 0, que as
+        rejeita pelo mesmo motivo que p2. As ordens de carteiras partilhadas são validadas, sem serem agendadas,
+        pelo fragmento da carteira e ficam no encaminhador, tal como em agenda_ordem.
+
+        Args:
+        - nome_ficheiro (str): Nome do ficheiro a ser processado.
+        - tamanho_bloco (int): Número de linhas lidas e repartidas de cada vez.
+
+        Raises:
+        - ValueError: Se houver um erro ao abrir o ficheiro.
+
+        Returns:
+        - list: Lista de tuplos (numero_linha, motivo) com as linhas rejeitadas.
+        """
+        rejeitadas = []
+        try:
+            with open(nome_ficheiro, 'r') as ficheiro:
+                n_linha = 1
+                while True:
+                    linhas = list(itertools.islice(ficheiro, tamanho_bloco))
+                    if not linhas:
+                        break
+                    self._carrega_bloco_ordens(linhas, n_linha, rejeitadas)
+                    n_linha += len(linhas)
+        except IOError:
+            raise ValueError('erro a abrir o ficheiro')
+        rejeitadas.sort()
+        return rejeitadas
+
+    def _carrega_bloco_ordens(self, linhas, primeira_linha, rejeitadas):
+        """
+        Reparte um bloco de linhas de um ficheiro de ordens pelos fragmentos e carrega-o (ver carrega_ordens).
+
+        Args:
+        - linhas (list): Linhas do bloco, tal como lidas do ficheiro.
+        - primeira_linha (int): Número da primeira linha do bloco no ficheiro.
+        - rejeitadas (list): Lista onde são acrescentados os tuplos (numero_linha, motivo) das linhas rejeitadas.
+
+        Returns:
+        - None
+        """
+        # (fragmento, partilhadas) -> linhas com os identificadores locais e números dessas linhas no ficheiro
+        destinos = {}
+        for n_linha, linha in enumerate(linhas, primeira_linha):
+            campos = p2._campos_tabulados(linha)
+            if not campos:
+                continue
+            try:
+                carteira_id = int(campos[0])
+            except ValueError:
+                destino = destinos.setdefault((0, False), ([], []))
+            else:
+                fragmento, local_id = self._local(carteira_id)
+                linha = '\t'.join([str(local_id)] + campos[1:]) + '\n'
+                destino = destinos.setdefault((fragmento, carteira_id in self.partilhadas), ([], []))
+            destino[0].append(linha)
+            destino[1].append(n_linha)
+        chaves = list(destinos)
+        respostas = self._chama_todos([(fragmento, '_valida_ordens' if partilhadas else '_carrega_linhas',
+                                        (destinos[(fragmento, partilhadas)][0],))
+                                       for fragmento, partilhadas in chaves])
+        for (fragmento, partilhadas), resposta in zip(chaves, respostas):
+            numeros = destinos[(fragmento, partilhadas)][1]
+            if not partilhadas:
+                rejeitadas.extend((numeros[indice], motivo) for indice, motivo in resposta)
+                continue
+            futuras, do_dia, invalidas = resposta
+            rejeitadas.extend((numeros[indice], motivo) for indice, motivo in invalidas)
+            self._agenda_partilhadas(fragmento, futuras, [(numeros[indice], ordem) for indice, ordem in do_dia],
+                                     rejeitadas)
+
+    def _agenda_partilhadas(self, fragmento, futuras, do_dia, rejeitadas):
+        """
+        Guarda no encaminhador ordens de carteiras partilhadas de um fragmento, já validadas por este, e executa
+        as do dia atual que a cotação permite executar, tal como p2._carrega_bloco_ordens.
+
+        Args:
+        - fragmento (int): Fragmento das carteiras das ordens.
+        - futuras (list): Ordens para dias futuros, com os identificadores locais das carteiras.
+        - do_dia (list): Tuplos (numero_linha, ordem) das ordens para o dia atual, com os identificadores locais.
+        - rejeitadas (list): Lista onde são acrescentados os tuplos (numero_linha, motivo) das ordens recusadas.
+
+        Returns:
+        - None
+        """
+        if futuras:
+            ordem_id = self._chama(fragmento, '_reserva_ordem_ids', len(futuras))
+            for local_id, ordem in enumerate(futuras, ordem_id):
+                ordem = self._ordem_global(fragmento, ordem)
+                global_id = self._global(fragmento, local_id)
+                self.ordens.setdefault(ordem[5], {})[global_id] = self.agendadas[global_id] = ordem
+        if not do_dia:
+            return
+        ordens_dia = [(n_linha, self._ordem_global(fragmento, ordem)) for n_linha, ordem in do_dia]
+        a_aguardar = []
+        for (n_linha, ordem), cruza in zip(ordens_dia, self._chama(0, '_cruzam', [ordem for _, ordem in ordens_dia])):
+            if not cruza:
+                a_aguardar.append(ordem)
+                continue
+            try:
+                self._transacao(ordem[0], ordem[1], ordem[2], ordem[3])
+            except ValueError as erro:
+                rejeitadas.append((n_linha, str(erro)))
+        if a_aguardar:
+            ordem_id = self._chama(fragmento, '_reserva_ordem_ids', len(a_aguardar))
+            for local_id, ordem in enumerate(a_aguardar, ordem_id):
+                self._aguarda(self._global(fragmento, local_id), ordem)
+
+    def carrega_mercado(self, nome_ficheiro, cache=True):
+        """
+        Carrega o mesmo ficheiro de mercado em todos os fragmentos (ver p2.carrega_mercado).
+
+        Returns:
+        - list: Lista de tuplos (numero_linha, motivo) com as linhas rejeitadas.
+        """
+        rejeitadas = self._difunde('carrega_mercado', nome_ficheiro, cache)[0]
+        self._dispara_partilhadas()
+        return rejeitadas
+
+    def atualiza_precos(self, ticks):
+        """
+        Aplica as mesmas cotações em todos os fragmentos (ver p2.atualiza_precos).
+
+        Returns:
+        - set: Identificadores globais das carteiras cujo valor foi alterado.
+        """
+        ticks = list(ticks)
+        alteradas = set()
+        for fragmento, alteradas_fragmento in enumerate(self._difunde('atualiza_precos', ticks)):
+            alteradas.update(self._global(fragmento, carteira_id) for carteira_id in alteradas_fragmento)
+        return alteradas | self._dispara_partilhadas(nome_titulo for nome_titulo, _ in ticks)
+
+    def gera_resumo(self, carteira_id, data_inicio_str="", data_fim_str=""):
+        """
+        Gera o resumo de uma carteira no seu fragmento (ver p2.gera_resumo).
+
+        Returns:
+        - list: Resumo da carteira, com o identificador global.
+        """
+        fragmento, local_id = self._local(carteira_id)
+        resumo = self._chama(fragmento, 'gera_resumo', local_id, data_inicio_str, data_fim_str)
+        resumo[0] = carteira_id
+        return resumo
@@ -0,0 +1,345 @@
+import bisect
+import cProfile
+import collections
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+
+import p2
+
+# Operações de p2 instrumentadas por ativa
+OPERACOES = ('cria_cliente', 'encerra_cliente', 'encerra_clientes', 'posicao_cliente', 'matriz_posicoes',
+             'posicao_clientes', 'movimenta_saldo', 'abre_carteira', 'encerra_carteira', 'regista_operacao',
+             'processa_operacao', 'agenda_ordem', 'cancela_ordem', 'cancela_ordens', 'altera_ordem', 'gera_resumo',
+             'imprime_resumo', 'grava_resumos', 'carrega_mercado', 'atualiza_precos', 'carrega_ordens', 'inicia_dia')
+
+# Limites superiores, em segundos, dos intervalos dos histogramas de latência
+LIMITES_LATENCIA = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2,
+                    5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Limites superiores dos intervalos do histograma do número de ordens executadas em cada abertura de dia
+LIMITES_ORDENS = (0, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+metricas = None  # Metricas em recolha, enquanto a instrumentação estiver ativa
+_originais = {}  # nome da operação -> função de p2 substituída por ativa
+
+
+class Histograma:
+    """
+    Histograma de intervalos fixos, com a soma e o número de observações.
+    """
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.contagens = [0] * (len(limites) + 1)  # o último intervalo não tem limite superior
+        self.soma = 0.0
+        self.n = 0
+
+    def observa(self, valor):
+        self.contagens[bisect.bisect_left(self.limites, valor)] += 1
+        self.soma += valor
+        self.n += 1
+
+
+class Metricas:
+    """
+    Métricas recolhidas pela instrumentação: latência e erros de cada operação, número de ordens executadas e
+    duração de cada abertura de dia.
+    """
+
+    def __init__(self):
+        self.latencias = {}  # nome da operação -> Histograma das durações, em segundos
+        self.erros = collections.Counter()  # nome da operação -> número de chamadas terminadas com uma exceção
+        self.ordens_dia = Histograma(LIMITES_ORDENS)
+        self.dias = []  # (data, duração em segundos, ordens executadas) de cada chamada a inicia_dia
+
+    def amostra(self):
+        """
+        Tira uma amostra das métricas, juntando-lhes a profundidade atual dos livros de ordens.
+
+        Returns:
+        - dict: Contadores, histogramas e medidores, tal como são passados aos exportadores.
+        """
+        return {'chamadas': {nome: histograma.n for nome, histograma in self.latencias.items()},
+                'erros': dict(self.erros),
+                'latencias': {nome: (histograma.limites, list(histograma.contagens), histograma.soma, histograma.n)
+                              for nome, histograma in self.latencias.items()},
+                'ordens_dia': (self.ordens_dia.limites, list(self.ordens_dia.contagens), self.ordens_dia.soma,
+                               self.ordens_dia.n),
+                'dias': list(self.dias),
+                'medidores': {'ordens_agendadas': _ordens_agendadas(),
+                              'ordens_limite': len(p2.ordens_ativas),
+                              'clientes': len(p2.clientes),
+                              'carteiras': len(p2.carteiras)}}
+
+
+def _ordens_agendadas():
+    """
+    Conta as ordens agendadas no livro de ordens, percorrendo apenas as datas.
+
+    Returns:
+    - int: Número de ordens agendadas.
+    """
+    return sum(map(len, p2.ordens.values()))
+
+
+def _instrumenta(nome, funcao):
+    """
+    Envolve uma operação de p2, medindo a duração e contando os erros de cada chamada.
+
+    Args:
+    - nome (str): Nome da operação.
+    - funcao (callable): Função original.
+
+    Returns:
+    - callable: Função instrumentada.
+    """
+    histograma = metricas.latencias.setdefault(nome, Histograma(LIMITES_LATENCIA))
+    erros = metricas.erros
+
+    @functools.wraps(funcao)
+    def instrumentada(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args, **kwargs)
+        except Exception:
+            erros[nome] += 1
+            raise
+        finally:
+            histograma.observa(time.perf_counter() - inicio)
+    return instrumentada
+
+
+def _instrumenta_inicia_dia(funcao):
+    """
+    Envolve inicia_dia, registando além da duração o número de ordens executadas em cada abertura de dia.
+
+    Args:
+    - funcao (callable): Função inicia_dia original.
+
+    Returns:
+    - callable: Função instrumentada.
+    """
+    instrumentada = _instrumenta('inicia_dia', funcao)
+    ordens_dia = metricas.ordens_dia
+    dias = metricas.dias
+
+    @functools.wraps(funcao)
+    def inicia_dia(*args, **kwargs):
+        pendentes = _ordens_agendadas() + len(p2.ordens_ativas)
+        inicio = time.perf_counter()
+        try:
+            return instrumentada(*args, **kwargs)
+        finally:
+            duracao = time.perf_counter() - inicio
+            executadas = max(0, pendentes - _ordens_agendadas() - len(p2.ordens_ativas))
+            ordens_dia.observa(executadas)
+            dias.append((str(p2.estado['hoje']), duracao, executadas))
+    return inicia_dia
+
+
+def ativa(operacoes=OPERACOES):
+    """
+    Passa a recolher métricas das operações de p2, substituindo-as no módulo por versões instrumentadas.
+
+    Quando a instrumentação não está ativa, as operações de p2 são as originais e não têm qualquer custo adicional.
+    As chamadas feitas dentro de p2 também são contadas: as carteiras liquidadas por encerra_cliente contam, por
+    exemplo, como chamadas a encerra_carteira. Módulos que importaram as operações diretamente (from p2 import ...)
+    continuam a usar as originais.
+
+    Args:
+    - operacoes (iterable): Nomes das operações a instrumentar.
+
+    Returns:
+    - Metricas: As métricas em recolha.
+    """
+    global metricas
+    desativa()
+    metricas = Metricas()
+    for nome in operacoes:
+        _originais[nome] = getattr(p2, nome)
+        if nome == 'inicia_dia':
+            setattr(p2, nome, _instrumenta_inicia_dia(_originais[nome]))
+        else:
+            setattr(p2, nome, _instrumenta(nome, _originais[nome]))
+    return metricas
+
+
+def desativa():
+    """
+    Repõe as operações originais de p2. As métricas recolhidas até aqui continuam disponíveis em metricas.
+
+    Returns:
+    - None
+    """
+    for nome, funcao in _originais.items():
+        setattr(p2, nome, funcao)
+    _originais.clear()
+
+
+def exporta(exportador):
+    """
+    Passa uma amostra das métricas em recolha a um exportador.
+
+    Args:
+    - exportador (callable): Função ou objeto chamado com a amostra, tal como devolvida por Metricas.amostra.
+
+    Returns:
+    - None
+    """
+    if metricas is not None:
+        exportador(metricas.amostra())
+
+
+class ExportadorMemoria:
+    """
+    Exportador que guarda em memória as amostras recebidas.
+    """
+
+    def __init__(self):
+        self.amostras = []
+
+    def __call__(self, amostra):
+        self.amostras.append(amostra)
+
+
+class ExportadorPrometheus:
+    """
+    Exportador que escreve cada amostra num ficheiro, no formato de texto do Prometheus, substituindo a anterior.
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+
+    def __call__(self, amostra):
+        temporario = self.caminho + '.tmp'
+        with open(temporario, 'w') as ficheiro:
+            ficheiro.write(formata_prometheus(amostra))
+        os.replace(temporario, self.caminho)
+
+
+def _formata_histograma(linhas, metrica, rotulos, histograma):
+    """
+    Acrescenta as linhas de um histograma no formato do Prometheus, com intervalos cumulativos.
+
+    Args:
+    - linhas (list): Lista onde as linhas são acrescentadas.
+    - metrica (str): Nome da métrica.
+    - rotulos (str): Rótulos da série, já formatados (por exemplo 'operacao="inicia_dia",'), ou ''.
+    - histograma (tuple): Limites, contagens, soma e número de observações.
+
+    Returns:
+    - None
+    """
+    limites, contagens, soma, n = histograma
+    acumulado = 0
+    for limite, contagem in zip(limites, contagens):
+        acumulado += contagem
+        linhas.append('%s_bucket{%sle="%r"} %d' % (metrica, rotulos, limite, acumulado))
+    linhas.append('%s_bucket{%sle="+Inf"} %d' % (metrica, rotulos, n))
+    rotulos = '{%s}' % rotulos.rstrip(',') if rotulos else ''
+    linhas.append('%s_sum%s %r' % (metrica, rotulos, soma))
+    linhas.append('%s_count%s %d' % (metrica, rotulos, n))
+
+
+def formata_prometheus(amostra):
+    """
+    Formata uma amostra das métricas no formato de texto do Prometheus.
+
+    Args:
+    - amostra (dict): Amostra, tal como devolvida por Metricas.amostra.
+
+    Returns:
+    - str: O texto a expor.
+    """
+    linhas = ['# TYPE p2_chamadas_total counter']
+    for nome, n in sorted(amostra['chamadas'].items()):
+        linhas.append('p2_chamadas_total{operacao="%s"} %d' % (nome, n))
+    linhas.append('# TYPE p2_erros_total counter')
+    for nome, n in sorted(amostra['erros'].items()):
+        linhas.append('p2_erros_total{operacao="%s"} %d' % (nome, n))
+    linhas.append('# TYPE p2_latencia_segundos histogram')
+    for nome, histograma in sorted(amostra['latencias'].items()):
+        _formata_histograma(linhas, 'p2_latencia_segundos', 'operacao="%s",' % nome, histograma)
+    linhas.append('# TYPE p2_ordens_executadas_dia histogram')
+    _formata_histograma(linhas, 'p2_ordens_executadas_dia', '', amostra['ordens_dia'])
+    for nome, valor in sorted(amostra['medidores'].items()):
+        linhas.append('# TYPE p2_%s gauge' % nome)
+        linhas.append('p2_%s %d' % (nome, valor))
+    if amostra['dias']:
+        linhas.append('# TYPE p2_ultimo_inicia_dia_segundos gauge')
+        linhas.append('p2_ultimo_inicia_dia_segundos %r' % amostra['dias'][-1][1])
+    linhas.append('')
+    return '\n'.join(linhas)
+
+
+def _amostra_pilhas(fio_id, intervalo, pilhas, parar):
+    """
+    Amostra periodicamente a pilha de chamadas de um fio de execução, até ser pedido que pare.
+
+    Args:
+    - fio_id (int): Identificador do fio a amostrar.
+    - intervalo (float): Tempo, em segundos, entre amostras.
+    - pilhas (collections.Counter): Contador onde cada pilha amostrada é acumulada.
+    - parar (threading.Event): Evento que termina a amostragem.
+
+    Returns:
+    - None
+    """
+    while not parar.wait(intervalo):
+        frame = sys._current_frames().get(fio_id)
+        pilha = []
+        while frame is not None:
+            codigo = frame.f_code
+            pilha.append('%s:%s' % (os.path.basename(codigo.co_filename), codigo.co_name))
+            frame = frame.f_back
+        if pilha:
+            pilhas[';'.join(reversed(pilha))] += 1
+
+
+def perfila(funcao, args=(), modo='cprofile', caminho=None, intervalo=0.001):
+    """
+    Executa uma função sob um perfilador.
+
+    Com modo 'cprofile', todas as chamadas são medidas e, se for dado um caminho, as estatísticas são gravadas no
+    formato do pstats. Com modo 'amostragem', a pilha de chamadas é amostrada a cada intervalo segundos, com um
+    custo muito menor; o caminho recebe as pilhas no formato usado pelos flame graphs ('f1;f2;f3 contagem').
+
+    Args:
+    - funcao (callable): Função a executar.
+    - args (tuple): Argumentos da função.
+    - modo (str): 'cprofile' ou 'amostragem'.
+    - caminho (str): Ficheiro onde gravar o perfil.
+    - intervalo (float): Tempo, em segundos, entre amostras, no modo 'amostragem'.
+
+    Raises:
+    - ValueError: Se o modo for desconhecido.
+
+    Returns:
+    - tuple: O resultado da função e o perfil (pstats.Stats ou collections.Counter das pilhas amostradas).
+    """
+    if modo == 'cprofile':
+        perfilador = cProfile.Profile()
+        resultado = perfilador.runcall(funcao, *args)
+        if caminho:
+            perfilador.dump_stats(caminho)
+        return resultado, pstats.Stats(perfilador)
+    if modo == 'amostragem':
+        pilhas = collections.Counter()
+        parar = threading.Event()
+        amostrador = threading.Thread(target=_amostra_pilhas, args=(threading.get_ident(), intervalo, pilhas, parar),
+                                      daemon=True)
+        amostrador.start()
+        try:
+            resultado = funcao(*args)
+        finally:
+            parar.set()
+            amostrador.join()
+        if caminho:
+            with open(caminho, 'w') as ficheiro:
+                for pilha, n in pilhas.most_common():
+                    ficheiro.write('%s %d\n' % (pilha, n))
+        return resultado, pilhas
+    raise ValueError('modo de perfil desconhecido')
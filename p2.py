@@ -1,11 +1,310 @@
+import bisect
+import collections
+import collections.abc
 import datetime
+import functools
+import gc
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+from array import array
+
+estado = {'hoje': datetime.date.today(), 'cliente_id': 1, 'carteira_id': 1, 'ordem_id': 1}
+clientes = {}  # cliente_id -> Cliente
+carteiras = {}  # carteira_id -> Carteira
+# Os saldos, cotações e valores são inteiros, em unidades monetárias (ESCALA_MONETARIA unidades por euro)
+saldos = array('q')  # saldo de cada cliente, indexado pelo identificador do cliente
+valores_titulos = array('q')  # valor em cache dos títulos de cada cliente, indexado pelo identificador do cliente
+valores_carteiras = array('q')  # valor em cache de cada carteira, indexado pelo identificador da carteira
+mercado = {}  # nome do título -> identificador interno, índice de mercado_nomes, mercado_designacoes e mercado_precos
+mercado_nomes = []
+mercado_designacoes = []
+mercado_precos = array('q')  # cotação de cada título, em unidades monetárias
+detentores = {}  # nome do título -> conjunto das carteiras que o detêm
+ordens = {}  # livro de ordens agendadas: data 'AAAA-MM-DD' -> {ordem_id: ordem} desse dia, por ordem de chegada
+ordens_agendadas = {}  # ordem_id -> ordem agendada no livro de ordens
+# nome do título -> {'COMPRA': heap, 'VENDA': heap} de (chave do limite, ordem_id) das ordens a aguardar o preço
+livro_limites = {}
+ordens_ativas = {}  # ordem_id -> ordem a aguardar no livro_limites
+ordens_carteira = {}  # carteira_id -> conjunto dos identificadores das ordens agendadas ou a aguardar da carteira
+ordens_titulo = {}  # nome do título -> conjunto dos identificadores das ordens agendadas ou a aguardar do título
+entradas_obsoletas = {}  # nome do título -> {'COMPRA': n, 'VENDA': n} entradas do livro_limites sem ordem em vigor
+# Diário de operações de todas as carteiras, guardado por colunas partilhadas; cada carteira guarda os índices das suas
+# linhas (Carteira.operacoes), por ordem cronológica
+diario_datas = array('i')  # ordinal da data de cada operação
+diario_codigos = array('b')  # índice da descrição da operação em OPERACOES
+diario_titulos = array('i')  # identificador interno do título transacionado, ou -1
+diario_quantidades = array('q')  # número de unidades do título transacionadas
+diario_valores = array('q')  # valor total da operação, em unidades monetárias
+# carteira_id -> {nome do título: linha do resumo}, do menos para o mais recentemente usado
+resumos = collections.OrderedDict()
+
+OPERACOES = ['ABERTURA', 'FECHO', 'COMPRA', 'VENDA']  # descrições das operações, indexadas pelo código no diário
+CAMPOS_DIARIO = ('data', 'codigo', 'titulo', 'quantidade', 'valor')  # campos de cada operação no diário de uma carteira
+
+MAXIMO_CARTEIRAS_TUPLO = 8  # acima deste número, as carteiras de um cliente são guardadas num conjunto
+TAMANHO_BLOCO = 100_000  # linhas lidas de cada vez por carrega_ordens
+# Bloco de ordens bem formado: em cada linha, cinco campos sem espaços separados por um tabulador, pelo que os
+# campos separados por espaços coincidem com os obtidos por _campos_tabulados
+BLOCO_ORDENS_REGULAR = re.compile(r'(?:\S+\t\S+\t\S+\t\S+\t\S+\r?(?:\n|\Z))*')
+ESCALA_MONETARIA = 10_000  # unidades monetárias por euro: os valores são guardados com quatro casas decimais exatas
+LIMITE_CACHE_RESUMOS = 64 * 2**20  # memória, em bytes, disponível para os resumos em cache
+BYTES_POR_LINHA_RESUMO = 250  # estimativa da memória ocupada por cada linha de títulos de um resumo em cache
+_linhas_em_cache = 0
+
+# Cabeçalho da cache binária de carrega_mercado: identificação do formato, mtime, tamanho e hash do ficheiro de
+# origem, seguidos do número de títulos e de linhas rejeitadas e do tamanho, em bytes, de cada bloco de texto
+CABECALHO_CACHE_MERCADO = struct.Struct('<8sqq16sIIIII')
+FORMATO_CACHE_MERCADO = b'P2MERC01'
+
+# Variáveis globais que compõem o estado do módulo, guardadas nos instantâneos de persistencia.py
+VARIAVEIS_ESTADO = ('estado', 'clientes', 'carteiras', 'saldos', 'valores_titulos', 'valores_carteiras', 'mercado',
+                    'mercado_nomes', 'mercado_designacoes', 'mercado_precos', 'detentores', 'ordens',
+                    'ordens_agendadas', 'livro_limites', 'ordens_ativas', 'ordens_carteira', 'ordens_titulo',
+                    'entradas_obsoletas',
+                    'diario_datas', 'diario_codigos', 'diario_titulos', 'diario_quantidades', 'diario_valores',
+                    'OPERACOES')
+
+# Função chamada com (nome, args, kwargs) antes de cada operação que altera o estado e, se a operação falhar, de
+# novo com (None, (motivo,), {}), para que a recuperação distinga as falhas registadas das divergências
+diario_escrita = None
+_em_registo = False
+
+
+def _persistente(funcao):
+    """
+    Decora uma função que altera o estado, para que cada chamada seja passada a diario_escrita antes de ser executada.
+
+    As chamadas feitas a partir de outra função já registada não são registadas, pois são repetidas por esta. Uma
+    chamada que termina com uma exceção é seguida de um registo da falha (ver diario_escrita). Os argumentos que só
+    podem ser percorridos uma vez, como geradores, são convertidos em listas antes do registo, e é essa lista que é
+    passada à função.
+
+    Args:
+    - funcao (function): Função a decorar.
+
+    Returns:
+    - function: A função decorada.
+    """
+    @functools.wraps(funcao)
+    def persistente(*args, **kwargs):
+        global _em_registo
+        if diario_escrita is None or _em_registo:
+            return funcao(*args, **kwargs)
+        args = tuple(map(_materializa, args))
+        kwargs = {nome: _materializa(valor) for nome, valor in kwargs.items()}
+        diario = diario_escrita
+        diario(funcao.__name__, args, kwargs)
+        _em_registo = True
+        try:
+            return funcao(*args, **kwargs)
+        except Exception as erro:
+            diario(None, (str(erro),), {})
+            raise
+        finally:
+            _em_registo = False
+    return persistente
+
+
+def _materializa(valor):
+    """
+    Converte numa lista um argumento iterável que não pode ser registado tal como está (iteradores, geradores e
+    vistas de dicionários); os restantes argumentos são devolvidos sem alteração.
+
+    Args:
+    - valor (object): Argumento de uma operação registada.
+
+    Returns:
+    - object: O argumento, ou uma lista com os seus elementos.
+    """
+    if isinstance(valor, (collections.abc.Iterator, collections.abc.MappingView)):
+        return list(valor)
+    return valor
+
+
+class Cliente:
+    """
+    Registo de um cliente, com atributos fixos (__slots__) em vez de um dicionário por cliente.
+
+    O saldo e o valor dos títulos são guardados, em unidades monetárias, nos arrays saldos e valores_titulos,
+    indexados pelo identificador do cliente, e lidos em euros. As carteiras do cliente são guardadas em carteiras
+    como None (nenhuma), como o identificador da única carteira, como um tuplo ou, acima de MAXIMO_CARTEIRAS_TUPLO
+    carteiras, como um conjunto (ver _carteiras_cliente). Os campos podem também ser lidos e alterados como num
+    dicionário (cliente['saldo']); carteiras_id é devolvido como uma vista só de leitura sobre as carteiras, pois
+    estas só são alteradas por abre_carteira e encerra_carteira.
+    """
+    __slots__ = ('cliente_id', 'nif', 'nome', 'data_nasc', 'carteiras')
+
+    def __init__(self, cliente_id, nif, nome, data_nasc):
+        self.cliente_id = cliente_id
+        self.nif = nif
+        self.nome = nome
+        # As datas de nascimento repetem-se muito: cada data distinta é guardada uma só vez
+        self.data_nasc = sys.intern(data_nasc) if type(data_nasc) is str else data_nasc
+        self.carteiras = None  # carteiras de que o cliente é titular: None, um identificador, um tuplo ou um conjunto
+
+    @property
+    def saldo(self):
+        return saldos[self.cliente_id] / ESCALA_MONETARIA
+
+    @saldo.setter
+    def saldo(self, valor):
+        saldos[self.cliente_id] = _unidades(valor)
+
+    @property
+    def valor_titulos(self):
+        return valores_titulos[self.cliente_id] / ESCALA_MONETARIA
+
+    @valor_titulos.setter
+    def valor_titulos(self, valor):
+        valores_titulos[self.cliente_id] = _unidades(valor)
+
+    @property
+    def carteiras_id(self):
+        return _VistaCarteiras(self)
+
+    def __getitem__(self, campo):
+        return getattr(self, campo)
+
+    def __setitem__(self, campo, valor):
+        setattr(self, campo, valor)
+
+    def __repr__(self):
+        return 'Cliente(%r, %r, %r, saldo=%r, valor_titulos=%r, carteiras_id=%r)' % (
+            self.nif, self.nome, self.data_nasc, self.saldo, self.valor_titulos, set(_carteiras_cliente(self)))
+
+
+class _VistaCarteiras(collections.abc.Set):
+    """
+    Vista só de leitura sobre as carteiras de um cliente, sem cópia: reflete as alterações posteriores.
+    """
+    __slots__ = ('_cliente',)
+
+    def __init__(self, cliente):
+        self._cliente = cliente
+
+    def __contains__(self, elemento):
+        return elemento in _carteiras_cliente(self._cliente)
+
+    def __iter__(self):
+        return iter(_carteiras_cliente(self._cliente))
+
+    def __len__(self):
+        return len(_carteiras_cliente(self._cliente))
+
+    def __repr__(self):
+        return repr(set(_carteiras_cliente(self._cliente)))
+
+
+def _carteiras_cliente(cliente):
+    """
+    Devolve as carteiras de um cliente como uma coleção, qualquer que seja a forma em que estão guardadas.
+
+    Args:
+    - cliente (Cliente): O cliente.
+
+    Returns:
+    - tuple or set: Identificadores das carteiras de que o cliente é titular.
+    """
+    carteiras_id = cliente.carteiras
+    if carteiras_id is None:
+        return ()
+    if type(carteiras_id) is int:
+        return (carteiras_id,)
+    return carteiras_id
+
+
+class Carteira:
+    """
+    Registo de uma carteira de títulos, com atributos fixos (__slots__) em vez de um dicionário por carteira.
+
+    O valor em cache dos títulos é guardado, em unidades monetárias, no array valores_carteiras, indexado pelo
+    identificador da carteira. As operações são guardadas nas colunas partilhadas do diário (diario_datas, ...), e
+    operacoes guarda os índices das linhas da carteira, por ordem cronológica. Os campos podem também ser lidos e
+    alterados como num dicionário (carteira['titulos']).
+    """
+    __slots__ = ('carteira_id', 'titulares_id', 'designacao', 'data_abertura', 'titulos', 'operacoes')
+
+    def __init__(self, carteira_id, titulares_id, designacao, data_abertura):
+        self.carteira_id = carteira_id
+        self.titulares_id = titulares_id
+        self.designacao = designacao
+        self.data_abertura = data_abertura
+        self.titulos = {}
+        self.operacoes = array('q')  # índices das operações da carteira nas colunas do diário
+
+    @property
+    def valor(self):
+        return valores_carteiras[self.carteira_id] / ESCALA_MONETARIA
+
+    @valor.setter
+    def valor(self, valor):
+        valores_carteiras[self.carteira_id] = _unidades(valor)
+
+    def __getitem__(self, campo):
+        return getattr(self, campo)
+
+    def __setitem__(self, campo, valor):
+        setattr(self, campo, valor)
+
+    def __repr__(self):
+        return 'Carteira(%r, %r, %r, titulos=%r, valor=%r)' % (
+            self.titulares_id, self.designacao, self.data_abertura, self.titulos, self.valor)
+
+
+def _reserva(coluna, indice):
+    """
+    Garante que um array indexado por identificadores tem uma posição para o identificador dado, inicializada a zero.
+
+    Args:
+    - coluna (array): Array a alargar.
+    - indice (int): Identificador que tem de caber no array.
+
+    Returns:
+    - None
+    """
+    if len(coluna) <= indice:
+        coluna.extend(itertools.repeat(0, indice + 1 - len(coluna)))
+    coluna[indice] = 0
+
+
+def _unidades(valor):
+    """
+    Converte um valor em euros para unidades monetárias, arredondando à unidade mais próxima.
+
+    Args:
+    - valor (float): Valor em euros.
+
+    Returns:
+    - int: Valor em unidades monetárias.
+    """
+    return round(valor * ESCALA_MONETARIA)
+
+
+def _divide_valor(valor, n):
+    """
+    Divide um valor inteiro em n partes exatas. As unidades que sobram da divisão vão, uma a cada, para as primeiras
+    partes, pelo que a soma das partes é sempre igual ao valor e o resultado depende apenas da ordem dos titulares.
+
+    Args:
+    - valor (int): Valor a dividir, em unidades monetárias.
+    - n (int): Número de partes.
+
+    Returns:
+    - list: As n partes, da maior para a menor.
+    """
+    parte, resto = divmod(valor, n)
+    return [parte + 1] * resto + [parte] * (n - resto)
 
-estado = {'hoje': datetime.date.today(), 'cliente_id': 1, 'carteira_id': 1}
-clientes = {}
-carteiras = {}
-mercado = {}
-ordens = []
 
+@_persistente
 def cria_cliente(nif, nome, data_nasc):
     """
     Cria um novo cliente com os detalhes fornecidos e o adiciona ao dicionário de clientes.
@@ -20,11 +319,14 @@ def cria_cliente(nif, nome, data_nasc):
     """
     global estado, clientes
     cliente_id = estado['cliente_id']
-    clientes[cliente_id] = {'nif': nif, 'nome': nome, 'data_nasc': data_nasc, 'saldo': 0.0, 'carteiras_id': []}
+    _reserva(saldos, cliente_id)
+    _reserva(valores_titulos, cliente_id)
+    clientes[cliente_id] = Cliente(cliente_id, nif, nome, data_nasc)
     estado['cliente_id'] += 1
     return cliente_id
 
 
+@_persistente
 def encerra_cliente(cliente_id):
     """
     Encerra o cliente com o identificador fornecido, liquidando todas as suas carteiras individuais, se houver.
@@ -42,19 +344,17 @@ def encerra_cliente(cliente_id):
         return 0  # Nenhum cliente com esse ID, retorno 0
 
     # Verifica se o cliente tem carteiras partilhadas
-    carteiras_cliente = clientes[cliente_id]['carteiras_id']
+    carteiras_cliente = list(_carteiras_cliente(clientes[cliente_id]))
     for carteira_id in carteiras_cliente:
-        titulares = carteiras[carteira_id]['titulares_id']
-        if isinstance(titulares, int):
-            titulares = (titulares,)
-        if len(titulares) > 1:
+        if len(_titulares(carteira_id)) > 1:
             raise ValueError('cliente tem carteiras partilhadas')
 
-    # Encerra as carteiras individuais do cliente
-    total_saldo = clientes[cliente_id]['saldo']
+    # Encerra as carteiras individuais do cliente; encerra_carteira credita o valor dos títulos no saldo e retira-as
+    # das carteiras do cliente
     for carteira_id in carteiras_cliente:
-        total_saldo += encerra_carteira(carteira_id)
+        encerra_carteira(carteira_id)
         del carteiras[carteira_id]
+    total_saldo = saldos[cliente_id] / ESCALA_MONETARIA
 
     # Remove o cliente
     del clientes[cliente_id]
@@ -62,6 +362,29 @@ def encerra_cliente(cliente_id):
     return total_saldo
 
 
+def encerra_clientes(cliente_ids):
+    """
+    Encerra um conjunto de clientes, liquidando as suas carteiras individuais.
+
+    Os clientes com carteiras partilhadas não são encerrados.
+
+    Args:
+    - cliente_ids (iterable): Identificadores dos clientes a encerrar.
+
+    Returns:
+    - dict: Valor a entregar a cada cliente encerrado.
+    """
+    valores = {}
+    for cliente_id in cliente_ids:
+        if cliente_id not in clientes:
+            continue
+        try:
+            valores[cliente_id] = encerra_cliente(cliente_id)
+        except ValueError:
+            continue
+    return valores
+
+
 def posicao_cliente(cliente_id):
     """
     Retorna o valor total do cliente, incluindo o saldo atual e o valor atual de todas as ações das carteiras que o cliente possui.
@@ -72,43 +395,125 @@ def posicao_cliente(cliente_id):
     Returns:
     - float: O valor correspondente à soma do saldo do cliente com o valor atual de todas as ações das carteiras que o cliente possui.
     """
-    global clientes, carteiras, mercado
+    global clientes
     if cliente_id not in clientes:
         return 0
-    total_saldo = clientes[cliente_id]['saldo']
-    for carteira_id in clientes[cliente_id]['carteiras_id']:
-        carteira = carteiras[carteira_id]
-        if isinstance(carteira['titulares_id'], tuple):
-            n = len(carteira['titulares_id']) + 1
-        else:
-            n = 1
-        for titulo in carteira['titulos']:
-            total_saldo += mercado[titulo[0]][1] * titulo[1] / n
-    return total_saldo
+    # O valor dos títulos é mantido em cache por _ajusta_valor a cada movimento ou nova cotação
+    return (saldos[cliente_id] + valores_titulos[cliente_id]) / ESCALA_MONETARIA
+
+
+def matriz_posicoes(cliente_ids=None):
+    """
+    Constrói a matriz esparsa (formato CSR) das posições dos clientes, em dois níveis: uma linha por cliente, com as
+    carteiras de que é titular, e uma linha por carteira, com os títulos que detém.
+
+    O valor de uma carteira partilhada é dividido pelos titulares com _divide_valor, tal como em posicao_cliente,
+    pelo que cada entrada de um cliente guarda também a sua posição entre os titulares da carteira.
+
+    Args:
+    - cliente_ids (iterable): Identificadores dos clientes. Por omissão, todos os clientes.
+
+    Returns:
+    - dict: 'clientes' (list) com os clientes de cada linha, 'inicio' (array) com o índice da primeira entrada de
+      cada linha, 'carteiras' (array) com a linha da carteira de cada entrada e 'posicoes' (array) com a posição do
+      cliente entre os titulares dessa carteira; 'titulares' (array) com o número de titulares de cada carteira,
+      'inicio_carteiras' (array) com o índice do primeiro título de cada carteira, 'titulos' (array) com o
+      identificador interno de cada título e 'quantidades' (array) com a quantidade correspondente.
+    """
+    global clientes, carteiras, mercado
+    cliente_ids = list(clientes) if cliente_ids is None else list(cliente_ids)
+    inicio = array('q', [0])
+    linhas_carteiras = array('q')
+    posicoes = array('q')
+    linhas = {}  # carteira_id -> linha da carteira na matriz
+    titulares = array('q')
+    inicio_carteiras = array('q', [0])
+    titulo_ids = array('q')
+    quantidades = array('q')
+    for cliente_id in cliente_ids:
+        for carteira_id in _carteiras_cliente(clientes[cliente_id]) if cliente_id in clientes else ():
+            titulares_carteira = _titulares(carteira_id)
+            linha = linhas.get(carteira_id)
+            if linha is None:
+                linha = linhas[carteira_id] = len(titulares)
+                titulares.append(len(titulares_carteira))
+                for nome_titulo, quantidade in carteiras[carteira_id].titulos.items():
+                    titulo_ids.append(mercado[nome_titulo])
+                    quantidades.append(quantidade)
+                inicio_carteiras.append(len(titulo_ids))
+            linhas_carteiras.append(linha)
+            posicoes.append(titulares_carteira.index(cliente_id))
+        inicio.append(len(linhas_carteiras))
+    return {'clientes': cliente_ids, 'inicio': inicio, 'carteiras': linhas_carteiras, 'posicoes': posicoes,
+            'titulares': titulares, 'inicio_carteiras': inicio_carteiras, 'titulos': titulo_ids,
+            'quantidades': quantidades}
+
+
+def posicao_clientes(cliente_ids=None, matriz=None, precos=None):
+    """
+    Calcula de uma só vez a posição de um conjunto de clientes, multiplicando a matriz de posições pelo vetor de
+    cotações.
 
+    Ao contrário de posicao_cliente, não usa os valores em cache, pelo que serve também para os reconciliar: os
+    valores são calculados em unidades monetárias inteiras e divididos como em _divide_valor, pelo que, com as
+    cotações atuais, o resultado é exatamente o de posicao_cliente.
 
+    Args:
+    - cliente_ids (iterable): Identificadores dos clientes. Por omissão, todos os clientes.
+    - matriz (dict): Matriz de posições já construída por matriz_posicoes, reutilizada entre cálculos.
+    - precos (array): Cotações a usar, em euros, indexadas pelo identificador interno do título. Por omissão, as
+      cotações atuais.
+
+    Returns:
+    - dict: Posição de cada cliente, a soma do saldo com o valor atual das suas carteiras.
+    """
+    global clientes, mercado_precos
+    if matriz is None:
+        matriz = matriz_posicoes(cliente_ids)
+    precos = mercado_precos if precos is None else array('q', map(_unidades, precos))
+    valores = array('q', map(operator.mul, map(precos.__getitem__, matriz['titulos']), matriz['quantidades']))
+    inicio_carteiras = matriz['inicio_carteiras']
+    partes = [divmod(sum(valores[inicio_carteiras[j]:inicio_carteiras[j + 1]]), n)
+              for j, n in enumerate(matriz['titulares'])]
+    inicio, linhas, ordens_titulares = matriz['inicio'], matriz['carteiras'], matriz['posicoes']
+    posicoes = {}
+    for i, cliente_id in enumerate(matriz['clientes']):
+        if cliente_id not in clientes:
+            posicoes[cliente_id] = 0
+            continue
+        total = saldos[cliente_id]
+        for k in range(inicio[i], inicio[i + 1]):
+            parte, resto = partes[linhas[k]]
+            total += parte + (ordens_titulares[k] < resto)
+        posicoes[cliente_id] = total / ESCALA_MONETARIA
+    return posicoes
+
+
+@_persistente
 def movimenta_saldo(cliente_id, valor):
     """
     Movimenta o saldo do cliente.
 
     Args:
     - cliente_id (int): Identificador do cliente.
-    - valor (float): Valor a movimentar.
+    - valor (float): Valor a movimentar, arredondado a 1 / ESCALA_MONETARIA euros.
 
     Returns:
     - float: O valor movimentado, que pode ser negativo se o saldo for insuficiente ou zero se o valor for negativo.
     """
-    global clientes
+    global clientes, saldos
     if cliente_id not in clientes:
         return 0
-    if valor < 0 and clientes[cliente_id]['saldo'] < abs(valor):
-        valor = -clientes[cliente_id]['saldo']
-        clientes[cliente_id]['saldo'] = 0.0
+    unidades = _unidades(valor)
+    if unidades < 0 and saldos[cliente_id] < -unidades:
+        valor = -saldos[cliente_id] / ESCALA_MONETARIA
+        saldos[cliente_id] = 0
         return valor
     else:
-        clientes[cliente_id]['saldo'] += valor
-        return valor if valor >= 0 else 0
+        saldos[cliente_id] += unidades
+        return unidades / ESCALA_MONETARIA if unidades >= 0 else 0
 
+@_persistente
 def abre_carteira(titulares_id, designacao):
     """
     Abre uma nova carteira de títulos.
@@ -124,20 +529,22 @@ def abre_carteira(titulares_id, designacao):
         raise ValueError("titulares_id não pode ser None")
     global estado, carteiras
     carteira_id = estado['carteira_id']
-    carteiras[carteira_id] = {'titulares_id': titulares_id, 'designacao': designacao, 'data_abertura': estado['hoje'], 'titulos': [], 'operacoes': []}
+    _reserva(valores_carteiras, carteira_id)
+    carteiras[carteira_id] = Carteira(carteira_id, titulares_id, designacao, estado['hoje'])
     if isinstance(titulares_id, int):
-        clientes[titulares_id]['carteiras_id'].append(carteira_id)
+        _liga_carteira(titulares_id, carteira_id)
     elif isinstance(titulares_id, tuple):
         for titular_id in titulares_id:
-            clientes[titular_id]['carteiras_id'].append(carteira_id)
+            _liga_carteira(titular_id, carteira_id)
     regista_operacao(carteira_id, 'ABERTURA')
     estado['carteira_id'] += 1
     return carteira_id
 
 
+@_persistente
 def encerra_carteira(carteira_id):
     """
-    Encerra uma carteira de títulos.
+    Encerra uma carteira de títulos, cancelando as suas ordens agendadas ou a aguardar o preço limite.
 
     Args:
     - carteira_id (int): Identificador da carteira a ser encerrada.
@@ -145,25 +552,70 @@ def encerra_carteira(carteira_id):
     Returns:
     - float: O valor total obtido com a venda dos títulos.
     """
-    global carteiras, clientes, mercado
+    global carteiras, clientes
     if carteira_id not in carteiras:
         raise ValueError('carteira inexistente')
-    total_valor = 0
-    for titulo in carteiras[carteira_id]['titulos']:
-        total_valor += titulo[1] * mercado[titulo[0]][1]
-    titular_ids = carteiras[carteira_id]['titulares_id']
-    if isinstance(titular_ids, list):
-        for titular_id in titular_ids:
-            clientes[titular_id]['saldo'] += total_valor / len(titular_ids)
-            clientes[titular_id]['carteiras_id'].remove(carteira_id)
-    else:
-        clientes[titular_ids]['saldo'] += total_valor
-        clientes[titular_ids]['carteiras_id'].remove(carteira_id)
+    cancela_ordens(carteira_id)
+    total_valor = _valor_posicoes(carteiras[carteira_id].titulos.items())
+    for nome_titulo, quantidade in list(carteiras[carteira_id].titulos.items()):
+        _movimenta_titulo(carteira_id, nome_titulo, -quantidade)
+    titular_ids = _titulares(carteira_id)
+    for titular_id, parte in zip(titular_ids, _divide_valor(total_valor, len(titular_ids))):
+        saldos[titular_id] += parte
+        _desliga_carteira(titular_id, carteira_id)
     regista_operacao(carteira_id, 'FECHO')
-    return total_valor
+    _descarta_resumo(carteira_id)
+    return total_valor / ESCALA_MONETARIA
+
+
+def _liga_carteira(cliente_id, carteira_id):
+    """
+    Junta uma carteira às carteiras de um cliente.
+
+    Args:
+    - cliente_id (int): Identificador do cliente.
+    - carteira_id (int): Identificador da carteira.
+
+    Returns:
+    - None
+    """
+    cliente = clientes[cliente_id]
+    carteiras_id = cliente.carteiras
+    if carteiras_id is None:
+        cliente.carteiras = carteira_id
+    elif type(carteiras_id) is set:
+        carteiras_id.add(carteira_id)
+    else:
+        atuais = _carteiras_cliente(cliente)
+        if carteira_id not in atuais:
+            # Um tuplo ocupa muito menos do que um conjunto; este só é criado para os clientes com muitas carteiras
+            atuais += (carteira_id,)
+            cliente.carteiras = atuais if len(atuais) <= MAXIMO_CARTEIRAS_TUPLO else set(atuais)
+
+
+def _desliga_carteira(cliente_id, carteira_id):
+    """
+    Retira uma carteira das carteiras de um cliente.
+
+    Args:
+    - cliente_id (int): Identificador do cliente.
+    - carteira_id (int): Identificador da carteira.
 
+    Returns:
+    - None
+    """
+    cliente = clientes[cliente_id]
+    carteiras_id = cliente.carteiras
+    if type(carteiras_id) is set:
+        carteiras_id.discard(carteira_id)
+        if not carteiras_id:
+            cliente.carteiras = None
+    else:
+        restantes = tuple(outra_id for outra_id in _carteiras_cliente(cliente) if outra_id != carteira_id)
+        cliente.carteiras = restantes[0] if len(restantes) == 1 else restantes or None
 
 
+@_persistente
 def regista_operacao(carteira_id, descricao, nome_titulo=None, quantidade=None, valor=None):
     """
     Regista uma operação na carteira de títulos.
@@ -178,11 +630,111 @@ def regista_operacao(carteira_id, descricao, nome_titulo=None, quantidade=None,
     Returns:
     - None
     """
-    global carteiras, estado
-    operacao = (estado['hoje'], descricao, nome_titulo, quantidade, valor)
-    carteiras[carteira_id]['operacoes'].append(operacao)
+    global carteiras, estado, OPERACOES
+    if descricao not in OPERACOES:
+        OPERACOES.append(descricao)
+    _anota_operacao(carteiras[carteira_id], OPERACOES.index(descricao),
+                    -1 if nome_titulo is None else _interna_titulo(nome_titulo), quantidade or 0, _unidades(valor or 0))
+
+
+def _anota_operacao(carteira, codigo, titulo_id, quantidade, valor):
+    """
+    Acrescenta uma operação, com a data atual, ao diário de uma carteira.
+
+    Args:
+    - carteira (Carteira): A carteira.
+    - codigo (int): Índice da descrição da operação em OPERACOES.
+    - titulo_id (int): Identificador interno do título transacionado, ou -1.
+    - quantidade (int): Número de unidades do título transacionadas.
+    - valor (int): Valor total da operação, em unidades monetárias.
+
+    Returns:
+    - None
+    """
+    _acrescenta_linha(carteira, estado['hoje'].toordinal(), codigo, titulo_id, quantidade, valor)
+
+
+def _acrescenta_linha(carteira, data, codigo, titulo_id, quantidade, valor):
+    """
+    Acrescenta uma linha às colunas do diário e o seu índice às operações da carteira.
+
+    As operações de cada carteira são acrescentadas por ordem cronológica, pelo que as datas das suas linhas
+    estão sempre ordenadas.
+
+    Args:
+    - carteira (Carteira): A carteira.
+    - data (int): Ordinal da data da operação.
+    - codigo (int): Índice da descrição da operação em OPERACOES.
+    - titulo_id (int): Identificador interno do título transacionado, ou -1.
+    - quantidade (int): Número de unidades do título transacionadas.
+    - valor (int): Valor total da operação, em unidades monetárias.
+
+    Returns:
+    - None
+    """
+    carteira.operacoes.append(len(diario_datas))
+    diario_datas.append(data)
+    diario_codigos.append(codigo)
+    diario_titulos.append(titulo_id)
+    diario_quantidades.append(quantidade)
+    diario_valores.append(valor)
+
+
+def _linhas_diario(linhas):
+    """
+    Lê linhas das colunas do diário.
+
+    Args:
+    - linhas (iterable): Índices das linhas a ler.
+
+    Returns:
+    - list: Tuplos (data, codigo, titulo, quantidade, valor) das linhas, pela ordem de CAMPOS_DIARIO.
+    """
+    return [(diario_datas[linha], diario_codigos[linha], diario_titulos[linha], diario_quantidades[linha],
+             diario_valores[linha]) for linha in linhas]
+
+
+def _data(data):
+    """
+    Converte uma data no formato 'AAAA-MM-DD' num objeto datetime.date; as datas já convertidas são devolvidas tal
+    como estão.
+
+    Args:
+    - data (str or datetime.date): Data a converter.
+
+    Returns:
+    - datetime.date: A data correspondente.
+    """
+    return datetime.date.fromisoformat(data) if isinstance(data, str) else data
+
+
+def operacoes_periodo(carteira_id, data_inicio, data_fim):
+    """
+    Localiza, por pesquisa binária, as operações de uma carteira realizadas entre duas datas, inclusive.
+
+    As colunas devolvidas são cópias, pelo que podem ser guardadas enquanto a carteira continua a registar
+    operações.
 
+    Args:
+    - carteira_id (int): Identificador da carteira.
+    - data_inicio (str or datetime.date): Data de início do período.
+    - data_fim (str or datetime.date): Data de fim do período.
 
+    Returns:
+    - dict: Um array por campo de CAMPOS_DIARIO, restrito às operações do período.
+    """
+    global carteiras
+    linhas = carteiras[carteira_id].operacoes
+    data = diario_datas.__getitem__
+    inicio = bisect.bisect_left(linhas, _data(data_inicio).toordinal(), key=data)
+    fim = bisect.bisect_right(linhas, _data(data_fim).toordinal(), inicio, key=data)
+    linhas = linhas[inicio:fim]
+    return {campo: array(coluna.typecode, map(coluna.__getitem__, linhas))
+            for campo, coluna in zip(CAMPOS_DIARIO, (diario_datas, diario_codigos, diario_titulos,
+                                                     diario_quantidades, diario_valores))}
+
+
+@_persistente
 def processa_operacao(carteira_id, operacao, nome_titulo, quantidade):
     """
     Regista uma operação na carteira de títulos.
@@ -195,55 +747,121 @@ def processa_operacao(carteira_id, operacao, nome_titulo, quantidade):
     - valor (float): Valor total da operação.
 
     Returns:
-    - None
+    - float: O valor total da operação.
     """
-    global carteiras, mercado, clientes
+    global carteiras, clientes, saldos
     valor_total = 0
 
     if operacao == 'COMPRA':
-        valor_unidade = mercado[nome_titulo]['preco']
-        valor_total = valor_unidade * quantidade
+        titulo_id = id_titulo(nome_titulo)
+        valor_total = mercado_precos[titulo_id] * quantidade
 
-        if isinstance(carteiras[carteira_id]['titulares_id'], int):
-            cliente_ids = [carteiras[carteira_id]['titulares_id']]
-        else:
-            cliente_ids = list(carteiras[carteira_id]['titulares_id'])
+        # Numa carteira partilhada, cada titular paga uma parte exata do valor (ver _divide_valor)
+        cliente_ids = _titulares(carteira_id)
+        partes = _divide_valor(valor_total, len(cliente_ids))
 
-        if not all(clientes[cliente_id]['saldo'] >= valor_total / len(cliente_ids) for cliente_id in cliente_ids):
+        if not all(saldos[cliente_id] >= parte for cliente_id, parte in zip(cliente_ids, partes)):
             raise ValueError('fundos insuficientes')
 
-        for cliente_id in cliente_ids:
-            clientes[cliente_id]['saldo'] -= valor_total / len(cliente_ids)
+        for cliente_id, parte in zip(cliente_ids, partes):
+            saldos[cliente_id] -= parte
 
-        regista_operacao(carteira_id, operacao, nome_titulo, quantidade, valor_total)
+        _movimenta_titulo(carteira_id, nome_titulo, quantidade)
+        _anota_operacao(carteiras[carteira_id], OPERACOES.index(operacao), titulo_id, quantidade, valor_total)
 
     elif operacao == 'VENDA':
-        for titulo in carteiras[carteira_id]['titulos']:
-            if titulo[0] == nome_titulo:
-                if titulo[1] < quantidade:
-                    quantidade = titulo[1]
-                valor_total = mercado[nome_titulo][1] * quantidade
+        detida = carteiras[carteira_id].titulos.get(nome_titulo)
+        if not detida:
+            raise ValueError('titulo inexistente em carteira')
+        if detida < quantidade:
+            quantidade = detida
+        titulo_id = id_titulo(nome_titulo)
+        valor_total = mercado_precos[titulo_id] * quantidade
+
+        cliente_ids = _titulares(carteira_id)
+
+        for cliente_id, parte in zip(cliente_ids, _divide_valor(valor_total, len(cliente_ids))):
+            saldos[cliente_id] += parte
+
+        _movimenta_titulo(carteira_id, nome_titulo, -quantidade)
+        _anota_operacao(carteiras[carteira_id], OPERACOES.index(operacao), titulo_id, quantidade, valor_total)
+
+    return valor_total / ESCALA_MONETARIA
+
+
+def _titulares(carteira_id):
+    """
+    Devolve os titulares de uma carteira, sempre na forma de um tuple.
+
+    Args:
+    - carteira_id (int): Identificador da carteira.
+
+    Returns:
+    - tuple: Identificadores dos clientes titulares da carteira.
+    """
+    titulares_id = carteiras[carteira_id].titulares_id
+    return (titulares_id,) if isinstance(titulares_id, int) else tuple(titulares_id)
+
 
-                if isinstance(carteiras[carteira_id]['titulares_id'], int):
-                    cliente_ids = [carteiras[carteira_id]['titulares_id']]
-                else:
-                    cliente_ids = list(carteiras[carteira_id]['titulares_id'])
+def _ajusta_valor(carteira_id, delta_valor):
+    """
+    Ajusta o valor em cache de uma carteira e a parte correspondente de cada um dos seus titulares.
 
-                for cliente_id in cliente_ids:
-                    clientes[cliente_id]['saldo'] += valor_total / len(cliente_ids)
+    Args:
+    - carteira_id (int): Identificador da carteira.
+    - delta_valor (int): Variação do valor de mercado dos títulos da carteira, em unidades monetárias.
 
-                regista_operacao(carteira_id, operacao, nome_titulo, quantidade, valor_total)
-                return valor_total
+    Returns:
+    - None
+    """
+    global valores_carteiras, valores_titulos
+    titulares = _titulares(carteira_id)
+    if len(titulares) == 1:
+        valores_carteiras[carteira_id] += delta_valor
+        valores_titulos[titulares[0]] += delta_valor
+        return
+    # A parte de cada titular é sempre a que _divide_valor dá para o valor total da carteira, para que os
+    # arredondamentos de variações sucessivas não se acumulem
+    antes = _divide_valor(valores_carteiras[carteira_id], len(titulares))
+    valores_carteiras[carteira_id] += delta_valor
+    depois = _divide_valor(valores_carteiras[carteira_id], len(titulares))
+    for titular_id, parte_antes, parte_depois in zip(titulares, antes, depois):
+        valores_titulos[titular_id] += parte_depois - parte_antes
+
+
+def _movimenta_titulo(carteira_id, nome_titulo, quantidade):
+    """
+    Atualiza a posição de uma carteira num título, o índice de detentores e os valores em cache.
 
-        raise ValueError('titulo inexistente em carteira')
+    Args:
+    - carteira_id (int): Identificador da carteira.
+    - nome_titulo (str): Nome do título.
+    - quantidade (int): Variação do número de unidades detidas, negativa numa saída.
 
-    return valor_total
+    Returns:
+    - None
+    """
+    global carteiras, detentores
+    titulos = carteiras[carteira_id].titulos
+    nova = titulos.get(nome_titulo, 0) + quantidade
+    if nova:
+        titulos[nome_titulo] = nova
+        detentores.setdefault(nome_titulo, set()).add(carteira_id)
+    else:
+        titulos.pop(nome_titulo, None)
+        detentores.get(nome_titulo, set()).discard(carteira_id)
+    _ajusta_valor(carteira_id, mercado_precos[id_titulo(nome_titulo)] * quantidade)
+    _atualiza_resumo(carteira_id, nome_titulo)
 
 
+@_persistente
 def agenda_ordem(carteira_id, operacao, nome_titulo, quantidade, preco_limite, data_str):
     """
     Permite agendar uma ordem para uma operação a ser realizada na data atual ou numa data futura.
 
+    A ordem só é executada quando a cotação do título atinge o preço limite: igual ou inferior numa compra, igual
+    ou superior numa venda. Até lá, fica a aguardar no livro de limites do título.
+
     Args:
     - carteira_id (int): Identificador da carteira sobre a qual deverá ser realizada a operação.
     - operacao (str): Operação a realizar. Pode ser 'COMPRA' ou 'VENDA'.
@@ -253,154 +871,1140 @@ def agenda_ordem(carteira_id, operacao, nome_titulo, quantidade, preco_limite, d
     - data_str (str): Data em que a operação deverá ser realizada, no formato 'AAAA-MM-DD'.
 
     Returns:
-    - bool: Valor booleano que indica se a operação pode ou não ser realizada ou a ordem agendada.
+    - int: Identificador da ordem, que permite cancelá-la ou alterá-la enquanto não for executada, ou False se a
+      operação não puder ser realizada ou a ordem agendada.
     """
     global estado, ordens
-    if not data_str or data_str == estado['hoje']:
+    hoje_str = str(estado['hoje'])
+    ordem = (carteira_id, operacao, nome_titulo, quantidade, preco_limite, data_str or hoje_str)
+    if not data_str or data_str == hoje_str:
+        if not _cruza_limite(ordem):
+            ordem_id = _nova_ordem_id()
+            _coloca_no_livro_limites(ordem, ordem_id)
+            return ordem_id
         try:
             processa_operacao(carteira_id, operacao, nome_titulo, quantidade)
         except ValueError:
             return False
-        return True
-    if data_str < str(estado['hoje']):
+        return _nova_ordem_id()
+    if data_str < hoje_str:
         return False
-    ordens.append((carteira_id, operacao, nome_titulo, quantidade, preco_limite, data_str))
-    return True
+    ordem_id = _nova_ordem_id()
+    ordens.setdefault(data_str, {})[ordem_id] = ordens_agendadas[ordem_id] = ordem
+    _indexa_ordem(ordem_id, ordem)
+    return ordem_id
 
 
-def gera_resumo(carteira_id, data_inicio_str="", data_fim_str=""):
+def _nova_ordem_id():
     """
-    Gera um resumo da carteira especificada, com as informações correspondentes.
-
-    Args:
-    - carteira_id (int): Identificador da carteira para a qual deve ser gerado o resumo.
-    - data_inicio_str (str): Data de início das operações a incluir no resumo, no formato 'AAAA-MM-DD'.
-    - data_fim_str (str): Data de fim das operações a incluir no resumo, no formato 'AAAA-MM-DD'.
+    Atribui o identificador da próxima ordem.
 
     Returns:
-    - list: Lista contendo o resumo da carteira, com os elementos de informação conforme especificado.
+    - int: Identificador da ordem.
     """
-    global carteiras, estado
-    resumo = []
-    if not data_inicio_str:
-        data_inicio_str = carteiras[carteira_id]['data_abertura']
-    if not data_fim_str:
-        data_fim_str = estado['hoje']
-    resumo.append(carteira_id)
-    resumo.append(carteiras[carteira_id]['designacao'])
-    resumo.append(estado['hoje'])
-    titulos_info = [(mercado[titulo[0]][0], titulo[0], titulo[1], mercado[titulo[0]][1] * titulo[1]) for titulo in carteiras[carteira_id]['titulos']]
-    resumo.append(titulos_info)
-    valor_total = sum(info[3] for info in titulos_info)
-    resumo.append(valor_total)
-    operacoes_info = [(op[0], op[1], op[2], op[3], op[4]) for op in carteiras[carteira_id]['operacoes'] if data_inicio_str <= op[0] <= data_fim_str]
-    resumo.append(operacoes_info)
-    return resumo
+    global estado
+    ordem_id = estado['ordem_id']
+    estado['ordem_id'] += 1
+    return ordem_id
 
 
-def imprime_resumo(resumo):
+def consulta_ordem(ordem_id):
     """
-    Imprime as informações contidas em um resumo de uma carteira de títulos.
+    Devolve uma ordem agendada ou a aguardar o preço limite.
 
     Args:
-    - resumo (list): Lista correspondente ao resumo de uma carteira de títulos, gerada pela função gera_resumo.
+    - ordem_id (int): Identificador da ordem, tal como devolvido por agenda_ordem.
 
     Returns:
-    - None
+    - tuple: A ordem, no formato guardado no livro de ordens, ou None se já foi executada ou cancelada.
     """
-    print("-" * 50)
-    print(f"CARTEIRA #{str(resumo[0]).zfill(6)} / {resumo[1]} {resumo[2]}")
-    print("-" * 50)
-    print(" " * 18 + "** TITULOS **")
-    print("-" * 50)
-    for titulo in resumo[3]:
-        print(f"{titulo[0]:<20}{titulo[1]:<5}{titulo[2]:>9}{titulo[3]:>12.2f}")
-    print("-" * 50)
-    print(f"TOTAL{'':32}{resumo[4]:>12.2f}")
-    print("-" * 50)
-    print(" " * 17 + "** OPERACOES **")
-    print("-" * 50)
-    for operacao in resumo[5]:
-        if all(operacao):
-            print(f"{operacao[0]} {operacao[1]:<8}  {operacao[2]:<5}{operacao[3]:>9}{operacao[4]:>12.2f}")
-    print("-" * 50)
+    return ordens_agendadas.get(ordem_id) or ordens_ativas.get(ordem_id)
 
 
-def carrega_mercado(nome_ficheiro):
+@_persistente
+def cancela_ordem(ordem_id):
     """
-    Processa um ficheiro contendo informações de todos os títulos disponíveis para serem negociados e respetivas cotações.
+    Cancela uma ordem agendada ou a aguardar o preço limite.
 
     Args:
-    - nome_ficheiro (str): Nome do ficheiro a ser processado.
-
-    Raises:
-    - ValueError: Se houver um erro ao abrir o ficheiro.
+    - ordem_id (int): Identificador da ordem, tal como devolvido por agenda_ordem.
 
     Returns:
-    - None
+    - tuple: A ordem cancelada, ou None se já foi executada ou cancelada.
     """
-    try:
-        with open(nome_ficheiro, 'r') as file:
-            mercado.clear()
-            for line in file:
-                # parts = line.strip().split('\t')
-                parts = [x for x in line.strip().split('\t') if x]
-                if len(parts) == 3:
-                    mercado[parts[1]] = {'designacao': parts[0], 'preco': float(parts[2])}
-    except IOError:
-        raise ValueError('erro a abrir o ficheiro')
+    global ordens, ordens_agendadas
+    ordem = ordens_agendadas.pop(ordem_id, None)
+    if ordem is not None:
+        ordens_dia = ordens[ordem[5]]
+        del ordens_dia[ordem_id]
+        if not ordens_dia:
+            del ordens[ordem[5]]
+    else:
+        ordem = _retira_do_livro_limites(ordem_id)
+        if ordem is None:
+            return None
+    _esquece_ordem(ordem_id, ordem)
+    return ordem
 
 
-def carrega_ordens(nome_ficheiro):
+@_persistente
+def cancela_ordens(carteira_id=None, nome_titulo=None):
     """
-    Processa um ficheiro contendo um conjunto de ordens.
+    Cancela, de uma só vez, as ordens agendadas ou a aguardar o preço limite de uma carteira, de um título ou de
+    ambos.
+
+    As ordens são encontradas pelos índices ordens_carteira e ordens_titulo, sem percorrer os livros.
 
     Args:
-    - nome_ficheiro (str): Nome do ficheiro a ser processado.
+    - carteira_id (int): Identificador da carteira.
+    - nome_titulo (str): Nome do título.
 
-    Raises:
-    - ValueError: Se houver um erro ao abrir o ficheiro.
+    Returns:
+    - list: Identificadores das ordens canceladas.
+    """
+    if carteira_id is not None and nome_titulo is not None:
+        ordem_ids = ordens_carteira.get(carteira_id, set()) & ordens_titulo.get(nome_titulo, set())
+    elif carteira_id is not None:
+        ordem_ids = ordens_carteira.get(carteira_id, ())
+    elif nome_titulo is not None:
+        ordem_ids = ordens_titulo.get(nome_titulo, ())
+    else:
+        return []
+    ordem_ids = sorted(ordem_ids)
+    for ordem_id in ordem_ids:
+        cancela_ordem(ordem_id)
+    return ordem_ids
+
+
+@_persistente
+def altera_ordem(ordem_id, quantidade=None, preco_limite=None):
+    """
+    Altera a quantidade ou o preço limite de uma ordem agendada ou a aguardar o preço limite, mantendo o seu
+    identificador e a sua prioridade de chegada.
+
+    Uma ordem a aguardar cujo novo preço limite seja atingido pela cotação atual é executada de imediato.
+
+    Args:
+    - ordem_id (int): Identificador da ordem, tal como devolvido por agenda_ordem.
+    - quantidade (int): Nova quantidade. Por omissão, mantém-se.
+    - preco_limite (float): Novo preço limite. Por omissão, mantém-se.
+
+    Returns:
+    - bool: Valor booleano que indica se a ordem foi alterada.
+    """
+    global ordens, ordens_agendadas, ordens_ativas, livro_limites
+    ordem = consulta_ordem(ordem_id)
+    if ordem is None or (quantidade is not None and quantidade <= 0):
+        return False
+    nova = (ordem[0], ordem[1], ordem[2], ordem[3] if quantidade is None else quantidade,
+            ordem[4] if preco_limite is None else preco_limite, ordem[5])
+    if ordem_id in ordens_agendadas:
+        ordens[ordem[5]][ordem_id] = ordens_agendadas[ordem_id] = nova
+        return True
+    ordens_ativas[ordem_id] = nova
+    if _chave_limite(nova) != _chave_limite(ordem):
+        if _cruza_limite(nova):
+            del ordens_ativas[ordem_id]
+            _esquece_ordem(ordem_id, nova)
+            _liquida_ordens([nova])
+        else:
+            heapq.heappush(livro_limites[nova[2]][nova[1]], (_chave_limite(nova), ordem_id))
+        # A entrada com o limite anterior fica no heap, obsoleta (ver _em_vigor)
+        _marca_obsoleta(nova[2], nova[1])
+    return True
+
+
+def _indexa_ordem(ordem_id, ordem):
+    """
+    Junta uma ordem agendada ou a aguardar aos índices das ordens de cada carteira e de cada título.
+
+    Args:
+    - ordem_id (int): Identificador da ordem.
+    - ordem (tuple): Ordem no formato guardado no livro de ordens.
+
+    Returns:
+    - None
+    """
+    global ordens_carteira, ordens_titulo
+    ordens_carteira.setdefault(ordem[0], set()).add(ordem_id)
+    ordens_titulo.setdefault(ordem[2], set()).add(ordem_id)
+
+
+def _esquece_ordem(ordem_id, ordem):
+    """
+    Retira uma ordem executada ou cancelada dos índices das ordens de cada carteira e de cada título.
+
+    Args:
+    - ordem_id (int): Identificador da ordem.
+    - ordem (tuple): Ordem no formato guardado no livro de ordens.
+
+    Returns:
+    - None
+    """
+    global ordens_carteira, ordens_titulo
+    for indice, chave in ((ordens_carteira, ordem[0]), (ordens_titulo, ordem[2])):
+        ordem_ids = indice.get(chave)
+        if ordem_ids is not None:
+            ordem_ids.discard(ordem_id)
+            if not ordem_ids:
+                del indice[chave]
+
+
+def _cruza_limite(ordem):
+    """
+    Indica se a cotação atual de um título permite executar uma ordem com preço limite.
+
+    Args:
+    - ordem (tuple): Ordem no formato guardado no livro de ordens.
+
+    Returns:
+    - bool: True se não houver limite, se o título não estiver cotado ou se a cotação atingir o limite.
+    """
+    preco_limite = ordem[4]
+    titulo_id = mercado.get(ordem[2])
+    if preco_limite is None or titulo_id is None:
+        return True
+    preco = mercado_precos[titulo_id] / ESCALA_MONETARIA
+    if ordem[1] == 'COMPRA':
+        return preco <= preco_limite
+    return preco >= preco_limite
+
+
+def _coloca_no_livro_limites(ordem, ordem_id):
+    """
+    Coloca uma ordem a aguardar que a cotação do título atinja o seu preço limite.
+
+    As compras ficam ordenadas do limite mais alto para o mais baixo e as vendas do mais baixo para o mais alto,
+    e, para o mesmo limite, pela ordem de chegada.
+
+    Args:
+    - ordem (tuple): Ordem no formato guardado no livro de ordens.
+    - ordem_id (int): Identificador da ordem.
+
+    Returns:
+    - None
+    """
+    global livro_limites, ordens_ativas
+    ordens_ativas[ordem_id] = ordem
+    _indexa_ordem(ordem_id, ordem)
+    livro = livro_limites.setdefault(ordem[2], {'COMPRA': [], 'VENDA': []})
+    heapq.heappush(livro[ordem[1]], (_chave_limite(ordem), ordem_id))
+
+
+def _chave_limite(ordem):
+    """
+    Calcula a chave de uma ordem no heap do livro de limites: o limite, com o sinal trocado nas compras.
+
+    Args:
+    - ordem (tuple): Ordem no formato guardado no livro de ordens.
+
+    Returns:
+    - float: A chave da ordem.
+    """
+    return -ordem[4] if ordem[1] == 'COMPRA' else ordem[4]
+
+
+def _em_vigor(entrada):
+    """
+    Indica se uma entrada de um heap do livro de limites corresponde a uma ordem a aguardar, com esse limite.
+
+    Args:
+    - entrada (tuple): Entrada (chave do limite, ordem_id) do heap.
+
+    Returns:
+    - bool: False se a ordem já foi executada ou cancelada ou se o seu limite foi alterado.
+    """
+    ordem = ordens_ativas.get(entrada[1])
+    return ordem is not None and _chave_limite(ordem) == entrada[0]
+
+
+def _retira_do_livro_limites(ordem_id):
+    """
+    Retira uma ordem do livro de limites. A entrada no heap do título fica obsoleta (ver _marca_obsoleta).
+
+    Args:
+    - ordem_id (int): Identificador da ordem.
+
+    Returns:
+    - tuple: A ordem retirada, ou None se não estava a aguardar no livro.
+    """
+    global ordens_ativas
+    ordem = ordens_ativas.pop(ordem_id, None)
+    if ordem is not None:
+        _marca_obsoleta(ordem[2], ordem[1])
+    return ordem
+
+
+def _marca_obsoleta(nome_titulo, operacao):
+    """
+    Conta uma entrada obsoleta num heap do livro de limites, deixada por uma ordem cancelada, executada por
+    alteração ou com o limite alterado.
+
+    As entradas obsoletas são descartadas quando chegam ao topo do heap; as restantes só quando passam a ser mais
+    do que as entradas em vigor, altura em que o heap é reconstruído apenas com estas. Assim, a memória ocupada
+    pelo heap é no máximo o dobro da das ordens a aguardar, com um custo amortizado constante por entrada.
+
+    Args:
+    - nome_titulo (str): Nome do título.
+    - operacao (str): Lado do livro, 'COMPRA' ou 'VENDA'.
+
+    Returns:
+    - None
+    """
+    global livro_limites, entradas_obsoletas
+    obsoletas = entradas_obsoletas.setdefault(nome_titulo, {'COMPRA': 0, 'VENDA': 0})
+    obsoletas[operacao] += 1
+    heap = livro_limites[nome_titulo][operacao]
+    if 2 * obsoletas[operacao] > len(heap):
+        # Uma ordem alterada para um limite anterior tem entradas repetidas, das quais só uma é mantida
+        heap[:] = set(filter(_em_vigor, heap))
+        heapq.heapify(heap)
+        obsoletas[operacao] = 0
+
+
+def _dispara_ordens(nome_titulo):
+    """
+    Executa, por ordem de chegada, as ordens do livro de limites de um título que a cotação atual permite executar.
+
+    Args:
+    - nome_titulo (str): Nome do título cuja cotação mudou.
+
+    Returns:
+    - set: Identificadores das carteiras das ordens executadas.
+    """
+    global livro_limites, ordens_ativas, entradas_obsoletas
+    livro = livro_limites.get(nome_titulo)
+    if livro is None:
+        return set()
+    preco = preco_titulo(nome_titulo)
+    disparadas = set()
+    obsoletas = entradas_obsoletas.setdefault(nome_titulo, {'COMPRA': 0, 'VENDA': 0})
+    compras, vendas = livro['COMPRA'], livro['VENDA']
+    while compras and (-compras[0][0] >= preco or not _em_vigor(compras[0])):
+        entrada = heapq.heappop(compras)
+        if _em_vigor(entrada) and entrada[1] not in disparadas:
+            disparadas.add(entrada[1])
+        else:
+            obsoletas['COMPRA'] -= 1
+    while vendas and (vendas[0][0] <= preco or not _em_vigor(vendas[0])):
+        entrada = heapq.heappop(vendas)
+        if _em_vigor(entrada) and entrada[1] not in disparadas:
+            disparadas.add(entrada[1])
+        else:
+            obsoletas['VENDA'] -= 1
+    executadas = [ordens_ativas.pop(ordem_id) for ordem_id in sorted(disparadas)]
+    for ordem_id, ordem in zip(sorted(disparadas), executadas):
+        _esquece_ordem(ordem_id, ordem)
+    _liquida_ordens(executadas)
+    return {ordem[0] for ordem in executadas}
+
+
+def gera_resumo(carteira_id, data_inicio_str="", data_fim_str=""):
+    """
+    Gera um resumo da carteira especificada, com as informações correspondentes.
+
+    Args:
+    - carteira_id (int): Identificador da carteira para a qual deve ser gerado o resumo.
+    - data_inicio_str (str): Data de início das operações a incluir no resumo, no formato 'AAAA-MM-DD'.
+    - data_fim_str (str): Data de fim das operações a incluir no resumo, no formato 'AAAA-MM-DD'.
+
+    Returns:
+    - list: Lista contendo o resumo da carteira, com os elementos de informação conforme especificado.
+    """
+    global carteiras, estado, mercado_nomes, OPERACOES
+    resumo = []
+    if not data_inicio_str:
+        data_inicio_str = carteiras[carteira_id].data_abertura
+    if not data_fim_str:
+        data_fim_str = estado['hoje']
+    resumo.append(carteira_id)
+    resumo.append(carteiras[carteira_id].designacao)
+    resumo.append(estado['hoje'])
+    titulos_info = list(_titulos_resumo(carteira_id).values())
+    resumo.append(titulos_info)
+    valor_total = valores_carteiras[carteira_id] / ESCALA_MONETARIA
+    resumo.append(valor_total)
+    periodo = operacoes_periodo(carteira_id, data_inicio_str, data_fim_str)
+    operacoes_info = []
+    for data, codigo, titulo_id, quantidade, valor in zip(*periodo.values()):
+        if titulo_id < 0:
+            operacoes_info.append((datetime.date.fromordinal(data), OPERACOES[codigo], None, None, None))
+        else:
+            operacoes_info.append((datetime.date.fromordinal(data), OPERACOES[codigo], mercado_nomes[titulo_id],
+                                   quantidade, valor / ESCALA_MONETARIA))
+    resumo.append(operacoes_info)
+    return resumo
+
+
+def _titulos_resumo(carteira_id):
+    """
+    Devolve as linhas de títulos do resumo de uma carteira, a partir da cache ou construindo-as e guardando-as na cache.
+
+    Args:
+    - carteira_id (int): Identificador da carteira.
+
+    Returns:
+    - dict: Linha (designacao, nome_titulo, quantidade, valor) de cada título da carteira.
+    """
+    global resumos, _linhas_em_cache
+    linhas = resumos.get(carteira_id)
+    if linhas is not None:
+        resumos.move_to_end(carteira_id)
+        return linhas
+    linhas = {nome_titulo: (designacao_titulo(nome_titulo), nome_titulo, quantidade,
+                            mercado_precos[id_titulo(nome_titulo)] * quantidade / ESCALA_MONETARIA)
+              for nome_titulo, quantidade in carteiras[carteira_id].titulos.items()}
+    resumos[carteira_id] = linhas
+    _linhas_em_cache += len(linhas) + 1
+    while _linhas_em_cache * BYTES_POR_LINHA_RESUMO > LIMITE_CACHE_RESUMOS and len(resumos) > 1:
+        _linhas_em_cache -= len(resumos.popitem(last=False)[1]) + 1
+    return linhas
+
+
+def _atualiza_resumo(carteira_id, nome_titulo):
+    """
+    Atualiza, se estiver em cache, a linha de um título no resumo de uma carteira, após uma operação ou nova cotação.
+
+    Args:
+    - carteira_id (int): Identificador da carteira.
+    - nome_titulo (str): Nome do título cuja posição ou cotação mudou.
+
+    Returns:
+    - None
+    """
+    global _linhas_em_cache
+    linhas = resumos.get(carteira_id)
+    if linhas is None:
+        return
+    quantidade = carteiras[carteira_id].titulos.get(nome_titulo)
+    _linhas_em_cache -= len(linhas)
+    if quantidade:
+        linhas[nome_titulo] = (designacao_titulo(nome_titulo), nome_titulo, quantidade,
+                               mercado_precos[id_titulo(nome_titulo)] * quantidade / ESCALA_MONETARIA)
+    else:
+        linhas.pop(nome_titulo, None)
+    _linhas_em_cache += len(linhas)
+
+
+def _descarta_resumo(carteira_id=None):
+    """
+    Retira da cache o resumo de uma carteira, ou todos os resumos, quando o estado é alterado por outra via.
+
+    Args:
+    - carteira_id (int): Identificador da carteira. Por omissão, todos os resumos são descartados.
+
+    Returns:
+    - None
+    """
+    global resumos, _linhas_em_cache
+    if carteira_id is None:
+        resumos.clear()
+        _linhas_em_cache = 0
+    elif carteira_id in resumos:
+        _linhas_em_cache -= len(resumos.pop(carteira_id)) + 1
+
+
+def formata_resumo(resumo):
+    """
+    Formata as informações contidas em um resumo de uma carteira de títulos, tal como são impressas por imprime_resumo.
+
+    Args:
+    - resumo (list): Lista correspondente ao resumo de uma carteira de títulos, gerada pela função gera_resumo.
+
+    Returns:
+    - str: O texto do resumo, terminado por uma mudança de linha.
+    """
+    linhas = ["-" * 50,
+              f"CARTEIRA #{str(resumo[0]).zfill(6)} / {resumo[1]} {resumo[2]}",
+              "-" * 50,
+              " " * 18 + "** TITULOS **",
+              "-" * 50]
+    for titulo in resumo[3]:
+        linhas.append(f"{titulo[0]:<20}{titulo[1]:<5}{titulo[2]:>9}{titulo[3]:>12.2f}")
+    linhas += ["-" * 50,
+               f"TOTAL{'':32}{resumo[4]:>12.2f}",
+               "-" * 50,
+               " " * 17 + "** OPERACOES **",
+               "-" * 50]
+    for operacao in resumo[5]:
+        if all(operacao):
+            linhas.append(f"{operacao[0]} {operacao[1]:<8}  {operacao[2]:<5}{operacao[3]:>9}{operacao[4]:>12.2f}")
+    linhas.append("-" * 50)
+    linhas.append("")
+    return "\n".join(linhas)
+
+
+def imprime_resumo(resumo):
+    """
+    Imprime as informações contidas em um resumo de uma carteira de títulos.
+
+    Args:
+    - resumo (list): Lista correspondente ao resumo de uma carteira de títulos, gerada pela função gera_resumo.
+
+    Returns:
+    - None
+    """
+    print(formata_resumo(resumo), end="")
+
+
+def grava_resumos(carteira_ids, nome_ficheiro, data_inicio_str="", data_fim_str=""):
+    """
+    Gera os resumos de um conjunto de carteiras e grava-os, uns a seguir aos outros, num único ficheiro.
+
+    Args:
+    - carteira_ids (iterable): Identificadores das carteiras.
+    - nome_ficheiro (str): Nome do ficheiro a criar.
+    - data_inicio_str (str): Data de início das operações a incluir nos resumos, no formato 'AAAA-MM-DD'.
+    - data_fim_str (str): Data de fim das operações a incluir nos resumos, no formato 'AAAA-MM-DD'.
+
+    Raises:
+    - ValueError: Se houver um erro ao criar o ficheiro.
+
+    Returns:
+    - int: Número de resumos gravados.
+    """
+    n = 0
+    try:
+        with open(nome_ficheiro, 'w', buffering=1 << 20) as file:
+            for carteira_id in carteira_ids:
+                file.write(formata_resumo(gera_resumo(carteira_id, data_inicio_str, data_fim_str)))
+                n += 1
+    except IOError:
+        raise ValueError('erro a criar o ficheiro')
+    return n
+
+
+def carrega_mercado(nome_ficheiro, cache=True):
+    """
+    Processa um ficheiro contendo informações de todos os títulos disponíveis para serem negociados e respetivas cotações.
+
+    As colunas (designação, nome do título e cotação) podem estar separadas por tabulações, espaços ou uma mistura
+    de ambos. O resultado da análise é guardado numa cache binária ao lado do ficheiro (nome_ficheiro + '.cache'),
+    usada nas cargas seguintes enquanto o ficheiro de origem não mudar.
+
+    Args:
+    - nome_ficheiro (str): Nome do ficheiro a ser processado.
+    - cache (bool): Se a cache binária deve ser usada e atualizada.
+
+    Raises:
+    - ValueError: Se houver um erro ao abrir o ficheiro.
+
+    Returns:
+    - list: Lista de tuplos (numero_linha, motivo) com as linhas rejeitadas.
+    """
+    try:
+        with open(nome_ficheiro, 'rb') as file:
+            info = os.fstat(file.fileno())
+            chave = (info.st_mtime_ns, info.st_size)
+            mercado_lido = _le_cache_mercado(nome_ficheiro + '.cache', chave) if cache else None
+            if mercado_lido is None:
+                dados = file.read()
+                resumo_dados = hashlib.blake2b(dados, digest_size=16).digest()
+                if cache:
+                    mercado_lido = _le_cache_mercado(nome_ficheiro + '.cache', chave, resumo_dados)
+                if mercado_lido is None:
+                    mercado_lido = _analisa_mercado(dados.decode())
+                    if cache:
+                        _grava_cache_mercado(nome_ficheiro + '.cache', chave, resumo_dados, mercado_lido)
+    except IOError:
+        raise ValueError('erro a abrir o ficheiro')
+    nomes, designacoes, precos, rejeitadas = mercado_lido
+    # Só são aplicadas, e registadas no diário, as designações e cotações que mudaram desde a última carga
+    ids = list(map(mercado.get, nomes))
+    novas_designacoes = [(nome_titulo, designacao)
+                         for nome_titulo, designacao, titulo_id in zip(nomes, designacoes, ids)
+                         if titulo_id is None or mercado_designacoes[titulo_id] != designacao]
+    novas_cotacoes = [(nome_titulo, preco) for nome_titulo, preco, titulo_id in zip(nomes, precos, ids)
+                      if titulo_id is None or mercado_precos[titulo_id] != _unidades(preco)]
+    if novas_designacoes:
+        _define_titulos(novas_designacoes)
+    if novas_cotacoes:
+        atualiza_precos(novas_cotacoes)
+    return rejeitadas
+
+
+def _analisa_mercado(texto):
+    """
+    Analisa o conteúdo de um ficheiro de mercado, com uma linha por título.
+
+    As colunas são separadas por tabulações; quando isso não resulta em três colunas, a cotação e o nome do título
+    são as duas últimas palavras da linha e a designação é o texto que as antecede.
+
+    Args:
+    - texto (str): Conteúdo do ficheiro.
+
+    Returns:
+    - tuple: Nomes dos títulos, designações, cotações (array) e lista de tuplos (numero_linha, motivo) com as
+      linhas rejeitadas.
+    """
+    nomes = []
+    designacoes = []
+    precos = array('d')
+    rejeitadas = []
+    for n_linha, linha in enumerate(texto.splitlines(), 1):
+        campos = _campos_tabulados(linha)
+        if len(campos) != 3:
+            campos = linha.rsplit(None, 2)
+        if not campos:
+            continue  # linha em branco
+        if len(campos) != 3 or not campos[0]:
+            rejeitadas.append((n_linha, 'numero de campos invalido'))
+            continue
+        designacao, nome_titulo, cotacao = campos
+        if len(nome_titulo.split()) != 1:
+            rejeitadas.append((n_linha, 'titulo invalido'))
+            continue
+        try:
+            preco = float(cotacao)
+        except ValueError:
+            preco = -1.0
+        if not math.isfinite(preco) or preco < 0:
+            rejeitadas.append((n_linha, 'cotacao invalida'))
+            continue
+        nomes.append(nome_titulo)
+        designacoes.append(designacao)
+        precos.append(preco)
+    return nomes, designacoes, precos, rejeitadas
+
+
+def _le_cache_mercado(nome_cache, chave, resumo_dados=None):
+    """
+    Lê a cache binária de um ficheiro de mercado, se corresponder à versão atual do ficheiro de origem.
+
+    A cache é válida se o mtime e o tamanho do ficheiro de origem forem os guardados ou, caso resumo_dados seja
+    dado, se o hash do conteúdo coincidir.
+
+    Args:
+    - nome_cache (str): Nome do ficheiro da cache.
+    - chave (tuple): mtime, em nanossegundos, e tamanho do ficheiro de origem.
+    - resumo_dados (bytes): Hash do conteúdo do ficheiro de origem.
+
+    Returns:
+    - tuple: O mesmo que _analisa_mercado, ou None se a cache não existir, estiver corrompida ou desatualizada.
+    """
+    try:
+        with open(nome_cache, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as dados:
+            (formato, mtime, tamanho, resumo, n_titulos, n_rejeitadas,
+             len_nomes, len_designacoes, len_motivos) = CABECALHO_CACHE_MERCADO.unpack_from(dados)
+            if formato != FORMATO_CACHE_MERCADO:
+                return None
+            if (resumo != resumo_dados) if resumo_dados is not None else ((mtime, tamanho) != chave):
+                return None
+            inicio = CABECALHO_CACHE_MERCADO.size
+            precos = array('d', dados[inicio:inicio + 8 * n_titulos])
+            inicio += 8 * n_titulos
+            linhas = array('i', dados[inicio:inicio + 4 * n_rejeitadas])
+            inicio += 4 * n_rejeitadas
+            blocos = []
+            for comprimento in (len_nomes, len_designacoes, len_motivos):
+                blocos.append(dados[inicio:inicio + comprimento].decode())
+                inicio += comprimento
+            if inicio != len(dados):
+                return None
+    except (OSError, ValueError, struct.error):
+        return None
+    nomes = blocos[0].split('\n') if n_titulos else []
+    designacoes = blocos[1].split('\n') if n_titulos else []
+    motivos = blocos[2].split('\n') if n_rejeitadas else []
+    return nomes, designacoes, precos, list(zip(linhas, motivos))
+
+
+def _grava_cache_mercado(nome_cache, chave, resumo_dados, mercado_lido):
+    """
+    Grava a cache binária de um ficheiro de mercado. Uma falha na gravação não impede a carga do mercado.
+
+    Args:
+    - nome_cache (str): Nome do ficheiro da cache.
+    - chave (tuple): mtime, em nanossegundos, e tamanho do ficheiro de origem.
+    - resumo_dados (bytes): Hash do conteúdo do ficheiro de origem.
+    - mercado_lido (tuple): Resultado de _analisa_mercado.
+
+    Returns:
+    - None
+    """
+    nomes, designacoes, precos, rejeitadas = mercado_lido
+    blocos = ['\n'.join(nomes).encode(), '\n'.join(designacoes).encode(),
+              '\n'.join(motivo for _, motivo in rejeitadas).encode()]
+    cabecalho = CABECALHO_CACHE_MERCADO.pack(FORMATO_CACHE_MERCADO, *chave, resumo_dados, len(precos),
+                                             len(rejeitadas), *map(len, blocos))
+    temporario = nome_cache + '.tmp'
+    try:
+        with open(temporario, 'wb') as file:
+            file.write(cabecalho)
+            file.write(precos.tobytes())
+            file.write(array('i', [n_linha for n_linha, _ in rejeitadas]).tobytes())
+            for bloco in blocos:
+                file.write(bloco)
+        os.replace(temporario, nome_cache)
+    except OSError:
+        pass
+
+
+@_persistente
+def _define_titulos(designacoes):
+    """
+    Regista ou atualiza a designação de um conjunto de títulos.
+
+    Args:
+    - designacoes (list): Pares (nome_titulo, designacao).
 
     Returns:
     - None
     """
+    global mercado_designacoes
+    for nome_titulo, designacao in designacoes:
+        titulo_id = _interna_titulo(nome_titulo)
+        if mercado_designacoes[titulo_id] != designacao:
+            mercado_designacoes[titulo_id] = designacao
+            _descarta_resumo()
+
+
+@_persistente
+def atualiza_precos(ticks):
+    """
+    Aplica um lote de novas cotações, revalorizando apenas as carteiras que detêm os títulos alterados.
+
+    Args:
+    - ticks (iterable): Pares (nome_titulo, preco) com as novas cotações, em euros.
+
+    As ordens do livro de limites que as novas cotações permitem executar são executadas de seguida.
+
+    Returns:
+    - set: Identificadores das carteiras cujo valor foi alterado.
+    """
+    global mercado_precos, detentores, carteiras
+    alteradas = set()
+    for nome_titulo, preco in ticks:
+        titulo_id = _interna_titulo(nome_titulo)
+        preco = _unidades(preco)
+        delta_preco = preco - mercado_precos[titulo_id]
+        mercado_precos[titulo_id] = preco
+        if not delta_preco:
+            continue
+        for carteira_id in detentores.get(nome_titulo, ()):
+            _ajusta_valor(carteira_id, delta_preco * carteiras[carteira_id].titulos[nome_titulo])
+            _atualiza_resumo(carteira_id, nome_titulo)
+            alteradas.add(carteira_id)
+        alteradas |= _dispara_ordens(nome_titulo)
+    return alteradas
+
+
+def _interna_titulo(nome_titulo):
+    """
+    Devolve o identificador interno de um título, atribuindo-lhe um novo se ainda não for conhecido.
+
+    Os identificadores são estáveis: um título que deixe de constar de um ficheiro de mercado mantém o seu
+    identificador e a última cotação conhecida.
+
+    Args:
+    - nome_titulo (str): Nome do título.
+
+    Returns:
+    - int: Identificador interno do título.
+    """
+    global mercado, mercado_nomes, mercado_designacoes, mercado_precos
+    titulo_id = mercado.get(nome_titulo)
+    if titulo_id is None:
+        titulo_id = mercado[nome_titulo] = len(mercado_precos)
+        mercado_nomes.append(nome_titulo)
+        mercado_designacoes.append('')
+        mercado_precos.append(0)
+    return titulo_id
+
+
+def id_titulo(nome_titulo):
+    """
+    Devolve o identificador interno de um título cotado.
+
+    Args:
+    - nome_titulo (str): Nome do título.
+
+    Raises:
+    - ValueError: Se o título não existir no mercado.
+
+    Returns:
+    - int: Identificador interno do título, índice de mercado_precos e mercado_designacoes.
+    """
+    try:
+        return mercado[nome_titulo]
+    except KeyError:
+        raise ValueError('titulo inexistente')
+
+
+def preco_titulo(nome_titulo):
+    """
+    Devolve a cotação atual de um título.
+
+    Args:
+    - nome_titulo (str): Nome do título.
+
+    Raises:
+    - ValueError: Se o título não existir no mercado.
+
+    Returns:
+    - float: Cotação atual do título, em euros.
+    """
+    return mercado_precos[id_titulo(nome_titulo)] / ESCALA_MONETARIA
+
+
+def designacao_titulo(nome_titulo):
+    """
+    Devolve a designação de um título.
+
+    Args:
+    - nome_titulo (str): Nome do título.
+
+    Raises:
+    - ValueError: Se o título não existir no mercado.
+
+    Returns:
+    - str: Designação do título.
+    """
+    return mercado_designacoes[id_titulo(nome_titulo)]
+
+
+def precos_titulos(titulo_ids):
+    """
+    Devolve as cotações de um conjunto de títulos, dados os seus identificadores internos.
+
+    Args:
+    - titulo_ids (iterable): Identificadores internos dos títulos.
+
+    Returns:
+    - array: Cotações dos títulos, em euros, pela mesma ordem dos identificadores.
+    """
+    return array('d', [preco / ESCALA_MONETARIA for preco in map(mercado_precos.__getitem__, titulo_ids)])
+
+
+def valor_titulos(titulos):
+    """
+    Calcula o valor de mercado de um conjunto de posições.
+
+    Args:
+    - titulos (iterable): Pares (nome_titulo, quantidade).
+
+    Raises:
+    - ValueError: Se algum dos títulos não existir no mercado.
+
+    Returns:
+    - float: Soma das quantidades multiplicadas pelas cotações atuais.
+    """
+    return _valor_posicoes(titulos) / ESCALA_MONETARIA
+
+
+def _valor_posicoes(titulos):
+    """
+    Calcula, de forma exata, o valor de mercado de um conjunto de posições.
+
+    Args:
+    - titulos (iterable): Pares (nome_titulo, quantidade).
+
+    Raises:
+    - ValueError: Se algum dos títulos não existir no mercado.
+
+    Returns:
+    - int: Soma das quantidades multiplicadas pelas cotações atuais, em unidades monetárias.
+    """
+    precos = mercado_precos
+    return sum(precos[id_titulo(nome_titulo)] * quantidade for nome_titulo, quantidade in titulos)
+
+
+def _campos_tabulados(linha):
+    """
+    Separa os campos de uma linha por tabuladores, sem os espaços à volta de cada campo e ignorando os campos vazios.
+
+    Args:
+    - linha (str): Linha a separar.
+
+    Returns:
+    - list: Campos não vazios da linha.
+    """
+    return [campo.strip() for campo in linha.split('\t') if campo and not campo.isspace()]
+
+
+def carrega_ordens(nome_ficheiro, tamanho_bloco=TAMANHO_BLOCO):
+    """
+    Processa um ficheiro contendo um conjunto de ordens, lido em blocos de linhas de tamanho fixo.
+
+    Args:
+    - nome_ficheiro (str): Nome do ficheiro a ser processado.
+    - tamanho_bloco (int): Número de linhas lidas e validadas de cada vez.
+
+    Raises:
+    - ValueError: Se houver um erro ao abrir o ficheiro.
+
+    Returns:
+    - list: Lista de tuplos (numero_linha, motivo) com as linhas rejeitadas.
+    """
+    rejeitadas = []
+    # As ordens carregadas não formam ciclos; suspender o GC evita varrimentos repetidos do livro durante a carga
+    gc_ativo = gc.isenabled()
+    gc.disable()
     try:
         with open(nome_ficheiro, 'r') as file:
-            for line in file:
-                parts = line.strip().split('\t')
-                if len(parts) == 5:
-                    carteira_id = int(parts[0])
-                    operacao = 'COMPRA' if int(parts[2]) > 0 else 'VENDA'
-                    nome_titulo = parts[1]
-                    quantidade = abs(int(parts[2]))
-                    preco_limite = float(parts[3])
-                    data_str = parts[4]
-                    agenda_ordem(carteira_id, operacao, nome_titulo, quantidade, preco_limite, data_str)
+            n_linha = 1
+            while True:
+                linhas = list(itertools.islice(file, tamanho_bloco))
+                if not linhas:
+                    break
+                _carrega_bloco_ordens(linhas, n_linha, rejeitadas)
+                n_linha += len(linhas)
     except IOError:
         raise ValueError('erro a abrir o ficheiro')
+    finally:
+        if gc_ativo:
+            gc.enable()
+    rejeitadas.sort()
+    return rejeitadas
+
+
+def _carrega_bloco_ordens(linhas, primeira_linha, rejeitadas):
+    """
+    Converte, valida e agenda um bloco de linhas de um ficheiro de ordens.
+
+    Args:
+    - linhas (list): Linhas do bloco, tal como lidas do ficheiro.
+    - primeira_linha (int): Número da primeira linha do bloco no ficheiro.
+    - rejeitadas (list): Lista onde são acrescentados os tuplos (numero_linha, motivo) das linhas rejeitadas.
+
+    Returns:
+    - None
+    """
+    futuras, do_dia = _valida_bloco_ordens(linhas, primeira_linha, rejeitadas)
+    _insere_ordens(futuras)
+
+    # As ordens para o dia atual são executadas de imediato, tal como em agenda_ordem
+    a_aguardar = []
+    for n_linha, ordem in do_dia:
+        if not _cruza_limite(ordem):
+            a_aguardar.append(ordem)
+            continue
+        try:
+            processa_operacao(ordem[0], ordem[1], ordem[2], ordem[3])
+        except ValueError as erro:
+            rejeitadas.append((n_linha, str(erro)))
+    if a_aguardar:
+        _aguarda_ordens(a_aguardar)
+
+
+def _valida_bloco_ordens(linhas, primeira_linha, rejeitadas):
+    """
+    Converte e valida um bloco de linhas de um ficheiro de ordens, sem alterar o livro de ordens.
+
+    Args:
+    - linhas (list): Linhas do bloco, tal como lidas do ficheiro.
+    - primeira_linha (int): Número da primeira linha do bloco no ficheiro.
+    - rejeitadas (list): Lista onde são acrescentados os tuplos (numero_linha, motivo) das linhas rejeitadas.
+
+    Returns:
+    - tuple: Lista das ordens válidas para dias futuros e lista de tuplos (numero_linha, ordem) das ordens válidas
+      para o dia atual, no formato guardado no livro de ordens e pela ordem das linhas.
+    """
+    global estado, ordens, carteiras, mercado
+    texto = ''.join(linhas)
+    if BLOCO_ORDENS_REGULAR.fullmatch(texto):
+        # Bloco bem formado, com cinco campos em cada linha: as colunas obtêm-se diretamente por fatias
+        campos = texto.split()
+        numeros = range(primeira_linha, primeira_linha + len(linhas))
+        col_carteira, col_titulo, col_quantidade, col_preco, col_data = (campos[i::5] for i in range(5))
+    else:
+        # Os campos de cada linha são normalizados como em carrega_mercado, para que o resultado de uma linha não
+        # dependa de as restantes linhas do bloco serem ou não bem formadas
+        numeros = []
+        campos = []
+        for n_linha, line in enumerate(linhas, primeira_linha):
+            parts = _campos_tabulados(line)
+            if len(parts) == 5:
+                numeros.append(n_linha)
+                campos.append(parts)
+            elif parts:
+                rejeitadas.append((n_linha, 'numero de campos invalido'))
+        if not campos:
+            return [], []
+        col_carteira, col_titulo, col_quantidade, col_preco, col_data = zip(*campos)
+
+    # Conversão por colunas; só se recorre à conversão linha a linha se o bloco tiver valores inválidos
+    try:
+        carteira_ids = list(map(int, col_carteira))
+        quantidades = list(map(int, col_quantidade))
+        precos = list(map(float, col_preco))
+    except ValueError:
+        carteira_ids, quantidades, precos = [], [], []
+        validos = []
+        for i, valores in enumerate(zip(col_carteira, col_quantidade, col_preco)):
+            try:
+                valores = (int(valores[0]), int(valores[1]), float(valores[2]))
+            except ValueError:
+                rejeitadas.append((numeros[i], 'valor numerico invalido'))
+                continue
+            carteira_ids.append(valores[0])
+            quantidades.append(valores[1])
+            precos.append(valores[2])
+            validos.append(i)
+        numeros = [numeros[i] for i in validos]
+        col_titulo = [col_titulo[i] for i in validos]
+        col_data = [col_data[i] for i in validos]
+    if not numeros:
+        return [], []
+
+    # As datas repetem-se muito num ficheiro de ordens; cada data distinta é validada uma só vez. Só o formato
+    # 'AAAA-MM-DD' é aceite, pois é a chave do livro de ordens procurada por inicia_dia
+    hoje_str = str(estado['hoje'])
+    datas_validas = set()
+    for data_str in set(col_data):
+        try:
+            if str(datetime.date.fromisoformat(data_str)) != data_str:
+                continue
+        except ValueError:
+            continue
+        datas_validas.add(data_str)
+
+    operacoes = ['COMPRA' if quantidade > 0 else 'VENDA' for quantidade in quantidades]
+    novas = zip(carteira_ids, operacoes, col_titulo, map(abs, quantidades), precos, col_data)
+    if (all(map(carteiras.__contains__, carteira_ids)) and all(map(mercado.__contains__, col_titulo))
+            and all(quantidades) and datas_validas.issuperset(col_data) and min(col_data) > hoje_str):
+        # Bloco inteiramente válido e sem ordens para o dia atual: todas as ordens seguem diretamente para o livro
+        return list(novas), []
+
+    futuras = []
+    do_dia = []
+    for n_linha, ordem in zip(numeros, novas):
+        carteira_id, nome_titulo, data_str = ordem[0], ordem[2], ordem[5]
+        if carteira_id not in carteiras:
+            rejeitadas.append((n_linha, 'carteira inexistente'))
+        elif nome_titulo not in mercado:
+            rejeitadas.append((n_linha, 'titulo inexistente'))
+        elif ordem[3] == 0:
+            rejeitadas.append((n_linha, 'quantidade nula'))
+        elif data_str not in datas_validas:
+            rejeitadas.append((n_linha, 'data invalida'))
+        elif data_str < hoje_str:
+            rejeitadas.append((n_linha, 'data passada'))
+        elif data_str == hoje_str:
+            do_dia.append((n_linha, ordem))
+        else:
+            futuras.append(ordem)
+    return futuras, do_dia
+
+
+@_persistente
+def _insere_ordens(novas):
+    """
+    Insere no livro um lote de ordens já validadas, cada uma no dia em que deve ser executada, atribuindo a cada uma
+    o seu identificador.
+
+    Args:
+    - novas (list): Ordens a inserir, no formato guardado no livro de ordens.
+
+    Returns:
+    - None
+    """
+    global estado, ordens, ordens_agendadas
+    ordem_id = estado['ordem_id']
+    dias = {}
+    for ordem in novas:
+        data_str = ordem[5]
+        if data_str not in dias:
+            dias[data_str] = ordens.setdefault(data_str, {})
+        dias[data_str][ordem_id] = ordens_agendadas[ordem_id] = ordem
+        _indexa_ordem(ordem_id, ordem)
+        ordem_id += 1
+    estado['ordem_id'] = ordem_id
+
+
+@_persistente
+def _aguarda_ordens(novas):
+    """
+    Coloca no livro de limites um lote de ordens do dia já validadas, cujo preço limite não é atingido pela cotação
+    atual, atribuindo a cada uma o seu identificador.
+
+    Args:
+    - novas (list): Ordens a colocar, no formato guardado no livro de ordens.
+
+    Returns:
+    - None
+    """
+    for ordem in novas:
+        _coloca_no_livro_limites(ordem, _nova_ordem_id())
 
 
-def inicia_dia(data_str=""):
+@_persistente
+def inicia_dia(data_str="", processos=1):
     """
-    Atualiza a data atual e processa as operações agendadas para o dia.
+    Atualiza a data atual e processa as operações agendadas para o dia. As ordens cujo preço limite não é atingido
+    pela cotação atual ficam a aguardar no livro de limites.
 
     Args:
     - data_str (str): Nova data atual no formato 'AAAA-MM-DD'.
+    - processos (int): Número de processos pelos quais as ordens do dia são repartidas (ver paralelo.py).
 
     Returns:
     - None
     """
-    global estado
+    global estado, ordens, ordens_agendadas
     if data_str:
         estado['hoje'] = datetime.date.fromisoformat(data_str)
     else:
         estado['hoje'] = estado['hoje'] + datetime.timedelta(days=1)
 
-    for ordem in ordens[:]:
-        if ordem[5] == str(estado['hoje']):
-            try:
-                processa_operacao(ordem[0], ordem[1], ordem[2], ordem[3])
-                ordens.remove(ordem)
-            except ValueError:
-                ordens.remove(ordem)
+    # Retira do livro apenas as ordens do dia; as restantes não são percorridas
+    # As cotações não mudam durante a abertura: as ordens cujo limite não é atingido passam logo para o livro de limites
+    executaveis = []
+    for ordem_id, ordem in ordens.pop(str(estado['hoje']), {}).items():
+        del ordens_agendadas[ordem_id]
+        if _cruza_limite(ordem):
+            executaveis.append(ordem)
+            _esquece_ordem(ordem_id, ordem)
+        else:
+            _coloca_no_livro_limites(ordem, ordem_id)
+    if processos > 1:
+        import paralelo
+        paralelo.executa_ordens(executaveis, processos)
+        return
+    _liquida_ordens(executaveis)
+
+
+def _liquida_ordens(lote):
+    """
+    Executa um lote de ordens retiradas do livro de ordens, com o mesmo resultado que processa_operacao chamada para
+    cada uma, pela ordem do lote. As ordens que não podem ser realizadas, por falta de fundos, de títulos ou porque a
+    carteira entretanto foi encerrada, são descartadas.
+
+    As ordens são liquidadas uma a uma, pois os fundos de cada compra dependem das ordens anteriores do lote; os
+    movimentos de saldo são feitos diretamente no array saldos, em unidades monetárias inteiras, sem passar pelas
+    validações e pelo registo de processa_operacao.
+
+    Args:
+    - lote (list): Ordens no formato guardado no livro de ordens.
+
+    Returns:
+    - None
+    """
+    global saldos
+    codigos = {operacao: OPERACOES.index(operacao) for operacao in ('COMPRA', 'VENDA')}
+    for carteira_id, operacao, nome_titulo, quantidade, _, _ in lote:
+        carteira = carteiras.get(carteira_id)
+        titulo_id = mercado.get(nome_titulo)
+        if carteira is None or titulo_id is None:
+            continue
+        titulares = _titulares(carteira_id)
+        if operacao == 'COMPRA':
+            valor_total = mercado_precos[titulo_id] * quantidade
+            partes = _divide_valor(valor_total, len(titulares))
+            if any(saldos[titular_id] < parte for titular_id, parte in zip(titulares, partes)):
+                continue
+            for titular_id, parte in zip(titulares, partes):
+                saldos[titular_id] -= parte
+            _movimenta_titulo(carteira_id, nome_titulo, quantidade)
+        elif operacao == 'VENDA':
+            detida = carteira.titulos.get(nome_titulo)
+            if not detida:
                 continue
+            quantidade = min(quantidade, detida)
+            valor_total = mercado_precos[titulo_id] * quantidade
+            for titular_id, parte in zip(titulares, _divide_valor(valor_total, len(titulares))):
+                saldos[titular_id] += parte
+            _movimenta_titulo(carteira_id, nome_titulo, -quantidade)
+        else:
+            continue
+        _anota_operacao(carteira, codigos[operacao], titulo_id, quantidade, valor_total)
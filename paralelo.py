@@ -0,0 +1,154 @@
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import p2
+
+ORDENS_MINIMAS = 10_000  # abaixo deste número de ordens do dia, a repartição por processos não compensa
+
+
+def _agrupa_ordens(ordens_dia):
+    """
+    Agrupa as ordens do dia pelas componentes ligadas de clientes e carteiras: duas ordens ficam no mesmo grupo se
+    as suas carteiras partilharem, direta ou indiretamente, algum titular.
+
+    As ordens de carteiras que já não existem são descartadas, tal como em p2._liquida_ordens.
+
+    Args:
+    - ordens_dia (list): Ordens do dia, no formato guardado no livro de ordens.
+
+    Returns:
+    - list: Grupos de ordens independentes entre si, cada um pela ordem original.
+    """
+    pai = {}
+
+    def raiz(cliente_id):
+        while pai.setdefault(cliente_id, cliente_id) != cliente_id:
+            pai[cliente_id] = pai[pai[cliente_id]]
+            cliente_id = pai[cliente_id]
+        return cliente_id
+
+    validas = [ordem for ordem in ordens_dia if ordem[0] in p2.carteiras]
+    for carteira_id in {ordem[0] for ordem in validas}:
+        titulares = p2._titulares(carteira_id)
+        primeiro = raiz(titulares[0])
+        for titular_id in titulares[1:]:
+            pai[raiz(titular_id)] = primeiro
+
+    grupos = {}
+    for ordem in validas:
+        grupos.setdefault(raiz(p2._titulares(ordem[0])[0]), []).append(ordem)
+    return list(grupos.values())
+
+
+def _reparte(grupos, n_tarefas):
+    """
+    Reparte grupos de ordens por um número de tarefas, equilibrando o número de ordens de cada tarefa.
+
+    Args:
+    - grupos (list): Grupos de ordens independentes entre si.
+    - n_tarefas (int): Número de tarefas a criar.
+
+    Returns:
+    - list: Tarefas não vazias, cada uma com as ordens dos seus grupos.
+    """
+    tarefas = [[] for _ in range(n_tarefas)]
+    cargas = [(0, i) for i in range(n_tarefas)]
+    for grupo in sorted(grupos, key=len, reverse=True):
+        carga, i = heapq.heappop(cargas)
+        tarefas[i].extend(grupo)
+        heapq.heappush(cargas, (carga + len(grupo), i))
+    return [tarefa for tarefa in tarefas if tarefa]
+
+
+def _inicia_processo():
+    """
+    Prepara um processo do conjunto: as operações executadas nos processos não são registadas no diário de escrita,
+    pois a chamada a inicia_dia que as originou já o foi.
+
+    Returns:
+    - None
+    """
+    p2.diario_escrita = None
+
+
+def _executa_tarefa(ordens_tarefa):
+    """
+    Executa, num processo do conjunto, as ordens de uma tarefa sobre a cópia do estado herdada do processo principal.
+
+    Args:
+    - ordens_tarefa (list): Ordens a executar, pela ordem em que seriam executadas em série.
+
+    Returns:
+    - tuple: Estado final das carteiras (titulos, valor e operações acrescentadas ao diário) e dos clientes
+      (saldo e valor dos títulos) envolvidos.
+    """
+    carteira_ids = {ordem[0] for ordem in ordens_tarefa}
+    cliente_ids = {titular_id for carteira_id in carteira_ids for titular_id in p2._titulares(carteira_id)}
+    inicio_diario = {carteira_id: len(p2.carteiras[carteira_id].operacoes) for carteira_id in carteira_ids}
+
+    p2._liquida_ordens(ordens_tarefa)
+
+    estado_carteiras = {}
+    for carteira_id in carteira_ids:
+        carteira = p2.carteiras[carteira_id]
+        inicio = inicio_diario[carteira_id]
+        novas_operacoes = p2._linhas_diario(carteira.operacoes[inicio:])
+        estado_carteiras[carteira_id] = (carteira.titulos, p2.valores_carteiras[carteira_id], novas_operacoes)
+    estado_clientes = {cliente_id: (p2.saldos[cliente_id], p2.valores_titulos[cliente_id]) for cliente_id in cliente_ids}
+    return estado_carteiras, estado_clientes
+
+
+def _aplica(estado_carteiras, estado_clientes):
+    """
+    Aplica ao estado do processo principal o resultado de uma tarefa.
+
+    Args:
+    - estado_carteiras (dict): Estado final das carteiras da tarefa, tal como devolvido por _executa_tarefa.
+    - estado_clientes (dict): Estado final dos clientes da tarefa, tal como devolvido por _executa_tarefa.
+
+    Returns:
+    - None
+    """
+    for carteira_id, (titulos, valor, novas_operacoes) in estado_carteiras.items():
+        carteira = p2.carteiras[carteira_id]
+        for nome_titulo in carteira.titulos.keys() - titulos.keys():
+            p2.detentores[nome_titulo].discard(carteira_id)
+        for nome_titulo in titulos.keys() - carteira.titulos.keys():
+            p2.detentores.setdefault(nome_titulo, set()).add(carteira_id)
+        carteira.titulos = titulos
+        p2.valores_carteiras[carteira_id] = valor
+        p2._descarta_resumo(carteira_id)
+        for operacao in novas_operacoes:
+            p2._acrescenta_linha(carteira, *operacao)
+    for cliente_id, (saldo, valor_titulos) in estado_clientes.items():
+        p2.saldos[cliente_id] = saldo
+        p2.valores_titulos[cliente_id] = valor_titulos
+
+
+def executa_ordens(ordens_dia, processos):
+    """
+    Executa as ordens do dia repartidas por um conjunto de processos.
+
+    As ordens são agrupadas de modo a que cada cliente e cada carteira sejam alterados por um único processo, que
+    executa as suas ordens pela ordem original; o estado final é por isso idêntico ao da execução em série. Os
+    processos são criados por fork e partilham, sem cópia, o estado do processo principal.
+
+    Args:
+    - ordens_dia (list): Ordens do dia, no formato guardado no livro de ordens.
+    - processos (int): Número máximo de processos a usar.
+
+    Returns:
+    - None
+    """
+    grupos = _agrupa_ordens(ordens_dia)
+    if len(ordens_dia) < ORDENS_MINIMAS or len(grupos) < 2:
+        p2._liquida_ordens(ordens_dia)
+        return
+
+    tarefas = _reparte(grupos, processos)
+    contexto = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(len(tarefas), mp_context=contexto, initializer=_inicia_processo) as executor:
+        resultados = list(executor.map(_executa_tarefa, tarefas))
+    for estado_carteiras, estado_clientes in resultados:
+        _aplica(estado_carteiras, estado_clientes)
@@ -0,0 +1,284 @@
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+
+import p2
+
+# Cada registo do diário é precedido do seu comprimento e do CRC32 dos dados
+CABECALHO = struct.Struct('<II')
+REGISTO_ESTADO = '__estado__'  # nome do registo com o estado completo de p2, gravado ao ativar o diário
+
+
+class DiarioEscrita:
+    """
+    Diário de escrita antecipada: grava cada operação que altera o estado de p2 antes de esta ser executada.
+
+    Cada registo é entregue ao sistema operativo (write) antes de a operação ser executada, pelo que sobrevive ao
+    fim abrupto do processo. A escrita em disco (fsync) é feita em grupo: por uma tarefa em segundo plano, a cada
+    intervalo_sync segundos com registos pendentes, e pela própria chamada quando se juntam registos_por_sync
+    registos. Uma falha do sistema perde, no máximo, os registos dos últimos intervalo_sync segundos.
+    """
+
+    def __init__(self, caminho, registos_por_sync=1000, intervalo_sync=0.05):
+        self.caminho = caminho
+        self.registos_por_sync = registos_por_sync
+        self.intervalo_sync = intervalo_sync
+        self.ficheiro = open(caminho, 'ab', buffering=0)
+        self.pendentes = 0
+        self.trinco = threading.Lock()
+        self.parar = threading.Event()
+        self.sincronizador = threading.Thread(target=self._sincroniza_periodicamente, daemon=True)
+        self.sincronizador.start()
+
+    def __call__(self, nome, args, kwargs):
+        dados = pickle.dumps((nome, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        with self.trinco:
+            self.ficheiro.write(CABECALHO.pack(len(dados), zlib.crc32(dados)) + dados)
+            self.pendentes += 1
+            if self.pendentes >= self.registos_por_sync:
+                self._sincroniza()
+
+    def _sincroniza_periodicamente(self):
+        """
+        Tarefa em segundo plano: sincroniza os registos pendentes a cada intervalo_sync segundos, até o diário ser
+        fechado.
+
+        Returns:
+        - None
+        """
+        while not self.parar.wait(self.intervalo_sync):
+            with self.trinco:
+                if self.pendentes:
+                    self._sincroniza()
+
+    def posicao(self):
+        """
+        Devolve a posição atual no ficheiro do diário.
+
+        Returns:
+        - int: Número de bytes já escritos no diário.
+        """
+        with self.trinco:
+            return self.ficheiro.tell()
+
+    def sincroniza(self):
+        """
+        Força a escrita em disco dos registos pendentes.
+
+        Returns:
+        - None
+        """
+        with self.trinco:
+            self._sincroniza()
+
+    def _sincroniza(self):
+        """
+        Força a escrita em disco dos registos pendentes; chamada com o trinco do diário.
+
+        Returns:
+        - None
+        """
+        os.fsync(self.ficheiro.fileno())
+        self.pendentes = 0
+
+    def fecha(self):
+        """
+        Termina a tarefa de sincronização, sincroniza e fecha o ficheiro do diário.
+
+        Returns:
+        - None
+        """
+        self.parar.set()
+        self.sincronizador.join()
+        self.sincroniza()
+        self.ficheiro.close()
+
+
+def ativa_diario(caminho, registos_por_sync=1000, intervalo_sync=0.05):
+    """
+    Passa a registar no diário indicado todas as operações que alteram o estado de p2.
+
+    O primeiro registo é o estado completo de p2 no momento da ativação, para que o diário baste, sozinho, para
+    reconstruir o estado (ver recupera), mesmo que já houvesse clientes, ordens ou uma data atual definida.
+
+    Args:
+    - caminho (str): Caminho do ficheiro do diário; os registos são acrescentados ao fim do ficheiro.
+    - registos_por_sync (int): Número máximo de registos entre sincronizações com o disco.
+    - intervalo_sync (float): Tempo máximo, em segundos, entre sincronizações com o disco.
+
+    Returns:
+    - DiarioEscrita: O diário ativo.
+    """
+    desativa_diario()
+    diario = DiarioEscrita(caminho, registos_por_sync, intervalo_sync)
+    diario(REGISTO_ESTADO, ({nome: getattr(p2, nome) for nome in p2.VARIAVEIS_ESTADO},), {})
+    diario.sincroniza()
+    p2.diario_escrita = diario
+    return diario
+
+
+def desativa_diario():
+    """
+    Deixa de registar as operações, sincronizando e fechando o diário ativo, se houver.
+
+    Returns:
+    - None
+    """
+    if p2.diario_escrita is not None:
+        p2.diario_escrita.fecha()
+        p2.diario_escrita = None
+
+
+def grava_instantaneo(caminho):
+    """
+    Grava um instantâneo do estado de p2, juntamente com a posição atual do diário ativo.
+
+    O ficheiro é escrito ao lado do destino e só depois o substitui, para que um instantâneo incompleto nunca
+    seja usado na recuperação. Sem diário ativo, a posição guardada é 0: o diário a usar na recuperação deve
+    então ser um ficheiro novo, ativado depois do instantâneo.
+
+    Args:
+    - caminho (str): Caminho do ficheiro do instantâneo.
+
+    Returns:
+    - None
+    """
+    posicao = p2.diario_escrita.posicao() if p2.diario_escrita is not None else 0
+    instantaneo = {'posicao_diario': posicao,
+                   'variaveis': {nome: getattr(p2, nome) for nome in p2.VARIAVEIS_ESTADO}}
+    temporario = caminho + '.tmp'
+    with open(temporario, 'wb') as ficheiro:
+        pickle.dump(instantaneo, ficheiro, protocol=pickle.HIGHEST_PROTOCOL)
+        ficheiro.flush()
+        os.fsync(ficheiro.fileno())
+    os.replace(temporario, caminho)
+
+
+def _repoe_variavel(nome, valor):
+    """
+    Repõe uma variável global de p2, alterando o objeto existente para que as referências importadas continuem válidas.
+
+    Args:
+    - nome (str): Nome da variável.
+    - valor: Novo valor da variável.
+
+    Returns:
+    - None
+    """
+    atual = getattr(p2, nome)
+    if isinstance(atual, dict):
+        atual.clear()
+        atual.update(valor)
+    else:
+        atual[:] = valor
+
+
+def _registos(caminho, inicio):
+    """
+    Lê os registos de um diário a partir de uma posição, parando no primeiro registo incompleto ou corrompido.
+
+    Args:
+    - caminho (str): Caminho do ficheiro do diário.
+    - inicio (int): Posição do primeiro registo a ler.
+
+    Returns:
+    - generator: Tuplos (nome, args, kwargs, fim), onde fim é a posição a seguir ao registo.
+    """
+    with open(caminho, 'rb') as ficheiro:
+        if os.fstat(ficheiro.fileno()).st_size <= inicio:
+            return
+        with mmap.mmap(ficheiro.fileno(), 0, access=mmap.ACCESS_READ) as dados:
+            posicao = inicio
+            while posicao + CABECALHO.size <= len(dados):
+                tamanho, crc = CABECALHO.unpack_from(dados, posicao)
+                fim = posicao + CABECALHO.size + tamanho
+                registo = dados[posicao + CABECALHO.size:fim]
+                if len(registo) < tamanho or zlib.crc32(registo) != crc:
+                    return
+                nome, args, kwargs = pickle.loads(registo)
+                yield nome, args, kwargs, fim
+                posicao = fim
+
+
+def _confirma(repetida):
+    """
+    Confirma que uma operação repetida sem registo de falha a seguir também não falhou na recuperação.
+
+    Args:
+    - repetida (tuple): (nome, erro) da operação repetida, ou None.
+
+    Raises:
+    - ValueError: Se a operação falhou na recuperação.
+
+    Returns:
+    - None
+    """
+    if repetida is not None and repetida[1] is not None:
+        raise ValueError('divergencia na recuperacao: %s falhou (%s)' % (repetida[0], repetida[1]))
+
+
+def recupera(caminho_instantaneo=None, caminho_diario=None):
+    """
+    Reconstrói o estado de p2 a partir do último instantâneo e das operações registadas no diário depois dele.
+
+    Um registo incompleto no fim do diário, deixado por uma interrupção a meio da escrita, é descartado e o
+    ficheiro é truncado nesse ponto. Os registos de estado gravados por ativa_diario repõem o estado completo. As
+    operações que falharam quando foram registadas devem falhar de novo, e as restantes devem ser bem sucedidas;
+    qualquer outro resultado indica que o estado reconstruído divergiu do original.
+
+    Args:
+    - caminho_instantaneo (str): Caminho do instantâneo. Se for omitido ou não existir, parte-se do estado atual.
+    - caminho_diario (str): Caminho do diário. Se for omitido ou não existir, apenas se carrega o instantâneo.
+
+    Raises:
+    - ValueError: Se uma operação repetida divergir do resultado registado.
+
+    Returns:
+    - int: Número de operações repetidas a partir do diário.
+    """
+    inicio = 0
+    if caminho_instantaneo and os.path.exists(caminho_instantaneo):
+        with open(caminho_instantaneo, 'rb') as ficheiro:
+            with mmap.mmap(ficheiro.fileno(), 0, access=mmap.ACCESS_READ) as dados:
+                instantaneo = pickle.loads(dados)
+        for nome, valor in instantaneo['variaveis'].items():
+            _repoe_variavel(nome, valor)
+        p2._descarta_resumo()
+        inicio = instantaneo['posicao_diario']
+    if not caminho_diario or not os.path.exists(caminho_diario):
+        return 0
+
+    diario, p2.diario_escrita = p2.diario_escrita, None
+    repetidas = 0
+    fim = inicio
+    anterior = None  # (nome, erro) da última operação repetida, até se saber se falhou quando foi registada
+    try:
+        for nome, args, kwargs, fim in _registos(caminho_diario, inicio):
+            if nome is None:
+                # A operação anterior falhou quando foi registada
+                if anterior is not None and anterior[1] is None:
+                    raise ValueError('divergencia na recuperacao: %s falhou no registo (%s)' % (anterior[0], args[0]))
+                anterior = None
+                continue
+            _confirma(anterior)
+            anterior = None
+            if nome == REGISTO_ESTADO:
+                for variavel, valor in args[0].items():
+                    _repoe_variavel(variavel, valor)
+                p2._descarta_resumo()
+                continue
+            try:
+                getattr(p2, nome)(*args, **kwargs)
+                anterior = (nome, None)
+            except Exception as erro:
+                anterior = (nome, erro)
+            repetidas += 1
+        _confirma(anterior)
+    finally:
+        p2.diario_escrita = diario
+    if os.path.getsize(caminho_diario) > fim:
+        os.truncate(caminho_diario, fim)
+    return repetidas
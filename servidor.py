@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import json
+
+import p2
+
+OPERACOES_ESCRITA = ('cria_cliente', 'movimenta_saldo', 'agenda_ordem', 'cancela_ordem', 'altera_ordem')
+OPERACOES_LEITURA = ('posicao_cliente', 'gera_resumo', 'consulta_ordem')
+LOTE_MAXIMO = 256  # número máximo de pedidos de escrita aplicados de seguida pelo escritor
+
+
+class Servidor:
+    """
+    Servidor TCP que expõe as operações de p2, com um pedido JSON por linha: {"id": ..., "op": ..., "args": [...]}.
+    Cada resposta é também uma linha JSON, {"id": ..., "resultado": ...} ou {"id": ..., "erro": ...}.
+
+    Os pedidos de escrita de todas as ligações são juntos em lotes, aplicados por uma única tarefa escritora sem
+    ceder o controlo ao ciclo de eventos. As leituras são servidas de imediato e veem sempre o estado entre dois
+    lotes, sem esperar pelas escritas pendentes. Os pedidos de uma mesma ligação são atendidos pela ordem de chegada.
+    """
+
+    def __init__(self, lote_maximo=LOTE_MAXIMO):
+        self.lote_maximo = lote_maximo
+        self.fila = None
+        self.servidor = None
+        self.escritor = None
+        self.lotes = 0
+        self.escritas = 0
+
+    async def inicia(self, host='127.0.0.1', porta=0):
+        """
+        Começa a aceitar ligações.
+
+        Args:
+        - host (str): Endereço onde escutar.
+        - porta (int): Porta onde escutar; 0 escolhe uma porta livre.
+
+        Returns:
+        - int: A porta onde o servidor está a escutar.
+        """
+        self.fila = asyncio.Queue()
+        self.escritor = asyncio.create_task(self._escreve())
+        self.servidor = await asyncio.start_server(self._atende, host, porta)
+        return self.servidor.sockets[0].getsockname()[1]
+
+    async def fecha(self):
+        """
+        Deixa de aceitar ligações e termina a tarefa escritora.
+
+        Returns:
+        - None
+        """
+        self.servidor.close()
+        await self.servidor.wait_closed()
+        self.escritor.cancel()
+
+    async def _escreve(self):
+        """
+        Tarefa escritora: retira da fila todos os pedidos de escrita pendentes, até lote_maximo, e aplica-os em série.
+
+        Returns:
+        - None
+        """
+        while True:
+            lote = [await self.fila.get()]
+            while len(lote) < self.lote_maximo and not self.fila.empty():
+                lote.append(self.fila.get_nowait())
+            for op, args, futuro in lote:
+                self._aplica(op, args, futuro)
+            self.lotes += 1
+            self.escritas += len(lote)
+
+    def _aplica(self, op, args, futuro):
+        """
+        Aplica um pedido de escrita e entrega o resultado, ou a exceção, ao futuro de quem o pediu.
+
+        Um pedido cujo futuro já foi cancelado, por exemplo porque a ligação fechou enquanto esperava na fila, é
+        descartado sem ser aplicado. Nenhuma falha de um pedido chega à tarefa escritora, que tem de continuar a
+        atender os restantes.
+
+        Args:
+        - op (str): Nome da operação de p2.
+        - args (list): Argumentos da operação.
+        - futuro (asyncio.Future): Futuro onde é entregue o resultado.
+
+        Returns:
+        - None
+        """
+        if futuro.cancelled():
+            return
+        try:
+            resultado = getattr(p2, op)(*args)
+        except Exception as erro:
+            # Algumas exceções (StopIteration) não podem ser entregues a um futuro tal como estão
+            falha = erro if not isinstance(erro, StopIteration) else RuntimeError(str(erro) or type(erro).__name__)
+            futuro.set_exception(falha)
+        else:
+            futuro.set_result(resultado)
+
+    async def _executa(self, op, args):
+        """
+        Executa um pedido: as escritas passam pela fila do escritor e as leituras são feitas de imediato.
+
+        Args:
+        - op (str): Nome da operação de p2.
+        - args (list): Argumentos da operação.
+
+        Raises:
+        - ValueError: Se a operação não for exposta pelo servidor ou falhar.
+
+        Returns:
+        - O resultado da operação.
+        """
+        if op in OPERACOES_ESCRITA:
+            futuro = asyncio.get_running_loop().create_future()
+            self.fila.put_nowait((op, args, futuro))
+            return await futuro
+        if op in OPERACOES_LEITURA:
+            return getattr(p2, op)(*args)
+        raise ValueError('operacao desconhecida')
+
+    async def _atende(self, leitor, escritor):
+        """
+        Atende uma ligação, respondendo a cada pedido pela ordem de chegada.
+
+        Args:
+        - leitor (asyncio.StreamReader): Leitor da ligação.
+        - escritor (asyncio.StreamWriter): Escritor da ligação.
+
+        Returns:
+        - None
+        """
+        try:
+            async for linha in leitor:
+                pedido_id = None
+                try:
+                    pedido = json.loads(linha)
+                    pedido_id = pedido.get('id')
+                    resultado = await self._executa(pedido['op'], pedido.get('args', []))
+                    resposta = {'id': pedido_id, 'resultado': resultado}
+                except Exception as erro:
+                    resposta = {'id': pedido_id, 'erro': str(erro)}
+                escritor.write(json.dumps(resposta, default=str).encode() + b'\n')
+                await escritor.drain()
+        except ConnectionError:
+            pass
+        finally:
+            escritor.close()
+
+
+class Ligacao:
+    """
+    Ligação de um cliente ao Servidor, com um pedido de cada vez.
+    """
+
+    def __init__(self, leitor, escritor):
+        self.leitor = leitor
+        self.escritor = escritor
+        self.pedido_id = 0
+
+    @classmethod
+    async def abre(cls, host='127.0.0.1', porta=8888):
+        """
+        Abre uma ligação a um servidor.
+
+        Args:
+        - host (str): Endereço do servidor.
+        - porta (int): Porta do servidor.
+
+        Returns:
+        - Ligacao: A ligação aberta.
+        """
+        leitor, escritor = await asyncio.open_connection(host, porta)
+        return cls(leitor, escritor)
+
+    async def chama(self, op, *args):
+        """
+        Pede ao servidor a execução de uma operação e espera pela resposta.
+
+        Args:
+        - op (str): Nome da operação de p2.
+        - args: Argumentos da operação.
+
+        Raises:
+        - ValueError: Se o servidor responder com um erro.
+
+        Returns:
+        - O resultado da operação, tal como devolvido em JSON.
+        """
+        self.pedido_id += 1
+        pedido = {'id': self.pedido_id, 'op': op, 'args': list(args)}
+        self.escritor.write(json.dumps(pedido).encode() + b'\n')
+        await self.escritor.drain()
+        resposta = json.loads(await self.leitor.readline())
+        if 'erro' in resposta:
+            raise ValueError(resposta['erro'])
+        return resposta['resultado']
+
+    async def fecha(self):
+        """
+        Fecha a ligação.
+
+        Returns:
+        - None
+        """
+        self.escritor.close()
+        await self.escritor.wait_closed()
+
+
+async def _executa_servidor(host, porta):
+    """
+    Executa um Servidor até o processo ser interrompido.
+
+    Args:
+    - host (str): Endereço onde escutar.
+    - porta (int): Porta onde escutar.
+
+    Returns:
+    - None
+    """
+    servidor = Servidor()
+    porta = await servidor.inicia(host, porta)
+    print('a escutar em %s:%d' % (host, porta))
+    await servidor.servidor.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor TCP para as operações do módulo p2.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8888)
+    parser.add_argument('--mercado', default='mercado.txt')
+    args = parser.parse_args()
+    p2.carrega_mercado(args.mercado)
+    asyncio.run(_executa_servidor(args.host, args.porta))
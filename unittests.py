@@ -1,5 +1,21 @@
+import asyncio
+import datetime
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
+import backtest
+import fragmentos
+import instrumentacao
+import p2
+import paralelo
+import persistencia
+import servidor
+
 from p2 import *
 
 class TestFunctions(unittest.TestCase):
@@ -104,6 +120,7 @@ class TestFunctions(unittest.TestCase):
         # Teste para a função agenda_ordem
         print("-" * 50)
         print('\nteste de agendamento de ordem\n')
+        inicia_dia('2023-11-01')
         cliente_id = cria_cliente('987654321', 'Jane Doe', '1980-01-01')
         print('cliente id: %s' % cliente_id)
         carteira_id = abre_carteira(cliente_id, "Carteira 2")
@@ -112,7 +129,23 @@ class TestFunctions(unittest.TestCase):
         print('sucesso no agendamento: %s' % sucesso)
         print('ordens: %s\n' % ordens)
         self.assertTrue(sucesso)
-        self.assertIn((carteira_id, 'COMPRA', 'CUR', 5, 100, '2023-11-11'), ordens)
+        self.assertIn((carteira_id, 'COMPRA', 'CUR', 5, 100, '2023-11-11'), ordens['2023-11-11'].values())
+
+    def test_inicia_dia(self):
+        # Teste para a função inicia_dia
+        print("-" * 50)
+        print('\nteste de processamento das ordens do dia\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('987654321', 'Jane Doe', '1980-01-01')
+        carteira_id = abre_carteira(cliente_id, "Carteira 3")
+        movimenta_saldo(cliente_id, 100)
+        agenda_ordem(carteira_id, 'COMPRA', 'CUR', 10, 100, '2023-11-02')
+        agenda_ordem(carteira_id, 'COMPRA', 'CUR', 10, 100, '2023-11-03')
+        inicia_dia()
+        print('ordens: %s\n' % ordens)
+        self.assertNotIn('2023-11-02', ordens)
+        self.assertEqual(len(ordens['2023-11-03']), 1)
+        self.assertAlmostEqual(clientes[cliente_id]['saldo'], 100 - 10 * 1.17)
 
     def test_imprime_resumo(self):
         # Teste para a função imprime_resumo
@@ -124,6 +157,826 @@ class TestFunctions(unittest.TestCase):
         print('impressao do resumo:\n')
         imprime_resumo(resumo)
 
+    def test_carrega_ordens(self):
+        # Teste para a função carrega_ordens com linhas inválidas
+        print("-" * 50)
+        print('\nteste de carregamento de ordens com rejeicoes\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('987654321', 'Jane Doe', '1980-01-01')
+        carteira_id = abre_carteira(cliente_id, "Carteira 4")
+        linhas = [
+            '%d\tCUR\t10\t100.00\t2023-11-20' % carteira_id,
+            '%d\tCUR\tdez\t100.00\t2023-11-20' % carteira_id,
+            '999999\tCUR\t10\t100.00\t2023-11-20',
+            '%d\tXPTO\t10\t100.00\t2023-11-20' % carteira_id,
+            '%d\tCUR\t-5\t100.00\t2023-10-01' % carteira_id,
+            '%d\tCUR\t10' % carteira_id,
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(linhas))
+        try:
+            rejeitadas = carrega_ordens(f.name, tamanho_bloco=4)
+        finally:
+            os.remove(f.name)
+        print('rejeitadas: %s\n' % rejeitadas)
+        self.assertEqual([n for n, motivo in rejeitadas], [2, 3, 4, 5, 6])
+        self.assertIn((carteira_id, 'COMPRA', 'CUR', 10, 100.0, '2023-11-20'), ordens['2023-11-20'].values())
+
+        # Linhas com campos fora do sítio ou datas noutro formato ISO são rejeitadas em qualquer bloco
+        outra_id = abre_carteira(cliente_id, "Carteira 4b")
+        linhas = [
+            '%d\tCUR\t10\t1.0\t2099-01-01 %d' % (carteira_id, outra_id),
+            '\tCUR\t10\t1.0\t2099-01-01',
+            '%d\tCUR\t10\t1.0\t20991231' % carteira_id,
+            '%d\tCUR\t10\t1.0\t2099-W01-1' % carteira_id,
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+            f.write('\n'.join(linhas))
+        try:
+            rejeitadas = carrega_ordens(f.name, tamanho_bloco=2)
+        finally:
+            os.remove(f.name)
+        print('rejeitadas: %s\n' % rejeitadas)
+        self.assertEqual(rejeitadas, [(1, 'data invalida'), (2, 'numero de campos invalido'),
+                                      (3, 'data invalida'), (4, 'data invalida')])
+        self.assertNotIn(outra_id, ordens_carteira)
+
+        # Cada linha tem o mesmo resultado num bloco bem formado (colunas por fatias) e num bloco com uma linha
+        # inválida (conversão linha a linha)
+        def carrega_linhas(linhas):
+            antes = set(ordens_agendadas)
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+                f.write('\n'.join(linhas))
+            try:
+                rejeitadas = carrega_ordens(f.name, tamanho_bloco=len(linhas))
+            finally:
+                os.remove(f.name)
+            novas = [ordens_agendadas[ordem_id] for ordem_id in ordens_agendadas.keys() - antes]
+            return [motivo for n, motivo in rejeitadas if n == 1], [ordem for ordem in novas if ordem[2] != 'EDPR']
+
+        boa = '%d\tEDPR\t1\t1.0\t2099-01-01' % carteira_id
+        variantes = ['%d\tCUR\t10\t1.0\t2099-01-01\r' % carteira_id,
+                     '%d\tCUR \t10\t1.0\t2099-01-01' % carteira_id,
+                     '%d\t CUR\t10\t1.0\t2099-01-01 \r' % carteira_id,
+                     '%d\tCUR X\t10\t1.0\t2099-01-01' % carteira_id,
+                     '%d\t\tCUR\t10\t1.0\t2099-01-01' % carteira_id,
+                     '%d\tCUR\t10 1.0\t2099-01-01\tx' % carteira_id]
+        for i, linha in enumerate(variantes):
+            self.assertEqual(bool(BLOCO_ORDENS_REGULAR.fullmatch(linha + '\n' + boa)), i == 0)
+            rapido = carrega_linhas([linha, boa])
+            lento = carrega_linhas([linha, 'linha invalida'])
+            print('%r: %s / %s\n' % (linha, rapido, lento))
+            self.assertEqual(rapido, lento)
+        self.assertEqual(carrega_linhas([variantes[1], boa])[1],
+                         [(carteira_id, 'COMPRA', 'CUR', 10, 1.0, '2099-01-01')])
+
+    def test_carrega_mercado(self):
+        # Teste para a função carrega_mercado e para o acesso às cotações
+        print("-" * 50)
+        print('\nteste de carregamento do mercado\n')
+        titulo_id = id_titulo('CUR')
+        carrega_mercado('mercado.txt')
+        print('mercado: %s\nprecos: %s\n' % (mercado, mercado_precos))
+        self.assertEqual(id_titulo('CUR'), titulo_id)
+        self.assertEqual(preco_titulo('CUR'), 1.17)
+        self.assertEqual(designacao_titulo('EDPR'), 'EDP RENOVAVEIS')
+        self.assertEqual(list(precos_titulos([id_titulo('EDPR'), titulo_id])), [19.99, 1.17])
+        with self.assertRaises(ValueError):
+            preco_titulo('XPTO')
+
+    def test_atualiza_precos(self):
+        # Teste para a função atualiza_precos
+        print("-" * 50)
+        print('\nteste de atualizacao de cotacoes\n')
+        cliente_1 = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        cliente_2 = cria_cliente('987654321', 'Jane Doe', '1980-01-01')
+        movimenta_saldo(cliente_1, 100)
+        movimenta_saldo(cliente_2, 100)
+        carteira_id = abre_carteira((cliente_1, cliente_2), "Carteira Partilhada")
+        processa_operacao(carteira_id, 'COMPRA', 'CUR', 20)
+        alteradas = atualiza_precos([('CUR', 2.0), ('EDPR', 20.0)])
+        print('carteiras alteradas: %s\n' % alteradas)
+        print('detentores: %s\n' % detentores)
+        self.assertIn(carteira_id, alteradas)
+        self.assertAlmostEqual(carteiras[carteira_id]['valor'], 40.0)
+        self.assertAlmostEqual(posicao_cliente(cliente_1), 100 - 10 * 1.17 + 20.0)
+        self.assertAlmostEqual(posicao_cliente(cliente_2), 100 - 10 * 1.17 + 20.0)
+
+    def test_posicao_clientes(self):
+        # Teste para a função posicao_clientes
+        print("-" * 50)
+        print('\nteste de posicao de varios clientes\n')
+        cliente_1 = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        cliente_2 = cria_cliente('987654321', 'Jane Doe', '1980-01-01')
+        movimenta_saldo(cliente_1, 100)
+        movimenta_saldo(cliente_2, 500)
+        carteira_1 = abre_carteira(cliente_1, "Carteira Individual")
+        carteira_2 = abre_carteira((cliente_1, cliente_2), "Carteira Partilhada")
+        processa_operacao(carteira_1, 'COMPRA', 'CUR', 10)
+        processa_operacao(carteira_2, 'COMPRA', 'EDPR', 4)
+        # Numa carteira com três titulares, o valor é dividido exatamente como em posicao_cliente
+        cliente_3 = cria_cliente('111111111', 'Joe Doe', '1970-01-01')
+        movimenta_saldo(cliente_3, 500)
+        carteira_3 = abre_carteira((cliente_1, cliente_2, cliente_3), "Carteira Tripla")
+        processa_operacao(carteira_3, 'COMPRA', 'EDPR', 1)
+        posicoes = posicao_clientes([cliente_1, cliente_2, cliente_3, 100000])
+        print('posicoes: %s\n' % posicoes)
+        for cliente_id in (cliente_1, cliente_2, cliente_3):
+            self.assertEqual(posicoes[cliente_id], posicao_cliente(cliente_id))
+        self.assertEqual(posicoes[100000], 0)
+        matriz = matriz_posicoes([cliente_1])
+        precos = precos_titulos(range(len(mercado_precos)))
+        precos[id_titulo('CUR')] = 2.0
+        self.assertAlmostEqual(posicao_clientes(matriz=matriz, precos=precos)[cliente_1],
+                               clientes[cliente_1]['saldo'] + 10 * 2.0 + 2 * 19.99 + 6.6634)
+
+    def test_processa_operacao(self):
+        # Teste para as compras e vendas da função processa_operacao
+        print("-" * 50)
+        print('\nteste de compras e vendas numa carteira\n')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        carteira_id = abre_carteira(cliente_id, "Carteira 5")
+        movimenta_saldo(cliente_id, 1000)
+        processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+        processa_operacao(carteira_id, 'COMPRA', 'CUR', 5)
+        processa_operacao(carteira_id, 'COMPRA', 'EDPR', 2)
+        self.assertEqual(carteiras[carteira_id]['titulos'], {'CUR': 15, 'EDPR': 2})
+        processa_operacao(carteira_id, 'VENDA', 'CUR', 4)
+        self.assertEqual(carteiras[carteira_id]['titulos']['CUR'], 11)
+        valor = processa_operacao(carteira_id, 'VENDA', 'EDPR', 10)
+        print('carteira: %s\n' % carteiras[carteira_id])
+        self.assertAlmostEqual(valor, 2 * 19.99)
+        self.assertNotIn('EDPR', carteiras[carteira_id]['titulos'])
+        self.assertNotIn(carteira_id, detentores['EDPR'])
+        with self.assertRaises(ValueError):
+            processa_operacao(carteira_id, 'VENDA', 'EDPR', 1)
+
+    def test_gera_resumo_periodo(self):
+        # Teste para a filtragem das operações por datas na função gera_resumo
+        print("-" * 50)
+        print('\nteste de resumo de um periodo\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        carteira_id = abre_carteira(cliente_id, "Carteira 6")
+        movimenta_saldo(cliente_id, 1000)
+        processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+        inicia_dia('2023-11-05')
+        processa_operacao(carteira_id, 'COMPRA', 'EDPR', 2)
+        inicia_dia('2023-11-10')
+        processa_operacao(carteira_id, 'VENDA', 'CUR', 5)
+        resumo = gera_resumo(carteira_id, '2023-11-02', '2023-11-09')
+        imprime_resumo(resumo)
+        self.assertEqual(resumo[5], [(datetime.date(2023, 11, 5), 'COMPRA', 'EDPR', 2, 2 * 19.99)])
+        self.assertEqual(len(gera_resumo(carteira_id)[5]), 4)
+        periodo = operacoes_periodo(carteira_id, '2023-11-05', '2023-11-10')
+        self.assertEqual(list(periodo['quantidade']), [2, 5])
+        # As colunas devolvidas são cópias: guardá-las não impede o registo de novas operações
+        processa_operacao(carteira_id, 'VENDA', 'CUR', 5)
+        self.assertEqual(list(periodo['quantidade']), [2, 5])
+        self.assertNotIn('CUR', carteiras[carteira_id]['titulos'])
+
+    def test_persistencia(self):
+        # Teste para a recuperação do estado a partir de um instantâneo e do diário de escrita
+        print("-" * 50)
+        print('\nteste de persistencia do estado\n')
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho_instantaneo = os.path.join(pasta, 'estado.bin')
+            caminho_diario = os.path.join(pasta, 'diario.bin')
+            persistencia.ativa_diario(caminho_diario)
+            try:
+                cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+                movimenta_saldo(cliente_id, 1000)
+                carteira_id = abre_carteira(cliente_id, "Carteira 7")
+                persistencia.grava_instantaneo(caminho_instantaneo)
+                processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+                with self.assertRaises(ValueError):
+                    processa_operacao(carteira_id, 'VENDA', 'EDPR', 1)
+                agenda_ordem(carteira_id, 'COMPRA', 'EDPR', 1, 100, '2999-01-01')
+                # Ordem do dia carregada de um ficheiro, a aguardar o preço limite
+                caminho_ordens = os.path.join(pasta, 'ordens.txt')
+                with open(caminho_ordens, 'w') as f:
+                    f.write('%d\tEDPR\t1\t0.01\t%s\n' % (carteira_id, estado['hoje']))
+                self.assertEqual(carrega_ordens(caminho_ordens), [])
+                atualiza_precos((nome_titulo, preco) for nome_titulo, preco in [('CUR', 2.0)])
+            finally:
+                persistencia.desativa_diario()
+            posicao = posicao_cliente(cliente_id)
+            titulos = dict(carteiras[carteira_id]['titulos'])
+            ativas = dict(ordens_ativas)
+            proxima_ordem_id = estado['ordem_id']
+            hoje = estado['hoje']
+
+            # Alterações sem diário ativo perdem-se na recuperação
+            movimenta_saldo(cliente_id, 5000)
+            encerra_cliente(cliente_id)
+            with open(caminho_diario, 'ab') as f:
+                f.write(b'\x10\x00')  # registo incompleto deixado por uma interrupção
+            repetidas = persistencia.recupera(caminho_instantaneo, caminho_diario)
+            print('operacoes repetidas: %s\n' % repetidas)
+            self.assertEqual(repetidas, 6)
+            self.assertAlmostEqual(posicao_cliente(cliente_id), posicao)
+            self.assertEqual(ordens_ativas, ativas)
+            self.assertIn((carteira_id, 'COMPRA', 'EDPR', 1, 0.01, str(estado['hoje'])), ativas.values())
+            self.assertEqual(estado['ordem_id'], proxima_ordem_id)
+            self.assertEqual(carteiras[carteira_id]['titulos'], titulos)
+            self.assertIn((carteira_id, 'COMPRA', 'EDPR', 1, 100, '2999-01-01'), ordens['2999-01-01'].values())
+
+            # Os registos chegam ao sistema operativo antes de a operação terminar, mesmo sem sincronização
+            caminho_abrupto = os.path.join(pasta, 'abrupto.bin')
+            codigo = ('import os, p2, persistencia\n'
+                      'persistencia.ativa_diario(%r, intervalo_sync=60)\n'
+                      'p2.cria_cliente("1", "A", "1990-01-01")\n'
+                      'os._exit(0)\n' % caminho_abrupto)
+            subprocess.run([sys.executable, '-c', codigo], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(persistencia.recupera(None, caminho_abrupto), 1)
+            self.assertEqual(len(clientes), 1)
+
+            # Uma operação que diverge do resultado registado interrompe a recuperação
+            caminho_invalido = os.path.join(pasta, 'invalido.bin')
+            diario = persistencia.DiarioEscrita(caminho_invalido)
+            diario('encerra_carteira', (0,), {})
+            diario.fecha()
+            with self.assertRaises(ValueError):
+                persistencia.recupera(None, caminho_invalido)
+
+            # O diário basta, sozinho, para reconstruir o estado, incluindo a data atual de quando foi ativado
+            persistencia.recupera(None, caminho_diario)
+            self.assertEqual(estado['hoje'], hoje)
+            self.assertAlmostEqual(posicao_cliente(cliente_id), posicao)
+            self.assertEqual(carteiras[carteira_id]['titulos'], titulos)
+            self.assertEqual(ordens_ativas, ativas)
+            self.assertEqual(estado['ordem_id'], proxima_ordem_id)
+        carrega_mercado('mercado.txt')
+
+    def _estado_carteiras(self):
+        # Cópia dos valores de clientes, carteiras e detentores, para comparar estados em momentos diferentes
+        return ({cliente_id: (set(cliente.carteiras_id), cliente.saldo, cliente.valor_titulos)
+                 for cliente_id, cliente in clientes.items()},
+                {carteira_id: (dict(carteira.titulos), carteira.valor,
+                               p2._linhas_diario(carteira.operacoes))
+                 for carteira_id, carteira in carteiras.items()},
+                {nome_titulo: set(ids) for nome_titulo, ids in detentores.items()})
+
+    def test_inicia_dia_paralelo(self):
+        # Teste para a execução das ordens do dia repartida por vários processos
+        print("-" * 50)
+        print('\nteste de inicio de dia em paralelo\n')
+        inicia_dia('2023-11-01')
+        cliente_ids = [cria_cliente(str(i), 'Cliente %d' % i, '1980-01-01') for i in range(6)]
+        for cliente_id in cliente_ids:
+            movimenta_saldo(cliente_id, 100)
+        carteira_ids = [abre_carteira(cliente_id, "Carteira Individual") for cliente_id in cliente_ids]
+        carteira_ids.append(abre_carteira((cliente_ids[0], cliente_ids[1]), "Carteira Partilhada"))
+        for i in range(40):
+            carteira_id = carteira_ids[i % len(carteira_ids)]
+            agenda_ordem(carteira_id, 'COMPRA', 'CUR', i % 7 + 1, 100, '2023-11-02')
+            agenda_ordem(carteira_id, 'VENDA', 'CUR', i % 3 + 1, 100, '2023-11-02')
+
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho_instantaneo = os.path.join(pasta, 'estado.bin')
+            persistencia.grava_instantaneo(caminho_instantaneo)
+            inicia_dia()
+            serie = self._estado_carteiras()
+            persistencia.recupera(caminho_instantaneo)
+            ordens_minimas, paralelo.ORDENS_MINIMAS = paralelo.ORDENS_MINIMAS, 0
+            try:
+                inicia_dia(processos=3)
+            finally:
+                paralelo.ORDENS_MINIMAS = ordens_minimas
+        print('carteiras: %s\n' % {c: carteiras[c]['titulos'] for c in carteira_ids})
+        self.assertEqual(self._estado_carteiras(), serie)
+        self.assertNotIn('2023-11-02', ordens)
+
+    def test_ordens_limite(self):
+        # Teste para a execução das ordens apenas quando a cotação atinge o preço limite
+        print("-" * 50)
+        print('\nteste de ordens com preco limite\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        carteira_id = abre_carteira(cliente_id, "Carteira 8")
+        movimenta_saldo(cliente_id, 100)
+        self.assertTrue(agenda_ordem(carteira_id, 'COMPRA', 'CUR', 10, 1.0, ''))
+        agenda_ordem(carteira_id, 'VENDA', 'CUR', 4, 1.5, '2023-11-02')
+        self.assertEqual(carteiras[carteira_id]['titulos'], {})
+        atualiza_precos([('CUR', 1.1)])
+        self.assertEqual(carteiras[carteira_id]['titulos'], {})
+        alteradas = atualiza_precos([('CUR', 0.9)])
+        self.assertIn(carteira_id, alteradas)
+        self.assertEqual(carteiras[carteira_id]['titulos'], {'CUR': 10})
+        self.assertAlmostEqual(clientes[cliente_id]['saldo'], 100 - 10 * 0.9)
+        inicia_dia()
+        print('livro de limites: %s\n' % livro_limites['CUR'])
+        self.assertEqual(carteiras[carteira_id]['titulos'], {'CUR': 10})
+        atualiza_precos([('CUR', 1.6)])
+        self.assertEqual(carteiras[carteira_id]['titulos'], {'CUR': 6})
+        self.assertNotIn((carteira_id, 'VENDA', 'CUR', 4, 1.5, '2023-11-02'), ordens_ativas.values())
+
+    def test_encerra_clientes(self):
+        # Teste para o encerramento de clientes com várias carteiras e de carteiras partilhadas
+        print("-" * 50)
+        print('\nteste de encerramento de varios clientes\n')
+        cliente_1 = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        cliente_2 = cria_cliente('987654321', 'Jane Doe', '1980-01-01')
+        cliente_3 = cria_cliente('555555555', 'Joe Doe', '1970-01-01')
+        movimenta_saldo(cliente_1, 100)
+        carteira_ids = [abre_carteira(cliente_1, "Carteira %d" % i) for i in range(3)]
+        for carteira_id in carteira_ids:
+            processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+        partilhada = abre_carteira((cliente_2, cliente_3), "Carteira Partilhada")
+        self.assertEqual(clientes[cliente_2]['carteiras_id'], {partilhada})
+
+        valores = encerra_clientes([cliente_1, cliente_2, 100000])
+        print('valores: %s\n' % valores)
+        self.assertAlmostEqual(valores[cliente_1], 100)
+        self.assertNotIn(cliente_1, clientes)
+        self.assertFalse(any(carteira_id in carteiras for carteira_id in carteira_ids))
+        self.assertIn(cliente_2, clientes)
+
+        encerra_carteira(partilhada)
+        self.assertEqual(clientes[cliente_2]['carteiras_id'], set())
+        self.assertEqual(clientes[cliente_3]['carteiras_id'], set())
+        self.assertEqual(encerra_clientes([cliente_2, cliente_3]), {cliente_2: 0.0, cliente_3: 0.0})
+
+    def test_servidor(self):
+        # Teste para o servidor TCP com vários clientes em simultâneo
+        print("-" * 50)
+        print('\nteste do servidor\n')
+
+        async def sessao(porta, i):
+            ligacao = await servidor.Ligacao.abre(porta=porta)
+            try:
+                cliente_id = await ligacao.chama('cria_cliente', str(i), 'Cliente %d' % i, '1980-01-01')
+                await ligacao.chama('movimenta_saldo', cliente_id, 100 + i)
+                posicao = await ligacao.chama('posicao_cliente', cliente_id)
+                with self.assertRaises(ValueError):
+                    await ligacao.chama('encerra_cliente', cliente_id)
+                return cliente_id, posicao
+            finally:
+                await ligacao.fecha()
+
+        async def executa():
+            servico = servidor.Servidor()
+            porta = await servico.inicia()
+            try:
+                return await asyncio.gather(*(sessao(porta, i) for i in range(20))), servico.lotes, servico.escritas
+            finally:
+                await servico.fecha()
+
+        resultados, lotes, escritas = asyncio.run(executa())
+        print('resultados: %s\nlotes: %s\nescritas: %s\n' % (resultados, lotes, escritas))
+        self.assertEqual(len({cliente_id for cliente_id, posicao in resultados}), 20)
+        for i, (cliente_id, posicao) in enumerate(resultados):
+            self.assertEqual(posicao, 100 + i)
+            self.assertIn(cliente_id, clientes)
+        # As escritas simultâneas das várias ligações são aplicadas em lotes
+        self.assertEqual(escritas, 40)
+        self.assertLess(lotes, 20)
+
+        # Um pedido de escrita cancelado enquanto esperava na fila é descartado e não para a tarefa escritora
+        async def pedido_cancelado():
+            servico = servidor.Servidor()
+            porta = await servico.inicia()
+            try:
+                futuro = asyncio.get_running_loop().create_future()
+                futuro.cancel()
+                servico.fila.put_nowait(('cria_cliente', ['1', 'Cancelado', '1980-01-01'], futuro))
+                ligacao = await servidor.Ligacao.abre(porta=porta)
+                try:
+                    cliente_id = await asyncio.wait_for(ligacao.chama('cria_cliente', '2', 'Depois', '1980-01-01'), 5)
+                finally:
+                    await ligacao.fecha()
+                return cliente_id, servico.escritor.done()
+            finally:
+                await servico.fecha()
+
+        cliente_id, terminou = asyncio.run(pedido_cancelado())
+        self.assertFalse(terminou)
+        self.assertEqual(clientes[cliente_id].nome, 'Depois')
+        self.assertNotIn('Cancelado', [cliente.nome for cliente in clientes.values()])
+
+    def test_resumos_em_cache(self):
+        # Teste para a cache de resumos e a gravação de vários resumos num ficheiro
+        print("-" * 50)
+        print('\nteste de resumos em cache\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        movimenta_saldo(cliente_id, 10000)
+        carteira_ids = [abre_carteira(cliente_id, "Carteira %d" % i) for i in range(3)]
+        for carteira_id in carteira_ids:
+            processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+            gera_resumo(carteira_id)
+        processa_operacao(carteira_ids[0], 'COMPRA', 'EDPR', 2)
+        processa_operacao(carteira_ids[1], 'VENDA', 'CUR', 10)
+        atualiza_precos([('CUR', 123.0)])
+        em_cache = [gera_resumo(carteira_id) for carteira_id in carteira_ids]
+        p2._descarta_resumo()
+        self.assertEqual(em_cache, [gera_resumo(carteira_id) for carteira_id in carteira_ids])
+        self.assertEqual(em_cache[0][3], [('AGUAS DA CURIA', 'CUR', 10, 1230.0), ('EDP RENOVAVEIS', 'EDPR', 2, 2 * 19.99)])
+        self.assertEqual(em_cache[1][3], [])
+
+        limite = p2.LIMITE_CACHE_RESUMOS
+        p2.LIMITE_CACHE_RESUMOS = 3 * p2.BYTES_POR_LINHA_RESUMO
+        try:
+            p2._descarta_resumo()
+            for carteira_id in carteira_ids:
+                gera_resumo(carteira_id)
+            self.assertEqual(list(resumos), carteira_ids[1:])
+        finally:
+            p2.LIMITE_CACHE_RESUMOS = limite
+
+        with tempfile.TemporaryDirectory() as pasta:
+            nome_ficheiro = os.path.join(pasta, 'resumos.txt')
+            self.assertEqual(grava_resumos(carteira_ids, nome_ficheiro), 3)
+            with open(nome_ficheiro) as file:
+                texto = file.read()
+        print(texto)
+        self.assertEqual(texto, ''.join(formata_resumo(resumo) for resumo in em_cache))
+
+    def test_carrega_mercado_cache(self):
+        # Teste para a análise de colunas mistas e a cache binária da função carrega_mercado
+        print("-" * 50)
+        print('\nteste de cache do mercado\n')
+        with tempfile.TemporaryDirectory() as pasta:
+            nome_ficheiro = os.path.join(pasta, 'mercado.txt')
+            with open(nome_ficheiro, 'w') as file:
+                file.write('BANCO COMERCIAL\t\tBCPT\t0.25\n'
+                           'MOTA ENGIL   \t   EGLT   1.5\n'
+                           'NOS SGPS    NOST    3.75\n'
+                           '\n'
+                           'SEMCOTACAO\tSCOT\n'
+                           'COTACAO ERRADA\tCERR\tabc\n')
+            rejeitadas = carrega_mercado(nome_ficheiro)
+            print('rejeitadas: %s\n' % rejeitadas)
+            self.assertEqual(rejeitadas, [(5, 'numero de campos invalido'), (6, 'cotacao invalida')])
+            self.assertTrue(os.path.exists(nome_ficheiro + '.cache'))
+            self.assertEqual(designacao_titulo('EGLT'), 'MOTA ENGIL')
+            self.assertEqual(designacao_titulo('NOST'), 'NOS SGPS')
+            self.assertEqual(preco_titulo('BCPT'), 0.25)
+
+            # A segunda carga é feita a partir da cache
+            self.assertEqual(carrega_mercado(nome_ficheiro), rejeitadas)
+            self.assertEqual(preco_titulo('EGLT'), 1.5)
+
+            # A cache é ignorada quando o ficheiro de origem muda
+            with open(nome_ficheiro, 'w') as file:
+                file.write('MOTA ENGIL\tEGLT\t1.75\n')
+            self.assertEqual(carrega_mercado(nome_ficheiro), [])
+            self.assertEqual(preco_titulo('EGLT'), 1.75)
+        self.assertIn('ALTR', mercado)
+
+    def test_instrumentacao(self):
+        # Teste para a recolha e exportação de métricas e para os perfiladores
+        print("-" * 50)
+        print('\nteste de instrumentacao\n')
+        originais = p2.processa_operacao, p2.inicia_dia
+        metricas = instrumentacao.ativa()
+        try:
+            p2.inicia_dia('2023-11-01')
+            cliente_id = p2.cria_cliente('123456789', 'John Doe', '1990-01-01')
+            p2.movimenta_saldo(cliente_id, 1000)
+            carteira_id = p2.abre_carteira(cliente_id, "Carteira 10")
+            p2.agenda_ordem(carteira_id, 'COMPRA', 'CUR', 1, 100, '2023-11-02')
+            p2.agenda_ordem(carteira_id, 'COMPRA', 'CUR', 1, 100, '2023-11-02')
+            with self.assertRaises(ValueError):
+                p2.processa_operacao(carteira_id, 'VENDA', 'EDPR', 1)
+            p2.inicia_dia()
+        finally:
+            instrumentacao.desativa()
+        self.assertEqual((p2.processa_operacao, p2.inicia_dia), originais)
+
+        memoria = instrumentacao.ExportadorMemoria()
+        instrumentacao.exporta(memoria)
+        amostra = memoria.amostras[0]
+        print('amostra: %s\n' % amostra['chamadas'])
+        self.assertEqual(amostra['chamadas']['processa_operacao'], 1)
+        self.assertEqual(amostra['erros'], {'processa_operacao': 1})
+        self.assertEqual(amostra['dias'][-1][0], '2023-11-02')
+        self.assertEqual(amostra['dias'][-1][2], 2)
+        self.assertEqual(metricas.ordens_dia.n, 2)
+
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho = os.path.join(pasta, 'metricas.prom')
+            instrumentacao.exporta(instrumentacao.ExportadorPrometheus(caminho))
+            with open(caminho) as file:
+                texto = file.read()
+        self.assertIn('p2_chamadas_total{operacao="processa_operacao"} 1\n', texto)
+        self.assertIn('p2_latencia_segundos_bucket{operacao="inicia_dia",le="+Inf"} 2\n', texto)
+        self.assertIn('p2_erros_total{operacao="processa_operacao"} 1\n', texto)
+
+        resultado, perfil = instrumentacao.perfila(sum, ([1, 2, 3],))
+        self.assertEqual(resultado, 6)
+        self.assertGreater(perfil.total_calls, 0)
+        resultado, pilhas = instrumentacao.perfila(espera, (0.05,), 'amostragem', intervalo=0.005)
+        self.assertTrue(any('espera' in pilha for pilha in pilhas))
+        with self.assertRaises(ValueError):
+            instrumentacao.perfila(sum, ([],), 'outro')
+
+
+    def test_registos_compactos(self):
+        # Teste para os registos Cliente e Carteira, com o saldo e os valores guardados em arrays
+        print("-" * 50)
+        print('\nteste de registos compactos\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        carteira_id = abre_carteira(cliente_id, "Carteira 11")
+        movimenta_saldo(cliente_id, 100)
+        processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+        cliente = clientes[cliente_id]
+        print('cliente: %s\ncarteira: %s\n' % (cliente, carteiras[carteira_id]))
+        self.assertFalse(hasattr(cliente, '__dict__'))
+        self.assertEqual(cliente['saldo'], saldos[cliente_id] / ESCALA_MONETARIA)
+        self.assertAlmostEqual(cliente.saldo, 100 - 10 * 1.17)
+        self.assertEqual(carteiras[carteira_id]['valor'], valores_carteiras[carteira_id] / ESCALA_MONETARIA)
+        self.assertEqual(cliente['carteiras_id'], {carteira_id})
+        self.assertEqual(cliente.carteiras, carteira_id)
+        with self.assertRaises(AttributeError):
+            cliente['carteiras_id'].add(0)
+        vista = cliente['carteiras_id']
+        outra_id = abre_carteira(cliente_id, "Carteira 12")
+        self.assertIn(outra_id, vista)
+        self.assertEqual(cliente.carteiras, (carteira_id, outra_id))
+        encerra_carteira(outra_id)
+        self.assertEqual(vista, {carteira_id})
+        self.assertEqual(cliente.carteiras, carteira_id)
+        outras_ids = [abre_carteira(cliente_id, "Carteira %d" % i) for i in range(MAXIMO_CARTEIRAS_TUPLO)]
+        self.assertEqual(cliente.carteiras, {carteira_id, *outras_ids})
+        for outra_id in outras_ids:
+            encerra_carteira(outra_id)
+        self.assertEqual(vista, {carteira_id})
+        sem_carteiras = clientes[cria_cliente('987654321', 'Jane Doe', '1990-01-01')]
+        self.assertIsNone(sem_carteiras.carteiras)
+        self.assertEqual(sem_carteiras.carteiras_id, set())
+        cliente['saldo'] = 50.0
+        self.assertEqual(saldos[cliente_id], 50 * ESCALA_MONETARIA)
+
+        copia = pickle.loads(pickle.dumps(carteiras[carteira_id]))
+        self.assertEqual((copia.titulares_id, copia.titulos, copia.operacoes),
+                         (cliente_id, {'CUR': 10}, carteiras[carteira_id].operacoes))
+        self.assertEqual(len(copia.operacoes), 2)
+        periodo = operacoes_periodo(carteira_id, '2023-11-01', '2023-11-01')
+        self.assertEqual(tuple(periodo), CAMPOS_DIARIO)
+        self.assertEqual(periodo['quantidade'].tolist(), [0, 10])
+
+    def test_valores_exatos(self):
+        # Teste para a aritmética monetária exata e a repartição determinística dos valores pelos titulares
+        print("-" * 50)
+        print('\nteste de valores exatos\n')
+        inicia_dia('2023-11-01')
+        cliente_ids = tuple(cria_cliente('12345678%d' % i, 'Titular %d' % i, '1990-01-01') for i in range(3))
+        for _ in range(10):
+            movimenta_saldo(cliente_ids[0], 0.1)
+        self.assertEqual(clientes[cliente_ids[0]].saldo, 1.0)
+        for cliente_id in cliente_ids:
+            movimenta_saldo(cliente_id, 100 - clientes[cliente_id].saldo)
+        carteira_id = abre_carteira(cliente_ids, "Carteira 12")
+        self.assertEqual(processa_operacao(carteira_id, 'COMPRA', 'EDPR', 1), 19.99)
+        print('saldos: %s\n' % [clientes[cliente_id].saldo for cliente_id in cliente_ids])
+        self.assertEqual([saldos[cliente_id] for cliente_id in cliente_ids], [933_366, 933_367, 933_367])
+        self.assertEqual(sum(saldos[cliente_id] for cliente_id in cliente_ids), (300 - 19.99) * ESCALA_MONETARIA)
+        self.assertEqual(sum(valores_titulos[cliente_id] for cliente_id in cliente_ids), valores_carteiras[carteira_id])
+
+        atualiza_precos([('EDPR', 20.01)])
+        self.assertEqual(sum(valores_titulos[cliente_id] for cliente_id in cliente_ids), 200_100)
+        agenda_ordem(carteira_id, 'VENDA', 'EDPR', 1, 20, '2023-11-02')
+        inicia_dia()
+        self.assertEqual(carteiras[carteira_id].titulos, {})
+        self.assertEqual(sum(saldos[cliente_id] for cliente_id in cliente_ids), 3_000_200)
+        self.assertEqual([valores_titulos[cliente_id] for cliente_id in cliente_ids], [0, 0, 0])
+        self.assertEqual(gera_resumo(carteira_id)[5][-1][4], 20.01)
+
+    def test_cancela_ordens(self):
+        # Teste para a consulta, o cancelamento e a alteração das ordens pelo seu identificador
+        print("-" * 50)
+        print('\nteste de cancelamento de ordens\n')
+        inicia_dia('2023-11-01')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        movimenta_saldo(cliente_id, 1000)
+        carteira_id = abre_carteira(cliente_id, "Carteira 16")
+        outra_id = abre_carteira(cliente_id, "Carteira 17")
+        agendada = agenda_ordem(carteira_id, 'COMPRA', 'CUR', 5, 100, '2023-11-02')
+        a_aguardar = agenda_ordem(carteira_id, 'COMPRA', 'EDPR', 1, 10.0, '')
+        outra = agenda_ordem(outra_id, 'COMPRA', 'EDPR', 2, 10.0, '2023-11-03')
+        print('ordens: %s\nlivro de limites: %s\n' % (ordens, ordens_ativas))
+        self.assertEqual(len({agendada, a_aguardar, outra}), 3)
+        self.assertEqual(consulta_ordem(agendada), (carteira_id, 'COMPRA', 'CUR', 5, 100, '2023-11-02'))
+        self.assertEqual(consulta_ordem(a_aguardar), (carteira_id, 'COMPRA', 'EDPR', 1, 10.0, '2023-11-01'))
+        self.assertEqual(ordens_carteira[carteira_id], {agendada, a_aguardar})
+
+        # Alteração de uma ordem agendada, que é executada com a nova quantidade
+        self.assertTrue(altera_ordem(agendada, quantidade=2))
+        self.assertFalse(altera_ordem(agendada, quantidade=0))
+        self.assertEqual(consulta_ordem(agendada)[3], 2)
+        inicia_dia('2023-11-02')
+        self.assertEqual(carteiras[carteira_id].titulos, {'CUR': 2})
+        self.assertIsNone(consulta_ordem(agendada))
+        self.assertIsNone(cancela_ordem(agendada))
+
+        # Um novo limite atingido pela cotação atual executa a ordem de imediato; o limite anterior deixa de valer
+        self.assertTrue(altera_ordem(a_aguardar, preco_limite=19.99))
+        self.assertEqual(carteiras[carteira_id].titulos, {'CUR': 2, 'EDPR': 1})
+        self.assertNotIn(carteira_id, ordens_carteira)
+
+        a_aguardar = agenda_ordem(carteira_id, 'VENDA', 'EDPR', 1, 20.0, '')
+        self.assertTrue(altera_ordem(a_aguardar, preco_limite=30.0))
+        atualiza_precos([('EDPR', 25.0)])
+        self.assertIsNotNone(consulta_ordem(a_aguardar))
+        atualiza_precos([('EDPR', 30.0)])
+        self.assertIsNone(consulta_ordem(a_aguardar))
+        self.assertEqual(carteiras[carteira_id].titulos, {'CUR': 2})
+
+        # Cancelamento individual e em bloco, por carteira ou por título
+        a_aguardar = agenda_ordem(carteira_id, 'COMPRA', 'CUR', 1, 0.5, '')
+        self.assertEqual(cancela_ordem(a_aguardar), (carteira_id, 'COMPRA', 'CUR', 1, 0.5, '2023-11-02'))
+        atualiza_precos([('CUR', 0.4)])
+        self.assertEqual(carteiras[carteira_id].titulos, {'CUR': 2})
+        self.assertEqual(cancela_ordens(nome_titulo='EDPR'), [outra])
+        self.assertNotIn('2023-11-03', ordens)
+        ordem_ids = [agenda_ordem(outra_id, 'COMPRA', 'CUR', 1, 100, '2023-11-0%d' % dia) for dia in (4, 5)]
+        self.assertEqual(cancela_ordens(outra_id), ordem_ids)
+        self.assertEqual(ordens_carteira.get(outra_id), None)
+        agenda_ordem(outra_id, 'COMPRA', 'CUR', 1, 100, '2023-11-04')
+        encerra_carteira(outra_id)
+        self.assertNotIn('2023-11-04', ordens)
+
+        # Alterações e cancelamentos repetidos não fazem crescer o livro de limites
+        base = agenda_ordem(carteira_id, 'COMPRA', 'CUR', 1, 0.1, '')
+        for _ in range(100):
+            ordem_id = agenda_ordem(carteira_id, 'COMPRA', 'CUR', 1, 0.2, '')
+            altera_ordem(ordem_id, preco_limite=0.3)
+            altera_ordem(ordem_id, preco_limite=0.2)
+            cancela_ordem(ordem_id)
+        print('livro de limites de CUR: %s\n' % livro_limites['CUR'])
+        self.assertLessEqual(len(livro_limites['CUR']['COMPRA']), 2 * len(ordens_titulo['CUR']))
+        self.assertIn(base, ordens_titulo['CUR'])
+        self.assertEqual(cancela_ordens(carteira_id, 'CUR'), [base])
+        self.assertNotIn(base, ordens_titulo.get('CUR', ()))
+
+    def test_backtest(self):
+        # Teste para a simulação de um período histórico a partir de instantâneos do mercado
+        print("-" * 50)
+        print('\nteste de backtest\n')
+        inicia_dia('2023-10-31')
+        cliente_id = cria_cliente('123456789', 'John Doe', '1990-01-01')
+        movimenta_saldo(cliente_id, 1000)
+        carteira_id = abre_carteira(cliente_id, "Carteira 13")
+        processa_operacao(carteira_id, 'COMPRA', 'CUR', 10)
+        with tempfile.TemporaryDirectory() as pasta:
+            for data, preco_cur, preco_edpr in (('2023-11-01', 1.20, 19.99), ('2023-11-03', 1.50, 18.00),
+                                                ('2023-11-06', 2.00, 17.00)):
+                with open(os.path.join(pasta, data + '.txt'), 'w') as file:
+                    file.write('AGUAS DA CURIA\tCUR\t%.2f\nEDP RENOVAVEIS\tEDPR\t%.2f\n' % (preco_cur, preco_edpr))
+            with open(os.path.join(pasta, 'LEIAME'), 'w') as file:
+                file.write('ignorado')
+            nome_ordens = os.path.join(pasta, 'ordens.csv')
+            with open(nome_ordens, 'w') as file:
+                file.write('%d\tEDPR\t1\t18.50\t2023-11-02\n' % carteira_id)
+
+            self.assertEqual([data for data, _ in backtest.lista_instantaneos(pasta)],
+                             [datetime.date(2023, 11, 1), datetime.date(2023, 11, 3), datetime.date(2023, 11, 6)])
+            self.assertEqual(backtest.divide_periodo(pasta, 2),
+                             [('2023-11-01', '2023-11-02'), ('2023-11-03', '2023-11-06')])
+            saldo_inicial = clientes[carteiras[carteira_id].titulares_id].saldo
+            ordens_iniciais = {data: dict(ordens_data) for data, ordens_data in ordens.items()}
+            cenarios = [{'pasta': pasta, 'ficheiro_ordens': nome_ordens},
+                        {'pasta': pasta, 'data_inicio': '2023-11-03', 'data_fim': '2023-11-06'}]
+            completo, parte = backtest.simula_cenarios(cenarios)
+            print('completo: %s\nparte: %s\n' % (completo, parte))
+            self.assertEqual(completo['datas'], ['2023-11-01', '2023-11-03', '2023-11-06'])
+            self.assertEqual(completo['rejeitadas'], [])
+            # A ordem de 2023-11-02 aguarda no livro de limites até à cotação de 18.00 de 2023-11-03
+            self.assertEqual(list(backtest.serie_carteira(completo, carteira_id)), [12.0, 33.0, 37.0])
+            self.assertEqual(list(backtest.serie_carteira(parte, carteira_id)), [15.0, 20.0])
+            self.assertEqual(os.path.exists(os.path.join(pasta, '2023-11-01.txt.cache')), True)
+            # O estado de p2 fica como estava antes dos cenários
+            self.assertEqual(carteiras[carteira_id].titulos, {'CUR': 10})
+            self.assertEqual(clientes[carteiras[carteira_id].titulares_id].saldo, saldo_inicial)
+            self.assertEqual(estado['hoje'], datetime.date(2023, 10, 31))
+            self.assertEqual(ordens, ordens_iniciais)
+            self.assertEqual(backtest.simula_cenarios(cenarios, processos=2), [completo, parte])
+
+            # Um processo do conjunto que simula vários cenários parte sempre do estado herdado
+            backtest._inicia_processo()
+            try:
+                self.assertEqual([backtest._simula_cenario(cenarios[0]) for _ in range(2)], [completo, completo])
+            finally:
+                backtest._estado_inicial = None
+            self.assertEqual(carteiras[carteira_id].titulos, {'CUR': 10})
+
+            # As ordens do ficheiro são validadas contra o período simulado, qualquer que seja a data atual
+            inicia_dia(str(datetime.date.today()))
+            self.assertEqual(backtest.simula_cenarios(cenarios[:1]), [completo])
+
+    def test_fragmentos(self):
+        # Teste para a repartição dos clientes e carteiras por processos fragmento, executados localmente
+        print("-" * 50)
+        print('\nteste de fragmentos\n')
+        with fragmentos.Encaminhador(3) as encaminhador:
+            encaminhador.carrega_mercado('mercado.txt')
+            encaminhador.inicia_dia('2023-11-01')
+            cliente_ids = [encaminhador.cria_cliente('12345678%d' % i, 'Titular %d' % i, '1990-01-01') for i in range(4)]
+            self.assertEqual([cliente_id % 3 for cliente_id in cliente_ids], [0, 1, 2, 0])
+            for cliente_id in cliente_ids:
+                encaminhador.movimenta_saldo(cliente_id, 100)
+            individual = encaminhador.abre_carteira(cliente_ids[3], "Carteira 14")
+            encaminhador.processa_operacao(individual, 'COMPRA', 'CUR', 10)
+            partilhada = encaminhador.abre_carteira(tuple(cliente_ids[:3]), "Carteira 15")
+            self.assertEqual(encaminhador.partilhadas, {partilhada: tuple(cliente_ids[:3])})
+
+            # Compra confirmada nos três fragmentos, com a unidade que sobra paga pelo primeiro titular
+            self.assertEqual(encaminhador.processa_operacao(partilhada, 'COMPRA', 'EDPR', 1), 19.99)
+            posicoes = encaminhador.posicao_clientes()
+            print('posicoes: %s\n' % posicoes)
+            self.assertEqual(set(posicoes), set(cliente_ids))
+            for cliente_id in cliente_ids:
+                self.assertAlmostEqual(posicoes[cliente_id], encaminhador.posicao_cliente(cliente_id))
+            self.assertEqual(encaminhador.total_ativos(), 400.0)
+
+            # Compra recusada por falta de fundos de um titular remoto: nenhum saldo é alterado
+            encaminhador.movimenta_saldo(cliente_ids[2], -90)
+            saldos_antes = encaminhador.posicao_clientes()
+            with self.assertRaises(ValueError):
+                encaminhador.processa_operacao(partilhada, 'COMPRA', 'EDPR', 2)
+            self.assertEqual(encaminhador.posicao_clientes(), saldos_antes)
+            with self.assertRaises(ValueError):
+                encaminhador.encerra_cliente(cliente_ids[0])
+
+            # Ordem de uma carteira partilhada, guardada no encaminhador até a cotação atingir o limite
+            self.assertTrue(encaminhador.agenda_ordem(partilhada, 'VENDA', 'EDPR', 1, 20, '2023-11-02'))
+            encaminhador.inicia_dia('2023-11-02')
+            self.assertEqual(len(encaminhador.limites), 1)
+            self.assertIn(partilhada, encaminhador.atualiza_precos([('EDPR', 20.01)]))
+            self.assertEqual(encaminhador.limites, {})
+            resumo = encaminhador.gera_resumo(partilhada)
+            self.assertEqual((resumo[0], resumo[3], resumo[5][-1][1]), (partilhada, [], 'VENDA'))
+            self.assertEqual(encaminhador.total_ativos(), 310.02)
+
+            ordem_id = encaminhador.agenda_ordem(partilhada, 'COMPRA', 'CUR', 1, 100, '2023-11-05')
+            self.assertEqual(encaminhador.consulta_ordem(ordem_id), (partilhada, 'COMPRA', 'CUR', 1, 100, '2023-11-05'))
+            outra_id = encaminhador.agenda_ordem(individual, 'COMPRA', 'CUR', 1, 100, '2023-11-05')
+            self.assertEqual(encaminhador.consulta_ordem(outra_id), (individual, 'COMPRA', 'CUR', 1, 100, '2023-11-05'))
+            self.assertEqual(encaminhador.cancela_ordens(nome_titulo='CUR'), sorted([ordem_id, outra_id]))
+            self.assertEqual(encaminhador.consulta_ordem(outra_id), None)
+
+            self.assertEqual(encaminhador.encerra_carteira(partilhada), 0)
+            self.assertEqual(encaminhador.posicao_cliente(cliente_ids[0]), 100.0066)
+            self.assertEqual(encaminhador.encerra_cliente(cliente_ids[0]), 100.0066)
+            self.assertNotIn(cliente_ids[0], encaminhador.posicao_clientes())
+
+            # Ordens a aguardar de uma carteira partilhada, num heap por título e lado: só as que a nova cotação
+            # atinge são executadas, e um limite alterado deixa no heap uma entrada obsoleta
+            outra = encaminhador.abre_carteira((cliente_ids[1], cliente_ids[3]), "Carteira 16")
+            compra_ids = [encaminhador.agenda_ordem(outra, 'COMPRA', 'EDPR', 1, limite, '') for limite in (19, 18, 17)]
+            self.assertEqual(len(encaminhador.livro['EDPR']['COMPRA']), 3)
+            self.assertTrue(encaminhador.altera_ordem(compra_ids[2], preco_limite=19))
+            self.assertEqual(len(encaminhador.livro['EDPR']['COMPRA']), 4)
+            self.assertIn(outra, encaminhador.atualiza_precos([('EDPR', 19)]))
+            self.assertEqual(list(encaminhador.limites), [compra_ids[1]])
+            self.assertEqual(len(encaminhador.livro['EDPR']['COMPRA']), 2)
+            encaminhador.cancela_ordem(compra_ids[1])
+            self.assertEqual(encaminhador.livro['EDPR']['COMPRA'], [])
+            self.assertEqual([linha[2] for linha in encaminhador.gera_resumo(outra)[3]], [2])
+
+            # Uma falha na execução no fragmento da carteira devolve as reservas dos titulares remotos
+            chama = encaminhador._chama
+
+            def falha_na_execucao(fragmento, op, *args):
+                if op == '_executa_carteira':
+                    raise ValueError('falha simulada')
+                return chama(fragmento, op, *args)
+
+            posicoes = encaminhador.posicao_clientes()
+            encaminhador._chama = falha_na_execucao
+            try:
+                with self.assertRaises(ValueError):
+                    encaminhador.processa_operacao(outra, 'VENDA', 'EDPR', 2)
+            finally:
+                del encaminhador._chama
+            self.assertEqual(encaminhador.posicao_clientes(), posicoes)
+
+            # Ficheiro de ordens com identificadores globais: cada linha é carregada no fragmento da sua carteira e
+            # as das carteiras partilhadas ficam no encaminhador
+            linhas = ['%d\tCUR\t1\t100\t2023-11-10' % individual,
+                      '%d\tEDPR\t-1\t1\t2023-11-10' % outra,
+                      'x\tCUR\t1\t1\t2023-11-10',
+                      '%d\tXPTO\t1\t1\t2023-11-10' % outra,
+                      '999999\tCUR\t1\t1\t2023-11-10',
+                      '%d\tEDPR\t-1\t100\t2023-11-02' % outra]
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+                f.write('\n'.join(linhas))
+            try:
+                rejeitadas = encaminhador.carrega_ordens(f.name, tamanho_bloco=4)
+            finally:
+                os.remove(f.name)
+            print('rejeitadas: %s\n' % rejeitadas)
+            self.assertEqual(rejeitadas, [(3, 'valor numerico invalido'), (4, 'titulo inexistente'),
+                                          (5, 'carteira inexistente')])
+            self.assertEqual(list(encaminhador.agendadas.values()), [(outra, 'VENDA', 'EDPR', 1, 1.0, '2023-11-10')])
+            self.assertEqual(list(encaminhador.limites.values()), [(outra, 'VENDA', 'EDPR', 1, 100.0, '2023-11-02')])
+            self.assertEqual(len(encaminhador.cancela_ordens(carteira_id=individual)), 1)
+
+def espera(segundos):
+    # Função auxiliar com uma moldura própria em Python, para ser encontrada pelo perfilador por amostragem
+    time.sleep(segundos)
 
 if __name__ == '__main__':
     unittest.main()